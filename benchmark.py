@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+import sys
+import time
+import tempfile
+import shutil
+import numpy as np
+import pandas as pd
+from tests.synthetic import random_contract, synthetic_contracts
+
+
+"""
+Script usage: python benchmark.py <section>
+Runs performance checks on synthetic or locally stored data and prints the timings.
+
+Sections:
+store - read time of a single contract and of the last 3 years of contracts from the HDF store as
+        the instrument file grows, compared to loading the whole file
+panama - panama stitching time for every instrument in config.instruments, the vectorized engine
+         compared to the join based implementation. Uses the stored quotes where available,
+         synthetic contracts otherwise.
+ipc - pickled size and transfer time of the instruments and their results sent through the
+      process pool, Instrument objects and pandas results compared to the specs and packed
+      results of core.ipc. Uses synthetic contracts.
+ewmac - EWMAC crossovers of the default periods for a date x instrument matrix of synthetic prices,
+        pickleable_ewmac() per instrument and period compared to the single pass of
+        trading.rules.ewmac_batch()
+breakout - breakout forecasts of synthetic prices for growing numbers of lookbacks, breakout_fn()
+           per lookback compared to the single pass of trading.rules.breakout_batch()
+norm - forecasts calculation time of every normalisation estimator of core.normalization and the
+       speedup compared to the arch bootstrap. Uses synthetic contracts.
+"""
+
+
+def timeit(fn, repeat=5):
+    """Best wall time of fn() in seconds"""
+    best = np.inf
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def bench_store():
+    import core.hdfstore as hdfstore
+    hdfstore.hdf_path = tempfile.mkdtemp()
+    try:
+        print('%10s %10s %14s %14s %14s' % ('contracts', 'rows', 'contract (ms)', 'recent (ms)',
+                                            'symbol (ms)'))
+        contracts = [y * 100 + m for y in range(1900, 2020) for m in range(1, 13)]
+        written = 0
+        for n in (30, 90, 270, 810):
+            data = pd.concat([random_contract(c) for c in contracts[written:n]])
+            hdfstore.write_data(data, 'BENCH', 'futures', 'bench')
+            written = n
+            hdfstore.compact('BENCH', 'futures', 'bench')
+            t_contract = timeit(lambda: hdfstore.read_contract('BENCH', contracts[0], 'bench'))
+            recent = slice(contracts[n - 36], None)
+            t_recent = timeit(lambda: hdfstore.read_symbol('BENCH', 'futures', 'bench',
+                                                           contracts=recent))
+            t_symbol = timeit(lambda: hdfstore.read_symbol('BENCH', 'futures', 'bench'))
+            print('%10d %10d %14.1f %14.1f %14.1f' % (n, n * 500, t_contract * 1000,
+                                                      t_recent * 1000, t_symbol * 1000))
+    finally:
+        shutil.rmtree(hdfstore.hdf_path)
+
+
+def bench_panama():
+    from core.instrument import Instrument
+    from core.utility import panama_stitch
+
+    def join_stitch(close, rp):
+        # the implementation replaced by core.utility.panama_stitch()
+        return close.diff().to_frame().swaplevel().fillna(0).join(
+            rp.to_frame().set_index('contract', append=True), how='inner').\
+            reset_index('contract', drop=True)['close'].cumsum()
+
+    print('%-16s %10s %10s %12s %12s %8s' % ('instrument', 'source', 'rows', 'join (ms)',
+                                             'arrays (ms)', 'equal'))
+    total_join, total_arrays = 0, 0
+    for name, inst in sorted(Instrument.load(None).items()):
+        try:
+            data = inst.contracts()
+        except Exception:
+            data = None
+        source = 'store'
+        if data is None or data.empty:
+            data, source = synthetic_contracts(inst), 'synthetic'
+        close, rp = data['close'], inst.roll_progression()
+        t_join = timeit(lambda: join_stitch(close, rp))
+        t_arrays = timeit(lambda: panama_stitch(close, rp))
+        equal = join_stitch(close, rp).equals(panama_stitch(close, rp))
+        total_join += t_join
+        total_arrays += t_arrays
+        print('%-16s %10s %10d %12.1f %12.1f %8s' % (name, source, len(close), t_join * 1000,
+                                                     t_arrays * 1000, equal))
+    print('%-16s %10s %10s %12.1f %12.1f' % ('total', '', '', total_join * 1000,
+                                             total_arrays * 1000))
+
+
+def synthetic_store(count=8):
+    """
+    Point the quotes storage and the caches to a temporary directory with synthetic contracts
+    for the first quandl futures in config.instruments
+    :return: (temporary directory, list of the instruments)
+    """
+    import core.hdfstore as hdfstore
+    import core.pricecache as pricecache
+    import core.catalog as catalog
+    from core.contract_store import Store, QuotesType
+    from core.instrument import Instrument
+    tmp = tempfile.mkdtemp()
+    hdfstore.hdf_path = pricecache.cache_path = catalog.cache_path = tmp
+    instruments = [i for _, i in sorted(Instrument.load(None).items())
+                   if not hasattr(i, 'spot') and hasattr(i, 'quandl_database') and
+                   hasattr(i, 'quandl_symbol') and 'quandl' in i.contract_data][:count]
+    for inst in instruments:
+        data = synthetic_contracts(inst).reset_index().assign(volume=10)
+        data['open'] = data['close']
+        Store('quandl', QuotesType.futures,
+              inst.quandl_database + '_' + inst.quandl_symbol).update(data)
+    return tmp, instruments
+
+
+def bench_ipc():
+    import dill
+    import pickle
+    from multiprocessing_on_dill import Pool
+    from contextlib import closing
+    from core.ipc import map_instruments, pack
+    tmp, instruments = synthetic_store()
+    try:
+        def transfer(obj, dumps):
+            """Pickled size in bytes and the best dumps + loads time in ms"""
+            return len(dumps(obj)), timeit(lambda: pickle.loads(dumps(obj))) * 1000
+
+        print('%-12s %-10s %12s %10s %14s %10s' % ('instrument', 'object', 'dill (B)', 'ms',
+                                                  'core.ipc (B)', 'ms'))
+        for inst in instruments:
+            forecasts = inst.forecasts()
+            rows = [('instrument', transfer(inst, dill.dumps),
+                     transfer(inst.to_spec(), pickle.dumps)),
+                    ('forecasts', transfer(forecasts, dill.dumps),
+                     transfer(pack(forecasts), pickle.dumps))]
+            for obj, (old_size, old_t), (new_size, new_t) in rows:
+                print('%-12s %-10s %12d %10.2f %14d %10.2f' % (inst.name, obj, old_size, old_t,
+                                                              new_size, new_t))
+
+        def objects_map():
+            with closing(Pool()) as pool:
+                return dict(pool.map(lambda x: (x.name, x.forecasts()), instruments))
+        t_objects = timeit(objects_map, repeat=3)
+        t_specs = timeit(lambda: map_instruments(instruments, 'forecasts'), repeat=3)
+        print('process pool forecasts of %d instruments: objects %.2f s, core.ipc %.2f s' %
+              (len(instruments), t_objects, t_specs))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_ewmac():
+    from trading.rules import ewmac_batch, pickleable_ewmac
+    periods = [8, 16, 32, 64]
+    print('%12s %10s %14s %12s %8s' % ('instruments', 'rows', 'pandas (ms)', 'batch (ms)',
+                                       'speedup'))
+    for n in (1, 10, 50, 100):
+        prices = pd.DataFrame(100 + np.random.randn(10000, n).cumsum(axis=0),
+                              index=pd.bdate_range('1980-01-01', periods=10000))
+        t_pandas = timeit(lambda: [pickleable_ewmac(prices[c], x)
+                                   for c in prices.columns for x in periods], repeat=3)
+        t_batch = timeit(lambda: ewmac_batch(prices, periods), repeat=3)
+        print('%12d %10d %14.1f %12.1f %8.1f' % (n, len(prices), t_pandas * 1000,
+                                                 t_batch * 1000, t_pandas / t_batch))
+
+
+def bench_breakout():
+    from trading.rules import breakout_batch, breakout_fn
+    prices = pd.Series(100 + np.random.randn(10000).cumsum(),
+                       index=pd.bdate_range('1980-01-01', periods=10000))
+    print('%10s %10s %14s %12s %8s' % ('lookbacks', 'rows', 'pandas (ms)', 'batch (ms)',
+                                       'speedup'))
+    for n in (4, 16, 32, 64):
+        lookbacks = list(np.unique(np.geomspace(10, 640, n).astype(int)))
+        t_pandas = timeit(lambda: [breakout_fn(prices, x) for x in lookbacks], repeat=3)
+        t_batch = timeit(lambda: breakout_batch(prices, lookbacks), repeat=3)
+        print('%10d %10d %14.1f %12.1f %8.1f' % (len(lookbacks), len(prices), t_pandas * 1000,
+                                                 t_batch * 1000, t_pandas / t_batch))
+
+
+def bench_norm():
+    import core.normalization as normalization
+    from core.instrument import Instrument
+    tmp, instruments = synthetic_store()
+    methods = ('bootstrap', 'resample', 'analytic')
+    try:
+        print('%-12s' % 'instrument' + ''.join('%14s' % (m + ' (ms)') for m in methods) +
+              '%12s %12s' % ('resample x', 'analytic x'))
+        for inst in instruments:
+            # fills the price cache, the timings use fresh instruments as the forecasts are memoized
+            inst.forecasts()
+            times = {}
+            for m in methods:
+                normalization.estimator = m
+                times[m] = timeit(lambda: Instrument.from_spec(inst.to_spec()).forecasts(),
+                                  repeat=1 if m == 'bootstrap' else 3) * 1000
+            print('%-12s' % inst.name + ''.join('%14.1f' % times[m] for m in methods) +
+                  '%12.1f %12.1f' % (times['bootstrap'] / times['resample'],
+                                     times['bootstrap'] / times['analytic']))
+    finally:
+        shutil.rmtree(tmp)
+
+
+sections = {
+    'store': bench_store,
+    'panama': bench_panama,
+    'ipc': bench_ipc,
+    'ewmac': bench_ewmac,
+    'breakout': bench_breakout,
+    'norm': bench_norm,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in sections:
+        print('Usage: benchmark.py [%s]' % '|'.join(sections.keys()))
+        sys.exit(1)
+    sections[sys.argv[1]]()
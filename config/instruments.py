@@ -24,6 +24,7 @@ Schema:
     'point_value': 50,                      # $ move per point move on the futures contract. Usually equal to the contract multiplier.
     'spread': 0.25,                         # Estimated spread, for estimating costs
     'commission': 2.81,                     # Interactive Brokers per contract commission in base currency
+    'storage_precision': 0.01,              # Optional. Max. error of the stored prices, in points (see core/schema.py)
 },
 
 
@@ -274,7 +275,7 @@ instruments_all = {
             'point_value': 500000,
             'denomination': 'USD',
             'spread': .00001,
-            'spot': Currency('MXNUSD').rate,
+            'spot': Currency.get('MXNUSD').rate,
             'expiry': 18,
         }, {
             'name': 'aud',
@@ -290,7 +291,7 @@ instruments_all = {
             'exchange': 'GLOBEX',
             'point_value': 100000,
             'spread': 0.0001,
-            'spot': Currency('AUDUSD').rate,
+            'spot': Currency.get('AUDUSD').rate,
             'expiry': 18,
         }, {
             'name': 'eur',
@@ -306,7 +307,7 @@ instruments_all = {
             'exchange': 'GLOBEX',
             'point_value': 125000,
             'spread':0.00005,
-            'spot': Currency('EURUSD').rate,
+            'spot': Currency.get('EURUSD').rate,
             'expiry': 18,
         }, {
             'name': 'gbp',
@@ -322,7 +323,7 @@ instruments_all = {
             'point_value': 62500,
             'denomination': 'USD',
             'spread': .0001,
-            'spot': Currency('GBPUSD').rate,
+            'spot': Currency.get('GBPUSD').rate,
             'expiry': 18,
         }, {
             'name':'nzd',
@@ -338,7 +339,7 @@ instruments_all = {
             'exchange': 'GLOBEX',
             'point_value': 1E6,
             'spread':0.0001,
-            'spot': Currency('NZDUSD').rate,
+            'spot': Currency.get('NZDUSD').rate,
             'expiry': 18,
         }, {
             'name': 'yen',
@@ -355,7 +356,7 @@ instruments_all = {
             'quandl_data_factor': 1000000,
             'point_value': 12500000,
             'spread': .0000005,
-            'spot': Currency('JPYUSD').rate,
+            'spot': Currency.get('JPYUSD').rate,
             'expiry': 18,
         }, {
             'name': 'bitcoin',
@@ -6,4 +6,6 @@ These methods are used in core.contract_store.
 """
 
 if quotes_storage == 'hdf5':
-    from core.hdfstore import read_symbol, read_contract, write_data, drop_symbol
\ No newline at end of file
+    from core.hdfstore import read_symbol, read_contract, write_data, drop_symbol, version
+elif quotes_storage == 'parquet':
+    from core.parquetstore import read_symbol, read_contract, write_data, drop_symbol, version
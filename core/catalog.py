@@ -0,0 +1,192 @@
+import json
+import os
+import pandas as pd
+import config.settings
+from core.fileutil import file_lock, atomic_write
+from core.utility import active_quotes
+
+"""
+Metadata catalog of the local storage.
+
+For every stored symbol the catalog records the first date, the last date, the last active date
+(see core.utility.active_quotes(), the same rows core.instrument.Instrument.contracts() keeps),
+the number of rows and a checksum of the contents of each contract (other quotes types have a
+single entry, contract 0). It's updated on every core.contract_store.Store.update()
+from the rows the storage backend has written, so freshness checks and incremental downloads
+don't need to load the price data.
+
+* Files structure: "[settings.cache_path]/catalog/[provider]/[q_type]/[symbol].json"
+* A catalog file holds the storage version it was computed for. If the symbol has been written
+  without updating the catalog, it is rebuilt from the storage on the next query.
+* The checksum of a contract is the sum of the hashes of its rows modulo 2**64, so it's updated
+  by adding the hashes of the written rows and subtracting the hashes of the rows they replaced.
+"""
+cache_path = getattr(config.settings, 'cache_path',
+                     os.path.join(os.path.dirname(config.settings.hdf_path), 'cache'))
+columns = ['first_date', 'last_date', 'last_active', 'rows', 'checksum']
+# Version of the catalog entries, the catalogs written by other versions are rebuilt
+layout = 2
+
+
+def fname(store):
+    """
+    Resolve the catalog file name for a core.contract_store.Store
+    """
+    fname = os.path.join(cache_path, 'catalog', store.provider, store.quotes_type.value,
+                         store.symbol + '.json')
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    return fname
+
+
+def get(store):
+    """
+    Query the catalog of a symbol
+    :param store: core.contract_store.Store object
+    :return: pd.DataFrame indexed by contract with columns first_date, last_date, last_active,
+             rows, checksum
+    """
+    entries = _load(store)
+    version = store.version()
+    if entries is None or entries['version'] != version:
+        with file_lock(fname(store)):
+            entries = {'version': version, 'contracts': _stats(store.get())}
+            _save(store, entries)
+    return _to_frame(entries['contracts'])
+
+
+def update(store, data, replaced=None, previous=None):
+    """
+    Update the catalog entries of the contracts which have been written, from the written rows
+    :param store: core.contract_store.Store object
+    :param data: pd.DataFrame of the rows written to the store, as they are read from it
+    :param replaced: pd.DataFrame of the previous version of the rows in data, or None if data
+                     holds the whole contents of its contracts
+    :param previous: version of the store before the write, the catalog is rebuilt from the
+                     storage if it's not up to date with it
+    """
+    with file_lock(fname(store)):
+        entries = _load(store) if previous is not None else {'contracts': {}}
+        if entries is None or entries.get('version', previous) != previous:
+            entries = {'contracts': _stats(store.get())}
+        elif replaced is None:
+            entries['contracts'].update(_stats(data))
+        else:
+            contracts = entries['contracts']
+            stale = _merge(contracts, data, replaced)
+            if stale:
+                # the last active date has been revised, it can't be updated from the delta
+                contracts.update(_stats(store.get(contracts=stale)))
+        entries['version'] = store.version()
+        _save(store, entries)
+
+
+def last_date(store, contract=None):
+    """
+    :return: last stored date of the contract (or of the whole symbol if contract is None),
+             None if there is no data
+    """
+    c = get(store)
+    if contract is not None:
+        c = c[c.index == int(contract)]
+    return c['last_date'].max() if not c.empty else None
+
+
+def checksums(data):
+    """
+    Checksums of the contracts of a quotes DataFrame as stored in the local storage, computed as
+    in the catalog entries
+    :return: dict {contract: checksum}
+    """
+    return {int(k): e[-1] for k, e in _stats(data).items()}
+
+
+def _stats(data):
+    """
+    Compute the catalog entries of a quotes DataFrame as stored in the local storage
+    :return: dict {contract: [first_date, last_date, last_active, rows, checksum]}
+    """
+    return {str(k): _entry(v) for k, v in _aggregate(data).iterrows()}
+
+
+def _merge(contracts, data, replaced):
+    """
+    Update the catalog entries in place with the written rows
+    :param contracts: dict of catalog entries, see _stats()
+    :return: list of the contracts whose entries have to be recomputed from the storage
+    """
+    new, old = _aggregate(data), _aggregate(replaced)
+    stale = []
+    for k, v in new.iterrows():
+        e = contracts.get(str(k))
+        if e is None:
+            contracts[str(k)] = _entry(v)
+            continue
+        first, last, active, rows, checksum = e
+        active = pd.Timestamp(active) if active else pd.NaT
+        checksum = int(checksum, 16)
+        if k in old.index:
+            o = old.loc[k]
+            rows -= int(o.rows)
+            checksum -= int(o.checksum)
+            if o.last_active >= active and not v.last_active >= o.last_active:
+                stale.append(int(k))
+        v.first_date = min(v.first_date, pd.Timestamp(first))
+        v.last_date = max(v.last_date, pd.Timestamp(last))
+        if not v.last_active >= active:
+            v.last_active = active
+        v.rows += rows
+        v.checksum = checksum + int(v.checksum)
+        contracts[str(k)] = _entry(v)
+    return stale
+
+
+def _aggregate(data):
+    """
+    Group the rows of a quotes DataFrame by contract
+    :return: pd.DataFrame indexed by contract with the catalog columns, the checksums as integers
+    """
+    if data.empty:
+        return pd.DataFrame(columns=columns, index=pd.Index([], name='contract'))
+    futures = isinstance(data.index, pd.MultiIndex)
+    dates = data.index.get_level_values('date') if futures else pd.DatetimeIndex(data.index)
+    keys = data.index.get_level_values('contract') if futures else [0] * len(data)
+    active = active_quotes(data)
+    df = pd.DataFrame({'date': dates, 'active': dates.where(active),
+                       'hash': pd.util.hash_pandas_object(data).values},
+                      index=pd.Index(keys, name='contract'))
+    g = df.groupby(level='contract')
+    return pd.DataFrame({'first_date': g['date'].min(), 'last_date': g['date'].max(),
+                         'last_active': g['active'].max(), 'rows': g.size(),
+                         'checksum': g['hash'].sum()}, columns=columns).astype({'checksum': object})
+
+
+def _entry(v):
+    """Catalog entry of a row of _aggregate()"""
+    return [v.first_date.isoformat(), v.last_date.isoformat(),
+            v.last_active.isoformat() if pd.notnull(v.last_active) else None, int(v.rows),
+            '%016x' % (int(v.checksum) % 2 ** 64)]
+
+
+def _to_frame(contracts):
+    data = pd.DataFrame.from_dict(contracts, orient='index', columns=columns)
+    data.index = pd.Index([int(c) for c in data.index], name='contract')
+    data['first_date'] = pd.to_datetime(data['first_date'])
+    data['last_date'] = pd.to_datetime(data['last_date'])
+    data['last_active'] = pd.to_datetime(data['last_active'])
+    return data.sort_index()
+
+
+def _load(store):
+    try:
+        with open(fname(store)) as f:
+            entries = json.load(f)
+        return entries if entries.get('layout') == layout else None
+    except (IOError, ValueError):
+        return None
+
+
+def _save(store, entries):
+    entries['layout'] = layout
+    with atomic_write(fname(store)) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
@@ -1,5 +1,6 @@
 import pandas as pd
 import core.basestore as basestore
+import core.catalog as catalog
 from enum import Enum
 
 # This list is kept separately from the global config.settings.data_sources, because data may
@@ -31,7 +32,7 @@ columns_mapping = {
 
 class Store(object):
     """
-    Class to write, read and delete data from local storage (either MySQL of HDF5)
+    Class to write, read and delete data from local storage (either HDF5 or Parquet)
     """
     def __init__(self, provider, quotes_type, symbol):
         assert isinstance(quotes_type, QuotesType)
@@ -44,11 +45,39 @@ class Store(object):
     def update(self, new_data):
         """Write a DataFrame to the local storage. Data will be updated on index collision"""
         assert type(new_data) is pd.DataFrame
-        basestore.write_data(new_data, self.symbol, self.quotes_type.value, self.provider)
+        previous = self.version()
+        rows, replaced = basestore.write_data(new_data, self.symbol, self.quotes_type.value,
+                                              self.provider)
+        catalog.update(self, rows, replaced, previous)
 
-    def get(self):
-        """Read a symbol from the local storage"""
-        return basestore.read_symbol(self.symbol, self.quotes_type.value, self.provider)
+    def get(self, start=None, end=None, contracts=None, columns=None):
+        """
+        Read a symbol from the local storage. The optional selection is pushed down to the
+        storage backend, so only the selected data is read.
+        :param start: first date to read, inclusive
+        :param end: last date to read, inclusive
+        :param contracts: list of contract labels, or a slice of labels (futures only)
+        :param columns: list of data columns to read, all columns if None
+        """
+        return basestore.read_symbol(self.symbol, self.quotes_type.value, self.provider,
+                                     start=start, end=end, contracts=contracts, columns=columns)
+
+    def get_contract(self, contract, start=None, end=None):
+        """Read a single futures contract from the local storage, optionally a date range only"""
+        assert self.quotes_type == QuotesType.futures
+        return basestore.read_contract(self.symbol, contract, self.provider, start=start, end=end)
+
+    def catalog(self):
+        """
+        Metadata of the stored symbol, see core.catalog
+        :return: pd.DataFrame indexed by contract with columns first_date, last_date, last_active,
+                 rows, checksum
+        """
+        return catalog.get(self)
+
+    def version(self):
+        """Token identifying the current state of the symbol in the local storage, or None"""
+        return basestore.version(self.symbol, self.quotes_type.value, self.provider)
 
     def delete(self):
         """Delete a symbol from the local storage"""
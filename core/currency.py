@@ -1,4 +1,5 @@
 import datetime
+import threading
 import pandas as pd
 import config.settings
 import config.currencies
@@ -7,6 +8,19 @@ from core.logger import get_logger
 
 logger = get_logger('currency')
 
+"""
+Currency exchange rates.
+
+* Currency.get(code) returns the process-wide Currency object of a pair, shared by all the
+  instruments with the same denomination. Pickled currencies are restored from the registry too.
+* The rate series is loaded once and cached in the object until the stored data of the pair
+  changes (see Currency.version())
+* Pairs which are not defined in config/currencies.py, or have no stored data, are cross rates
+  through the base currency: XXXYYY = XXX[base] / YYY[base]
+"""
+_registry = {}
+_registry_lock = threading.Lock()
+
 
 class Currency(object):
     """
@@ -16,7 +30,17 @@ class Currency(object):
     @classmethod
     def load_all(cls):
         """Load all currencies in the system into a dictionary"""
-        return {v['code']: Currency(v['code']) for v in config.currencies.currencies_definitions}
+        return {v['code']: Currency.get(v['code']) for v in config.currencies.currencies_definitions}
+
+    @classmethod
+    def get(cls, code):
+        """
+        Shared Currency object for the pair, created on the first request
+        """
+        with _registry_lock:
+            if code not in _registry:
+                _registry[code] = Currency(code)
+            return _registry[code]
 
     def __init__(self, code):
         """Initialise the currency with defaults, taking overrides from the config/currencies.py"""
@@ -24,9 +48,22 @@ class Currency(object):
         self.ib_symbol = None
         self.quandl_symbol = None
         self.currency_data = ['ib', 'quandl']
-        kwargs = config.currencies.currencies_all[code]
-        for key, value in kwargs.items():
-            setattr(self, key, value)
+        # codes of the pairs to the base currency if this is a cross rate
+        self.cross = _cross(code)
+        if code in config.currencies.currencies_all:
+            kwargs = config.currencies.currencies_all[code]
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+        elif self.cross is not None:
+            self.currency_data = []
+        else:
+            raise KeyError(code)
+        self._rate = None
+        self._version = None
+
+    def __reduce__(self):
+        # the definitions hold lambdas, a pickled currency is restored from the registry by code
+        return Currency.get, (self.code,)
 
     def rate(self, nofx=False):
         """
@@ -35,13 +72,31 @@ class Currency(object):
         """
         if nofx is True:
             return 1
-        elif self.code == config.settings.base_currency * 2:
+        elif self.code[:3] == self.code[3:]:
             return 1
-        else:
-            data = data_feed.get_currency(self)
-            if data is None or data.empty:
-                raise Exception("No price data for currency %s" % self.code)
+        version = self.version()
+        if self._rate is None or self._version != version:
+            self._rate = self._load()
+            self._version = version
+        return self._rate
+
+    def version(self):
+        """
+        Token identifying the stored data of the pair (of both pairs for a cross rate)
+        """
+        versions = [data_feed.currency_version(self)]
+        if self.cross is not None:
+            versions.extend(Currency.get(c).version() for c in self.cross)
+        return '/'.join(versions)
+
+    def _load(self):
+        data = data_feed.get_currency(self) if self.currency_data else None
+        if data is not None and not data.empty:
             return data['rate']
+        if self.cross is None:
+            raise Exception("No price data for currency %s" % self.code)
+        logger.debug("Currency %s calculated as %s / %s" % ((self.code,) + self.cross))
+        return cross_rate(*[Currency.get(c).rate() for c in self.cross]).rename('rate')
 
     def __repr__(self):
         return self.code
@@ -50,7 +105,34 @@ class Currency(object):
         """
         :return: age of the price data in days
         """
-        if self.rate() is 1:
+        rate = self.rate()
+        if not isinstance(rate, pd.Series):
             return 0
         else:
-            return (pd.to_datetime(datetime.date.today()) - self.rate().tail(1).index[0]).days
+            return (pd.to_datetime(datetime.date.today()) - rate.index[-1]).days
+
+
+def cross_rate(numerator, denominator):
+    """
+    Divide the rates aligned on the union of their dates, carrying the last rate forward
+    :param numerator: pd.Series or 1
+    :param denominator: pd.Series or 1
+    :return: pd.Series
+    """
+    if isinstance(numerator, pd.Series) and isinstance(denominator, pd.Series):
+        rates = pd.concat([numerator, denominator], axis=1, sort=True).ffill().dropna()
+        return rates.iloc[:, 0] / rates.iloc[:, 1]
+    return numerator / denominator
+
+
+def _cross(code):
+    """
+    The pairs to the base currency to calculate the pair through, None if the pair is one of
+    them or they are not defined
+    """
+    base = config.settings.base_currency
+    pairs = (code[:3] + base, code[3:] + base)
+    if len(code) != 6 or code in pairs or \
+            not all(p in config.currencies.currencies_all for p in pairs):
+        return None
+    return pairs
@@ -1,4 +1,7 @@
+import pandas as pd
 from core.contract_store import Store, QuotesType
+from core import pricecache
+from core.utility import filter_quotes
 import core.logger
 from config.settings import data_sources
 logger = core.logger.get_logger('data_feed')
@@ -7,18 +10,117 @@ logger = core.logger.get_logger('data_feed')
 This file defines functions to pull the contracts data from the local storage for multiple
 data providers and merge them into a single pd.DataFrame. On duplicate index, data providers are
 prioritized in the order they appear in the list in the instrument definition (config/instruments.py) 
+The merged data is persisted in core.pricecache and rebuilt when any provider's data changes.
 """
 
 
-def get_instrument(instrument):
+def get_instrument(instrument, start=None, end=None, contracts=None, columns=None):
     """
     Get all contracts data for an instrument
     :param instrument: core.trading.Instrument object
+    :param start: first date to read, inclusive
+    :param end: last date to read, inclusive
+    :param contracts: list of contract labels, or a slice of labels
+    :param columns: list of data columns to read, all columns if None
     :return: price data as pd.DataFrame
     """
+    return _get_merged(QuotesType.futures, instrument.name, instrument_sources(instrument),
+                       start=start, end=end, contracts=contracts, columns=columns)
+
+
+def get_currency(currency, start=None, end=None):
+    """
+    Get data for a currency
+    :param currency: core.currency.Currency object
+    :param start: first date to read, inclusive
+    :param end: last date to read, inclusive
+    :return: rate data as pd.DataFrame
+    """
+    return _get_merged(QuotesType.currency, currency.code, currency_sources(currency),
+                       start=start, end=end)
+
+
+def get_spot(spot, start=None, end=None):
+    """
+    Get data for a spot
+    :param spot: core.spot.Spot object
+    :param start: first date to read, inclusive
+    :param end: last date to read, inclusive
+    :return: price data as pd.DataFrame
+    """
+    return _get_merged(QuotesType.others, spot.name, spot_sources(spot), start=start, end=end)
+
+
+def get_catalog(instrument):
+    """
+    Get the storage catalog of an instrument without loading the price data
+    :param instrument: core.trading.Instrument object
+    :return: pd.DataFrame indexed by ['provider', 'contract'], see core.catalog
+    """
+    frames = [Store(p, QuotesType.futures, db + '_' + symbol).catalog()
+              for p, db, symbol in instrument_sources(instrument)]
+    if not frames:
+        return None
+    return pd.concat(frames, keys=[p for p, _, _ in instrument_sources(instrument)],
+                     names=['provider'])
+
+
+def instrument_version(instrument):
+    """
+    Version of all the stored data an instrument's calculations depend on: its contracts, the
+    exchange rate of its denomination and the spot price used for carry. It changes whenever any
+    of them is written.
+    :param instrument: core.trading.Instrument object
+    :return: version string
+    """
+    versions = [_version(QuotesType.futures, instrument_sources(instrument)),
+                instrument.currency.version()]
+    # the spot is a bound method of a core.currency.Currency or core.spot.Spot object
+    spot = getattr(getattr(instrument, 'spot', None), '__self__', None)
+    if hasattr(spot, 'currency_data'):
+        versions.append(spot.version())
+    elif hasattr(spot, 'price_data'):
+        versions.append(_version(QuotesType.others, spot_sources(spot)))
+    return '/'.join(versions)
+
+
+def instrument_stores(instrument):
+    """
+    Stores of the quotes an instrument's prices and forecasts are calculated from: its contracts
+    and the spot price used for carry. The exchange rate is not included.
+    :param instrument: core.trading.Instrument object
+    :return: list of core.contract_store.Store objects
+    """
+    stores = [Store(p, QuotesType.futures, db + '_' + symbol)
+              for p, db, symbol in instrument_sources(instrument)]
+    spot = getattr(getattr(instrument, 'spot', None), '__self__', None)
+    if hasattr(spot, 'currency_data'):
+        stores += [Store(p, QuotesType.currency, db + '_' + symbol)
+                   for p, db, symbol in currency_sources(spot)]
+    elif hasattr(spot, 'price_data'):
+        stores += [Store(p, QuotesType.others, db + '_' + symbol)
+                   for p, db, symbol in spot_sources(spot)]
+    return stores
+
+
+def currency_version(currency):
+    """
+    Version of the stored data of a currency, which changes whenever any of its sources is written
+    :param currency: core.currency.Currency object
+    :return: version string
+    """
+    return _version(QuotesType.currency, currency_sources(currency))
+
+
+def instrument_sources(instrument):
+    """
+    List the storage locations of an instrument's data
+    :param instrument: core.trading.Instrument object
+    :return: list of (provider, database, symbol) tuples in the order of priority
+    """
     # choose data providers with respect to the global list
     providers = [x for x in instrument.contract_data if x in data_sources]
-    data = None
+    sources = []
     for p in providers:
         if p == 'ib':
             db = instrument.exchange
@@ -28,20 +130,19 @@ def get_instrument(instrument):
             symbol = instrument.quandl_symbol
         else:
             raise Exception('Unknown data provider string: %s' % p)
-        p_data = _get_data(p, QuotesType.futures, db, symbol)
-        data = p_data if data is None else data.combine_first(p_data)
-    return data
+        sources.append((p, db, symbol))
+    return sources
 
 
-def get_currency(currency):
+def currency_sources(currency):
     """
-    Get data for a currency
+    List the storage locations of a currency's data
     :param currency: core.currency.Currency object
-    :return: rate data as pd.DataFrame
+    :return: list of (provider, database, symbol) tuples in the order of priority
     """
     # choose data providers with respect to the global list
     providers = [x for x in currency.currency_data if x in data_sources]
-    data = None
+    sources = []
     for p in providers:
         if p == 'ib':
             db = currency.ib_exchange
@@ -51,20 +152,19 @@ def get_currency(currency):
             symbol = currency.quandl_symbol
         else:
             raise Exception('Unknown data provider string: %s' % p)
-        p_data = _get_data(p, QuotesType.currency, db, symbol)
-        data = p_data if data is None else data.combine_first(p_data)
-    return data
+        sources.append((p, db, symbol))
+    return sources
 
 
-def get_spot(spot):
+def spot_sources(spot):
     """
-    Get data for a spot
+    List the storage locations of a spot's data
     :param spot: core.spot.Spot object
-    :return: price data as pd.DataFrame
+    :return: list of (provider, database, symbol) tuples in the order of priority
     """
     # choose data providers with respect to the global list
     providers = [x for x in spot.price_data if x in data_sources]
-    data = None
+    sources = []
     for p in providers:
         if p == 'ib':
             db = spot.ib_exchange
@@ -74,9 +174,8 @@ def get_spot(spot):
             symbol = spot.quandl_symbol
         else:
             raise Exception('Unknown data provider string: %s' % p)
-        p_data = _get_data(p, QuotesType.others, db, symbol)
-        data = p_data if data is None else data.combine_first(p_data)
-    return data
+        sources.append((p, db, symbol))
+    return sources
 
 
 def get_quotes(provider, **kwargs):
@@ -88,6 +187,54 @@ def get_quotes(provider, **kwargs):
     return _get_data(provider, QuotesType.others, kwargs['database'], kwargs['symbol'])
 
 
+def _get_merged(q_type, name, sources, columns=None, **selection):
+    """
+    Get the merged data of all sources. The merged dataset is materialized in the price cache
+    and only rebuilt when any of the sources has been written since, so an up-to-date dataset
+    costs a single read. Without the cache the selection is pushed down to the storage.
+    :param q_type: QuotesType of the sources
+    :param name: name of the instrument, currency or spot
+    :param sources: list of (provider, database, symbol) tuples in the order of priority
+    :param columns: list of data columns to read, all columns if None
+    :param selection: start, end and contracts, see core.contract_store.Store.get()
+    :return: pd.DataFrame or None
+    """
+    if not pricecache.price_cache:
+        return _merge(q_type, sources, columns=columns, **selection)
+    key = '%s/%s' % (q_type.value, name)
+    version = _version(q_type, sources)
+    data = pricecache.load(key, version, columns)
+    if data is None:
+        data = _merge(q_type, sources)
+        if data is None:
+            return None
+        if not data.empty:
+            pricecache.save(key, version, data)
+        if columns is not None:
+            data = data[list(columns)]
+    # slicing the memory-mapped data only touches the selected rows
+    return filter_quotes(data, **selection)
+
+
+def _merge(q_type, sources, columns=None, **selection):
+    """
+    Read the data of all sources and merge it, prioritizing the sources in the order of the list
+    """
+    data = None
+    for p, db, symbol in sources:
+        p_data = _get_data(p, q_type, db, symbol, columns=columns, **selection)
+        data = p_data if data is None else data.combine_first(p_data)
+    return data
+
+
+def _version(q_type, sources):
+    """
+    Version of the merged data, which changes whenever any of the sources is written
+    """
+    return '|'.join('%s:%s' % (p, Store(p, q_type, db + '_' + symbol).version())
+                    for p, db, symbol in sources)
+
+
 def _get_data(library, q_type, database, symbol, **kwargs):
     """
     General method to get quotes data from storage
@@ -95,10 +242,11 @@ def _get_data(library, q_type, database, symbol, **kwargs):
     :param q_type: one of 'futures' | 'currency' | 'others'
     :param database: local storage database name
     :param symbol: local storage symbol name
+    :param kwargs: start, end, contracts and columns, see core.contract_store.Store.get()
     :return: pd.DataFrame or None in case of error
     """
     try:
-        return Store(library, q_type, database + '_' + symbol).get()
+        return Store(library, q_type, database + '_' + symbol).get(**kwargs)
     except Exception as e:
         logger.warning("Something went wrong on symbol %s_%s request from storage: %s" %
                        (database, symbol, e))
@@ -0,0 +1,104 @@
+import os
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # not available on Windows, only the threads of one process are synchronized
+    fcntl = None
+
+"""
+File system helpers shared by the local storage backends
+"""
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+class _ReadWriteLock(object):
+    """
+    Lock shared by any number of readers or held by a single writer, for the threads of a process.
+    Waiting writers block new readers, so that a stream of reads can't starve the writes.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting = 0
+
+    def acquire(self, shared):
+        with self._cond:
+            if shared:
+                self._cond.wait_for(lambda: not self._writer and not self._waiting)
+                self._readers += 1
+            else:
+                self._waiting += 1
+                self._cond.wait_for(lambda: not self._writer and not self._readers)
+                self._waiting -= 1
+                self._writer = True
+
+    def release(self, shared):
+        with self._cond:
+            if shared:
+                self._readers -= 1
+            else:
+                self._writer = False
+            self._cond.notify_all()
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """
+    Exclusive lock for writing the given file (or directory), held by one thread of one process
+    at a time. It is an advisory lock on a separate "[path].lock" file, so the data file itself
+    may be replaced or removed while the lock is held.
+    :param shared: lock for reading, held by any number of readers at the same time, but not
+                   together with the exclusive lock
+    """
+    path = os.path.abspath(path)
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(path, _ReadWriteLock())
+    thread_lock.acquire(shared)
+    try:
+        if fcntl is None:
+            yield
+            return
+        with open(path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        thread_lock.release(shared)
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    Yields a temporary file name in the directory of path to write the new version of the file
+    to. On success the temporary file is flushed to disk and renamed over path, so readers in
+    other processes see either the old or the new version, never a partially written file.
+    The temporary file is removed if writing fails.
+    """
+    dirname, name = os.path.split(os.path.abspath(path))
+    # the leading dot hides the file from the storage directory listings
+    tmp = os.path.join(dirname, '.%s.tmp-%d-%d' % (name, os.getpid(), threading.get_ident()))
+    try:
+        yield tmp
+        _fsync(tmp)
+        os.replace(tmp, path)
+        _fsync(dirname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _fsync(path):
+    """Flush the file or directory to disk"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:  # directories can't be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -1,7 +1,10 @@
 import pandas as pd
+import config.settings
 from config.settings import hdf_path
 import os
-import threading
+import core.schema as schema
+from core.fileutil import file_lock, atomic_write
+from core.utility import filter_quotes
 
 """
 Implementation of the local storage with HDF5 files as the backend.
@@ -9,8 +12,27 @@ Implementation of the local storage with HDF5 files as the backend.
 * Directories structure for HDF storage:  "[settings.hdf_path]/[provider]/[q_type]/[symbol].h5"
 * For q_type == 'futures' returnes DataFrame with the multi-index ['contract', 'date'],
   for other quotes types index is ['date']
+* Files are written in the HDF 'table' format by default (settings.hdf_format). On update only
+  the new or changed rows are appended to the table, so a row may be stored more than once
+  until the file is compacted. Readers always get the latest version of every row.
+  With hdf_format = 'fixed' the whole file is rewritten on every update.
+* Values are stored in the compact schema of core.schema and upcast when read. Files written
+  before it are converted on their next update, their values are kept exactly unless
+  settings.convert_storage is set.
+* Writes are serialized per file with an advisory lock, which works across threads and processes.
+  Readers take the lock in the shared mode, so they don't block each other.
+* New rows are appended to a table file in place, so the cost of an update doesn't depend on the
+  size of the file. Readers never see a partially appended table, as they wait for the lock.
+  A crash in the middle of an append may leave the file unreadable though, download the symbol
+  again in that case.
+* Full rewrites (compaction, schema changes, 'fixed' files) go to a temporary file which replaces
+  the original one when complete, so a crash during a rewrite can't corrupt the file
 """
-lock = threading.Lock()
+
+# Older settings files don't define the storage format, default to the append-only tables
+hdf_format = getattr(config.settings, 'hdf_format', 'table')
+# Number of appends after which a table file is rewritten without superseded rows
+hdf_compact_after = getattr(config.settings, 'hdf_compact_after', 50)
 
 
 def fname(symbol, q_type, provider):
@@ -20,29 +42,38 @@ def fname(symbol, q_type, provider):
     fname = os.path.join(hdf_path, provider, q_type, symbol + '.h5')
     # create directories
     if not os.path.exists(os.path.dirname(fname)):
-        os.makedirs(os.path.dirname(fname))
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
     return fname
 
 
-def read_contract(symbol, contract, provider):
+def read_contract(symbol, contract, provider, start=None, end=None):
     """
-    Read a single contract for a future instrument
+    Read a single contract for a future instrument, optionally only the dates between start and
+    end (inclusive). For table files only the requested rows are read from disk.
     """
-    if os.path.exists(fname(symbol, 'futures', provider)):
-        data = pd.read_hdf(fname(symbol, 'futures', provider), 'quotes')
-        return data.loc[int(contract), :]
+    f = fname(symbol, 'futures', provider)
+    if os.path.exists(f):
+        with file_lock(f, shared=True):
+            data = _read(f, 'futures', contracts=[contract], start=start, end=end)
+        # an empty date range keeps the columns of the table
+        return data.reset_index('contract', drop=True)
     else:
         c = ['contract', 'date']
         return pd.DataFrame(columns=c).set_index(c)
 
 
-def read_symbol(symbol, q_type, provider):
+def read_symbol(symbol, q_type, provider, start=None, end=None, contracts=None, columns=None):
     """
-    Read data from the corresponding HDF file
+    Read data from the corresponding HDF file. The selection is pushed down to the HDF query.
+    :param start: first date to read, inclusive
+    :param end: last date to read, inclusive
+    :param contracts: list of contract labels, or a slice of labels (futures only)
+    :param columns: list of data columns to read, all columns if None
     """
-    if os.path.exists(fname(symbol, q_type, provider)):
-        data = pd.read_hdf(fname(symbol, q_type, provider), 'quotes')
-        return data
+    f = fname(symbol, q_type, provider)
+    if os.path.exists(f):
+        with file_lock(f, shared=True):
+            return _read(f, q_type, contracts=contracts, start=start, end=end, columns=columns)
     else:  # if symbol doesn't exist, an empty df is returned with only index columns
         c = ['contract', 'date'] if q_type == 'futures' else ['date']
         return pd.DataFrame(columns=c).set_index(c)
@@ -52,21 +83,204 @@ def write_data(data, symbol, q_type, provider):
     """
     Writes a dataframe to HDF file. If the symbol exists, the existing data will be updated
     on dataframe keys, favoring new data.
+    :return: tuple (rows, replaced): the rows written as they are read back, and the previous
+             version of these rows, or None if rows holds the whole contents of the file
     """
-    # Use a thread lock here to ensure the read+merge+write operation is atomic
-    # and HDF files won't get corrupted on concurrent downloading
-    lock.acquire()
-    existing_data = read_symbol(symbol, q_type, provider)
     idx = ['contract', 'date'] if q_type == 'futures' else ['date']
-    lvl = 0 if q_type == 'futures' else None
     data = data.set_index(idx)
-    new_data = data.combine_first(existing_data).sort_index(level=lvl)
-    new_data.to_hdf(fname(symbol, q_type, provider), 'quotes', mode='w', format='f')
-    lock.release()
+    f = fname(symbol, q_type, provider)
+    # Lock the file to ensure the read+merge+write operation is atomic and the HDF file won't get
+    # corrupted on concurrent downloading. Other symbols can be written at the same time.
+    with file_lock(f):
+        appended = _append(f, data, q_type, symbol) \
+            if hdf_format == 'table' and _is_table(f) else None
+        if appended is not None:
+            appends, rows, replaced = appended
+            if appends >= hdf_compact_after:
+                _write(f, _read(f, q_type), symbol, _stored_dtypes(f))
+            return rows, replaced
+        existing_data = _read(f, q_type) if os.path.exists(f) else data.iloc[:0]
+        lvl = 0 if q_type == 'futures' else None
+        new_data = data.combine_first(existing_data).sort_index(level=lvl)
+        return _write(f, new_data, symbol, _stored_dtypes(f)), None
+
+
+def compact(symbol, q_type, provider):
+    """
+    Rewrite a table file without the superseded rows and rebuild its index
+    """
+    f = fname(symbol, q_type, provider)
+    with file_lock(f):
+        if _is_table(f):
+            _write(f, _read(f, q_type), symbol, _stored_dtypes(f))
 
 
 def drop_symbol(symbol, q_type, provider):
     """
     Remove the corresponding HDF file
     """
-    os.remove(fname(symbol, q_type, provider))
+    f = fname(symbol, q_type, provider)
+    with file_lock(f):
+        os.remove(f)
+
+
+def stored_dtypes(symbol, q_type, provider):
+    """
+    Storage dtypes of the data columns of the stored symbol, see core.schema.dtypes()
+    :return: dict {column: dtype name}, or None if the symbol doesn't exist
+    """
+    f = fname(symbol, q_type, provider)
+    if not os.path.exists(f):
+        return None
+    with file_lock(f, shared=True):
+        return _stored_dtypes(f)
+
+
+def version(symbol, q_type, provider):
+    """
+    Token identifying the current state of the stored symbol, it changes on every write
+    :return: version string, or None if the symbol doesn't exist
+    """
+    f = fname(symbol, q_type, provider)
+    if not os.path.exists(f):
+        return None
+    st = os.stat(f)
+    return '%d-%d' % (st.st_mtime_ns, st.st_size)
+
+
+def _is_table(f):
+    """True if the file exists and is written in the HDF table format"""
+    if not os.path.exists(f):
+        return False
+    with pd.HDFStore(f, mode='r') as store:
+        return store.get_storer('quotes').is_table
+
+
+def _read(f, q_type, contracts=None, start=None, end=None, columns=None):
+    """
+    Read the quotes from a file. Selection by contracts, dates and columns is pushed down to the
+    HDF query for table files and applied in memory for fixed files.
+    See read_symbol() for the arguments.
+    For table files the rows appended last win on duplicate keys.
+    """
+    with pd.HDFStore(f, mode='r') as store:
+        storer = store.get_storer('quotes')
+        if storer.is_table:
+            where = _where(q_type, contracts, start, end, days=_is_compact(storer))
+            data = schema.decode(store.select('quotes', where=where,
+                                              columns=None if columns is None else list(columns)))
+            if getattr(storer.attrs, 'appends', 0) > 0:
+                lvl = 0 if q_type == 'futures' else None
+                data = data[~data.index.duplicated(keep='last')].sort_index(level=lvl)
+        else:
+            data = filter_quotes(schema.decode(store.select('quotes')), contracts, start, end)
+            if columns is not None:
+                data = data[list(columns)]
+    return data
+
+
+def _is_compact(storer):
+    """True if the file is written in the compact schema (dates are stored as days)"""
+    return getattr(storer.attrs, 'schema', 0) >= schema.version
+
+
+def _where(q_type, contracts=None, start=None, end=None, days=True):
+    """
+    Build the HDF table query for the given selection
+    :param days: dates are stored as days since 1970-01-01 (see core.schema)
+    :return: list of conditions, or None to select the whole table
+    """
+    date = 'date' if q_type == 'futures' else 'index'
+    where = []
+    if isinstance(contracts, slice):
+        if contracts.start is not None:
+            where.append('contract>=%d' % int(contracts.start))
+        if contracts.stop is not None:
+            where.append('contract<=%d' % int(contracts.stop))
+    elif contracts is not None:
+        where.append('contract=%s' % [int(c) for c in contracts])
+    for op, value in (('>=', start), ('<=', end)):
+        if value is None:
+            continue
+        if days:
+            where.append('%s%s%d' % (date, op, schema.to_days([pd.Timestamp(value)])[0]))
+        else:
+            where.append("%s%s'%s'" % (date, op, pd.Timestamp(value)))
+    return where or None
+
+
+def _stored_dtypes(f):
+    """Storage dtypes of the data columns of a file, None if the file doesn't exist"""
+    if not os.path.exists(f):
+        return None
+    with pd.HDFStore(f, mode='r') as store:
+        return {c: d.name for c, d in store.select('quotes', stop=0).dtypes.items()}
+
+
+def _write(f, data, symbol, stored=None):
+    """
+    Rewrite the whole file in the configured format, with the dtypes chosen for the data
+    :param stored: storage dtypes of the file being rewritten, see core.schema.dtypes()
+    :return: the data as it is read from the file
+    """
+    data = schema.encode(data, schema.dtypes(data, symbol, stored))
+    with atomic_write(f) as tmp:
+        if hdf_format == 'table':
+            data.to_hdf(tmp, key='quotes', mode='w', format='t', data_columns=True, index=False)
+            with pd.HDFStore(tmp) as store:
+                store.create_table_index('quotes', columns=_index_columns(data), optlevel=9,
+                                         kind='full')
+                store.get_storer('quotes').attrs.appends = 0
+                store.get_storer('quotes').attrs.schema = schema.version
+        else:
+            data.to_hdf(tmp, key='quotes', mode='w', format='f')
+    return schema.decode(data)
+
+
+def _append(f, data, q_type, symbol):
+    """
+    Append the rows of data which are new or differ from the stored ones. The rows are appended
+    to the file in place, the caller must hold the file lock.
+    :return: tuple (appends, rows, replaced): the number of appends since the last full rewrite
+             of the file, the appended rows as they are read back and the previous version of
+             these rows. None if the data doesn't fit the table schema and the file has to be
+             rewritten.
+    """
+    with pd.HDFStore(f, mode='r') as store:
+        storer = store.get_storer('quotes')
+        dtypes = {c: d.name for c, d in store.select('quotes', stop=0).dtypes.items()}
+        columns = list(dtypes)
+        if not _is_compact(storer) or not data.columns.isin(columns).all():
+            # the table schema can't be changed in place
+            return None
+        # Only the rows which may collide with the new data are read back
+        if q_type == 'futures':
+            contracts = data.index.get_level_values('contract').unique()
+            start = data.index.get_level_values('date').min()
+            existing = store.select('quotes', where=_where(q_type, contracts, start))
+        else:
+            existing = store.select('quotes', where=_where(q_type, start=data.index.min()))
+        existing = schema.decode(existing)
+        existing = existing[~existing.index.duplicated(keep='last')]
+        merged = data.combine_first(existing).reindex(index=data.index, columns=columns)
+        if not schema.fits(merged, dtypes, symbol):
+            # e.g. a float32 column gets a value which needs more precision
+            return None
+        # compare the values as they would be stored
+        merged = merged.astype(dtypes).astype('float64')
+        old = existing.reindex(index=merged.index, columns=columns)
+        unchanged = ((merged == old) | (merged.isnull() & old.isnull())).all(axis=1)
+        delta = schema.encode(merged[~unchanged].sort_index(), dtypes)
+        appends = getattr(storer.attrs, 'appends', 0)
+    if not delta.empty:
+        appends += 1
+        with pd.HDFStore(f, mode='a') as store:
+            store.append('quotes', delta, format='t', data_columns=True, index=False)
+            store.get_storer('quotes').attrs.appends = appends
+    rows = schema.decode(delta)
+    return appends, rows, existing[existing.index.isin(rows.index)]
+
+
+def _index_columns(data):
+    """Names of the table columns to be indexed"""
+    return list(data.index.names) if isinstance(data.index, pd.MultiIndex) else ['index']
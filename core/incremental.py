@@ -0,0 +1,585 @@
+import abc
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import config.settings
+import config.strategy
+import core.catalog as catalog
+import core.data_feed as data_feed
+from core.contract_store import QuotesType
+from core.fileutil import file_lock, atomic_write
+from core.logger import get_logger
+import core.normalization as normalization
+from core.utility import panama_stitch, RollingExtrema
+import trading.rules
+
+logger = get_logger('incremental')
+
+"""
+Incremental daily update of an instrument's panama prices, return volatility and forecasts.
+
+A full calculation runs every rule over decades of prices and estimates the normalisation of
+every forecast. In the incremental mode the computed series are persisted together with the
+state needed to extend them:
+
+* the last panama level and the market prices of the held contracts
+* EWM means and variances (exact streaming versions of pandas' ewm(adjust=True))
+* the rolling extrema queues of the breakout rule and the smoothing buffers of the carry rules
+* the forecast normalisation scalars, frozen at the last full calculation (the state is rebuilt
+  when a new version of the frozen scalars file is written, see core.normalization)
+
+When N new bars arrive, only the rows after the last computed date are calculated, in O(N) per
+stateful step, from the quotes of the last window_days only. check() compares the extended
+series with a full recalculation (using the same frozen scalars).
+
+* Files structure: "[settings.cache_path]/incremental/[instrument].pkl"
+* The state is rebuilt when the instrument's configuration changes, or when the stored quotes up
+  to the last computed date have been revised: it keeps their checksums (see fingerprint())
+* Rules without an incremental implementation raise ValueError, see rule_states
+"""
+cache_path = getattr(config.settings, 'cache_path',
+                     os.path.join(os.path.dirname(config.settings.hdf_path), 'cache'))
+# Number of calendar days of quotes read before the last computed date to extend the series
+window_days = 366
+# Version of the persisted state, the states saved by other versions are rebuilt
+layout = 2
+
+
+class EWMMean(object):
+    """
+    Streaming version of pd.Series.ewm(com=com, min_periods=min_periods).mean()
+    """
+    def __init__(self, com, min_periods=0):
+        self.factor = 1. - 1. / (1. + com)
+        self.min_periods = max(int(min_periods), 1)
+        self.mean = np.nan
+        self.weight = 1.
+        self.nobs = 0
+
+    @classmethod
+    def span(cls, span, min_periods=0):
+        return cls((span - 1) / 2., min_periods)
+
+    def start(self, values):
+        """
+        Initialise the state from the whole history
+        :return: np.ndarray, the result of pandas for the history
+        """
+        s = pd.Series(values, dtype='float64')
+        com = 1. / (1. - self.factor) - 1.
+        self.nobs, self.weight = _weights(s.values, self.factor)
+        self.mean = s.ewm(com=com).mean().iloc[-1] if len(s) else np.nan
+        return s.ewm(com=com, min_periods=self.min_periods).mean().values
+
+    def update(self, values):
+        """
+        Extend the state with new values
+        :return: np.ndarray of the means for the new values
+        """
+        out = np.empty(len(values))
+        for i, x in enumerate(values):
+            obs = x == x
+            self.nobs += obs
+            if self.mean == self.mean:
+                self.weight *= self.factor
+                if obs:
+                    if self.mean != x:
+                        self.mean = (self.weight * self.mean + x) / (self.weight + 1.)
+                    self.weight += 1.
+            elif obs:
+                self.mean = x
+            out[i] = self.mean if self.nobs >= self.min_periods else np.nan
+        return out
+
+
+class EWMStd(object):
+    """
+    Streaming version of pd.Series.ewm(com=com, min_periods=min_periods).std()
+    """
+    def __init__(self, com, min_periods=0):
+        self.factor = 1. - 1. / (1. + com)
+        self.min_periods = max(int(min_periods), 1)
+        self.mean = np.nan
+        self.var = 0.
+        self.weight = 1.
+        self.weight2 = 1.
+        self.nobs = 0
+
+    @classmethod
+    def span(cls, span, min_periods=0):
+        return cls((span - 1) / 2., min_periods)
+
+    def start(self, values):
+        """
+        Initialise the state from the whole history
+        :return: np.ndarray, the result of pandas for the history
+        """
+        s = pd.Series(values, dtype='float64')
+        com = 1. / (1. - self.factor) - 1.
+        self.nobs, self.weight = _weights(s.values, self.factor)
+        self.weight2 = _weights(s.values, self.factor ** 2)[1]
+        if self.nobs:
+            self.mean = s.ewm(com=com).mean().iloc[-1]
+            self.var = s.ewm(com=com).var(bias=True).iloc[-1]
+        return s.ewm(com=com, min_periods=self.min_periods).std().values
+
+    def update(self, values):
+        """
+        Extend the state with new values
+        :return: np.ndarray of the standard deviations for the new values
+        """
+        out = np.empty(len(values))
+        for i, x in enumerate(values):
+            obs = x == x
+            self.nobs += obs
+            if self.mean == self.mean:
+                self.weight *= self.factor
+                self.weight2 *= self.factor ** 2
+                if obs:
+                    old_mean = self.mean
+                    if self.mean != x:
+                        self.mean = (self.weight * old_mean + x) / (self.weight + 1.)
+                    self.var = (self.weight * (self.var + (old_mean - self.mean) ** 2) +
+                                (x - self.mean) ** 2) / (self.weight + 1.)
+                    self.weight += 1.
+                    self.weight2 += 1.
+            elif obs:
+                self.mean = x
+            out[i] = np.nan
+            if self.nobs >= self.min_periods:
+                denominator = self.weight ** 2 - self.weight2
+                if denominator > 0:
+                    out[i] = np.sqrt(max(self.weight ** 2 / denominator * self.var, 0))
+        return out
+
+
+def _weights(values, factor):
+    """
+    Number of observations and the sum of their weights at the end of the values, as accumulated
+    by the pandas' ewm() loop: each observation gets weight 1 and every step decays the weights
+    """
+    obs = np.flatnonzero(~np.isnan(values))
+    return len(obs), float(np.sum(factor ** (len(values) - 1 - obs))) if len(obs) else 1.
+
+
+def _scaled(raw, scalar):
+    """Apply a normalisation scalar, like core.utility.norm_forecast()"""
+    return (raw * 10 / scalar).clip(-20, 20)
+
+
+def _forecast_scalar(raw, inst, name=None):
+    """Normalisation scalar of core.utility.norm_forecast()"""
+    return normalization.scalar(raw, 'abs_mean', inst.name, name=name)
+
+
+### Rules
+
+class RuleState(abc.ABC):
+    """
+    Incremental state of a trading rule. build() calculates the whole forecast and initialises
+    the state, update() calculates the rows for the new panama prices.
+    Both return the forecast as pd.Series or pd.DataFrame (see trading.rules). update() may return
+    some rows before the new dates, when they are revised by the new data.
+    """
+    @abc.abstractmethod
+    def build(self, inst, panama, scalars=None):
+        """
+        :param panama: panama prices of the instrument
+        :param scalars: normalisation scalars to reuse, estimated if None
+        """
+
+    @abc.abstractmethod
+    def update(self, inst, panama, new):
+        """
+        :param panama: panama prices before the update
+        :param new: the new panama prices
+        """
+
+
+class EWMACState(RuleState):
+    """trading.rules.ewmac() and trading.rules.mr() (with reverse=True)"""
+    def __init__(self, spans=(8, 16, 32, 64), prefix='ewmac', reverse=False):
+        self.spans = spans
+        self.prefix = prefix
+        self.reverse = reverse
+
+    def build(self, inst, panama, scalars=None):
+        # norm_vol() scalar and the forecast scalar(s)
+        self.scalars = scalars or {'vol': normalization.scalar(panama, 'std', inst.name, name='vol')}
+        d = (panama * 10 / self.scalars['vol']).values
+        self.ewm = {x: (EWMMean.span(x, x * 4), EWMMean.span(x * 4, x * 4)) for x in self.spans}
+        raw = self._frame({x: fast.start(d) - slow.start(d)
+                           for x, (fast, slow) in self.ewm.items()}, panama.index)
+        if 'forecast' not in self.scalars:
+            self.scalars['forecast'] = raw.abs().mean() if self.reverse else \
+                _forecast_scalar(raw, inst)
+        return _scaled(raw, self.scalars['forecast'])
+
+    def update(self, inst, panama, new):
+        d = (new * 10 / self.scalars['vol']).values
+        raw = self._frame({x: fast.update(d) - slow.update(d)
+                           for x, (fast, slow) in self.ewm.items()}, new.index)
+        return _scaled(raw, self.scalars['forecast'])
+
+    def _frame(self, columns, index):
+        raw = pd.DataFrame({'%s%d' % (self.prefix, x): v for x, v in columns.items()},
+                           index=index)
+        return raw * -1 if self.reverse else raw
+
+
+class BreakoutState(RuleState):
+    """trading.rules.breakout()"""
+    def __init__(self, lookbacks=None):
+        self.lookbacks = tuple(lookbacks or trading.rules.breakout_lookbacks)
+
+    def build(self, inst, panama, scalars=None):
+        self.extrema = RollingExtrema(self.lookbacks, [np.ceil(x / 2.0) for x in self.lookbacks])
+        self.ewm = {x: EWMMean.span(self._smooth(x), np.ceil(self._smooth(x) / 2.0))
+                    for x in self.lookbacks}
+        raw = self._raw(panama, start=True)
+        self.scalars = scalars or {'forecast': _forecast_scalar(raw, inst)}
+        return _scaled(raw, self.scalars['forecast'])
+
+    def update(self, inst, panama, new):
+        return _scaled(self._raw(new), self.scalars['forecast'])
+
+    def _raw(self, prices, start=False):
+        values = prices.values.astype('float64')
+        lows, highs = self.extrema.start(values) if start else self.extrema.update(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            b = (values[:, None] - (highs + lows) / 2.0) / (highs - lows)
+        columns = {}
+        for j, x in enumerate(self.lookbacks):
+            columns['brk%d' % x] = self.ewm[x].start(b[:, j]) if start else self.ewm[x].update(b[:, j])
+        return pd.DataFrame(columns, index=prices.index)
+
+    @staticmethod
+    def _smooth(lookback):
+        return max(int(lookback / 4.0), 1)
+
+
+class CarryNextState(RuleState):
+    """
+    trading.rules.carry_next() and trading.rules.carry_prev() (with reverse=True).
+    The smoothing after the normalisation (ffill, interpolate and a 90 days mean) is recalculated
+    from the last valid value before the new data, the rows after it may be revised.
+    """
+    def __init__(self, name='carry_next', reverse=False):
+        self.name = name
+        self.reverse = reverse
+
+    def build(self, inst, panama, scalars=None):
+        raw = self._raw(inst)
+        self.scalars = scalars or {
+            'forecast': _forecast_scalar(raw, inst, 'carry' if self.reverse else 'carry_next')}
+        self.normed = _scaled(raw, self.scalars['forecast'])
+        self.filled = self.normed.ffill(limit=3).interpolate()
+        return self.filled.rolling(window=90).mean().rename(self.name)
+
+    def update(self, inst, panama, new):
+        last = self.normed.index[-1] if len(self.normed) else None
+        raw = self._raw(inst)
+        if last is not None:
+            raw = raw[raw.index > last]
+        self.normed = pd.concat([self.normed, _scaled(raw, self.scalars['forecast'])])
+        # the new values only change the rows after the last valid value
+        valid = np.flatnonzero(self.normed.iloc[:len(self.normed) - len(raw)].notnull().values)
+        start = valid[-1] if len(valid) else 0
+        filled = self.normed.iloc[start:].ffill(limit=3).interpolate()
+        self.filled = pd.concat([self.filled.iloc[:start], filled])
+        head = self.filled.iloc[max(start - 89, 0):]
+        return head.rolling(window=90).mean().iloc[start - max(start - 89, 0):].rename(self.name)
+
+    def _raw(self, inst):
+        """The carry before the normalisation over the loaded prices, see trading.rules._carry_raw()"""
+        current, other = trading.rules._carry_prices(inst, reverse=self.reverse)
+        return trading.rules._carry_raw(current, other, reverse=self.reverse)
+
+
+class CarrySpotState(RuleState):
+    """trading.rules.carry_spot()"""
+    def __init__(self, name='carry_spot'):
+        self.name = name
+
+    def build(self, inst, panama, scalars=None):
+        self.last = None
+        self.ewm = EWMMean(90)
+        f = self._raw(inst, end=panama.index[-1])
+        raw = pd.Series(self.ewm.start(f.values), index=f.index)
+        self.scalars = scalars or {'forecast': _forecast_scalar(raw, inst, 'carry_spot')}
+        return _scaled(raw, self.scalars['forecast']).rename(self.name)
+
+    def update(self, inst, panama, new):
+        f = self._raw(inst, start=self.last, end=new.index[-1])
+        raw = pd.Series(self.ewm.update(f.values), index=f.index)
+        return _scaled(raw, self.scalars['forecast']).rename(self.name)
+
+    def _raw(self, inst, start=None, end=None):
+        """
+        Spot premium of the held contract per year, for the dates after start until end. The
+        dates after the last price are left for the next update, as they may still get prices.
+        """
+        market_price = inst.market_price().reset_index('contract', drop=True)
+        f = ((inst.spot() - market_price) * 365 / inst.time_to_expiry())[:end]
+        if start is not None:
+            f = f[f.index > start]
+        if len(f):
+            self.last = f.index[-1]
+        return f
+
+
+class ConstantState(RuleState):
+    """trading.rules.buy_and_hold() and trading.rules.sell_and_hold()"""
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def build(self, inst, panama, scalars=None):
+        self.scalars = {}
+        return pd.Series(self.value, index=panama.index).rename(self.name)
+
+    def update(self, inst, panama, new):
+        return pd.Series(self.value, index=new.index).rename(self.name)
+
+
+class WeatherState(RuleState):
+    """trading.rules.weather_rule()"""
+    def build(self, inst, panama, scalars=None):
+        self.scalars = {}
+        return self._sign(panama.diff())
+
+    def update(self, inst, panama, new):
+        return self._sign(pd.concat([panama.iloc[-1:], new]).diff().iloc[1:])
+
+    @staticmethod
+    def _sign(r):
+        r = r.copy()
+        r[r == 0] = np.nan
+        return (np.sign(r) * 10).rename('weather_rule')
+
+
+# Incremental implementations of the rules in trading.rules, by the rule name
+rule_states = {
+    'ewmac': lambda inst: EWMACState(),
+    'mr': lambda inst: EWMACState(spans=(2, 4, 8, 16, 32, 64), prefix='mr', reverse=True),
+    'breakout': lambda inst: BreakoutState(),
+    'carry': lambda inst: CarrySpotState('carry') if hasattr(inst, 'spot') else
+    CarryNextState('carry'),
+    'carry_next': lambda inst: CarryNextState('carry_next'),
+    'carry_prev': lambda inst: CarryNextState('carry', reverse=True),
+    'carry_spot': lambda inst: CarrySpotState('carry_spot'),
+    'weather_rule': lambda inst: WeatherState(),
+    'buy_and_hold': lambda inst: ConstantState('buy_and_hold', 10),
+    'sell_and_hold': lambda inst: ConstantState('sell_and_hold', -10),
+}
+
+
+### Instrument state
+
+class InstrumentState(object):
+    """
+    Computed series of an instrument with the state to extend them
+    """
+    def __init__(self, inst):
+        unsupported = [r for r in inst.rules if str(r) not in rule_states]
+        if unsupported:
+            raise ValueError('Rules %s have no incremental implementation' % unsupported)
+        self.name = inst.name
+        self.rules = tuple(str(r) for r in inst.rules)
+        self.scalars_version = normalization.version()
+        self.config = _config(inst)
+        self.fingerprint = None
+        self.layout = layout
+
+    def build(self, inst, scalars=None):
+        """
+        Calculate everything from the whole history
+        :param scalars: normalisation scalars to use instead of estimating them
+        """
+        scalars = scalars or {}
+        self.panama = inst.panama_prices()
+        self.market = inst.market_price()
+        self.vol = EWMStd.span(36, 36)
+        self.vol_points = pd.Series(self.vol.start((self.panama * inst.point_value).diff().values),
+                                    index=self.panama.index)
+        self.states = {r: rule_states[r](inst) for r in self.rules}
+        self.outputs = {r: s.build(inst, self.panama, scalars.get(r))
+                        for r, s in self.states.items()}
+        self.scalars = {r: s.scalars for r, s in self.states.items()}
+        self.scalars['weighted'] = scalars.get('weighted') or \
+            _forecast_scalar(self._weighted_raw(inst), inst, name='weighted')
+        return self
+
+    def update(self, inst):
+        """
+        Extend the series with the new prices
+        :return: number of new rows
+        """
+        last = self.panama.index[-1]
+        start = last - pd.Timedelta(days=window_days)
+        if inst.prices_from is not None:
+            start = max(start, inst.prices_from)
+        # the copy of the instrument only loads the window from the storage
+        inst = inst.trailing(start=start)
+        close = inst.contracts()['close']
+        stitched = panama_stitch(close, inst.roll_progression())
+        if last not in stitched.index:
+            raise ValueError('No price of %s at %s' % (self.name, last))
+        new = stitched[stitched.index > last] - stitched[last] + self.panama.iloc[-1]
+        market = inst.market_price()
+        if len(self.market):
+            market = market[market.index.get_level_values('date') >
+                            self.market.index.get_level_values('date')[-1]]
+        self.market = pd.concat([self.market, market])
+        if new.empty:
+            return 0
+        new = new.rename(self.panama.name)
+        diff = (pd.concat([self.panama.iloc[-1:], new]) * inst.point_value).diff().iloc[1:]
+        self.vol_points = pd.concat([self.vol_points,
+                                     pd.Series(self.vol.update(diff.values), index=new.index)])
+        for r, s in self.states.items():
+            rows = s.update(inst, self.panama, new)
+            old = self.outputs[r]
+            self.outputs[r] = pd.concat([old[old.index < rows.index[0]], rows]) \
+                if len(rows) else old
+        self.panama = pd.concat([self.panama, new])
+        return len(new)
+
+    def return_volatility(self, inst, **kw):
+        """Same as Instrument.return_volatility()"""
+        return self.vol_points * inst.currency.rate(**kw)
+
+    def forecasts(self):
+        """Same as Instrument.forecasts()"""
+        return pd.concat([self.outputs[r] for r in self.rules], axis=1).dropna()
+
+    def weighted_forecast(self, inst):
+        """Same as Instrument.weighted_forecast(), with the frozen normalisation scalar"""
+        return _scaled(self._weighted_raw(inst), self.scalars['weighted']).clip(-20, 20)
+
+    def position(self, inst, capital=config.strategy.capital, nofx=False):
+        """Same as Instrument.position()"""
+        forecasts = self.weighted_forecast(inst)
+        position = (forecasts * (config.strategy.daily_volatility_target * capital / 10))\
+            .divide(self.return_volatility(inst, nofx=nofx)[forecasts.index], axis=0)
+        return np.around(position)
+
+    def _weighted_raw(self, inst):
+        return (self.forecasts() * inst.weights).mean(axis=1)
+
+
+def _config(inst):
+    """The configuration of an instrument the state depends on, see Instrument.to_spec()"""
+    spec = inst.to_spec()
+    spec.pop('incremental', None)
+    return spec
+
+
+def fname(inst):
+    """Resolve the state file name for an instrument"""
+    return os.path.join(cache_path, 'incremental', inst.name + '.pkl')
+
+
+def load(inst):
+    """
+    Load the persisted state of an instrument
+    :return: InstrumentState, or None if there is no state for the instrument's current rules
+             and frozen scalars
+    """
+    try:
+        with open(fname(inst), 'rb') as f:
+            state = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError):
+        return None
+    if state.rules != tuple(str(r) for r in inst.rules) or \
+            getattr(state, 'scalars_version', None) != normalization.version() or \
+            getattr(state, 'config', None) != _config(inst) or \
+            getattr(state, 'layout', None) != layout:
+        return None
+    return state
+
+
+def save(state):
+    f = os.path.join(cache_path, 'incremental', state.name + '.pkl')
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+    with atomic_write(f) as tmp:
+        with open(tmp, 'wb') as out:
+            pickle.dump(state, out, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def update(inst, rebuild=False):
+    """
+    Bring the persisted state of an instrument up to date: extend it with the new prices, or
+    calculate it from the whole history if there is no state yet, or if rebuild
+    :return: InstrumentState
+    """
+    f = fname(inst)
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+    with file_lock(f):
+        state = None if rebuild else load(inst)
+        if state is not None and state.fingerprint != fingerprint(inst, state.panama.index[-1]):
+            logger.warning('%s: the stored quotes have been revised, recalculating the state' %
+                           inst.name)
+            state = None
+        if state is not None:
+            try:
+                n = state.update(inst)
+                logger.debug('%s: %d new rows' % (inst.name, n))
+            except ValueError as e:
+                logger.warning('%s, recalculating the state' % e)
+                state = None
+        if state is None:
+            state = InstrumentState(inst).build(inst)
+        state.fingerprint = fingerprint(inst, state.panama.index[-1])
+        save(state)
+    return state
+
+
+def fingerprint(inst, last):
+    """
+    Checksums of the stored quotes of an instrument up to the date last, by contract. The
+    checksums of the contracts without newer quotes are taken from the storage catalog, only
+    the contracts which are still trading are read.
+    :return: dict {(provider, symbol, contract): checksum}
+    """
+    result = {}
+    for store in data_feed.instrument_stores(inst):
+        c = store.catalog()
+        c = c[c['first_date'] <= last]
+        checksums = c['checksum'].to_dict()
+        spanning = list(c.index[c['last_date'] > last])
+        if spanning:
+            futures = store.quotes_type == QuotesType.futures
+            checksums.update(catalog.checksums(
+                store.get(contracts=spanning if futures else None, end=last)))
+        result.update({(store.provider, store.symbol, k): v for k, v in checksums.items()})
+    return result
+
+
+def check(inst, state, tolerance=1e-8):
+    """
+    Compare the incrementally extended series with a full recalculation with the same
+    normalisation scalars
+    :return: pd.Series of the max. absolute differences by series name, NaN where the rows differ
+    """
+    full = InstrumentState(inst).build(inst, scalars=state.scalars)
+    pairs = {'panama_prices': (state.panama, full.panama),
+             'market_price': (state.market, full.market),
+             'return_volatility': (state.vol_points, full.vol_points),
+             'weighted_forecast': (state.weighted_forecast(inst), full.weighted_forecast(inst))}
+    pairs.update({r: (state.outputs[r], full.outputs[r]) for r in state.rules})
+    diff = {}
+    for name, (a, b) in pairs.items():
+        if not a.index.equals(b.index):
+            diff[name] = np.nan
+            continue
+        d = (pd.DataFrame(a) - pd.DataFrame(b)).abs()
+        # positions where one of the values is missing count as infinite differences
+        d[pd.DataFrame(a).isnull() != pd.DataFrame(b).isnull()] = np.inf
+        diff[name] = d.fillna(0).max().max() if len(d) else 0.
+    diff = pd.Series(diff)
+    if not (diff <= tolerance).all():
+        logger.warning('Incremental state of %s differs from the full calculation:\n%s' %
+                       (inst.name, diff[~(diff <= tolerance)]))
+    return diff
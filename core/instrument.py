@@ -1,6 +1,5 @@
+import copy
 import datetime
-from collections import deque
-from functools import lru_cache
 import sys
 try:
     import config.strategy
@@ -17,10 +16,18 @@ import config.instruments
 import config.settings
 import trading.rules
 from core import data_feed
+from core.memo import memoize
+from core.pricematrix import PriceMatrix
+import core.memo
+import core.incremental
+import core.normalization as normalization
 from core.logger import get_logger
-from core.utility import contract_to_tuple, cbot_month_code, generate_roll_progression, weight_forecast
+from core.utility import contract_to_tuple, cbot_month_code, generate_roll_progression, weight_forecast, \
+    panama_stitch, active_quotes
 
 logger = get_logger('instrument')
+# Days of prices loaded for the quick validation, enough for the warm-up of the rules
+validation_days = getattr(config.strategy, 'validation_days', 730)
 
 
 class Instrument(object):
@@ -43,6 +50,27 @@ class Instrument(object):
             j = {v['name']: v for v in config.instruments.instrument_definitions}
             return {k: Instrument(**j[k]) for k in instruments}
 
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Recreates an instrument from Instrument.to_spec(). The attributes missing in the spec are
+        taken from the instrument definition in config/instruments.py.
+        """
+        definitions = {v['name']: v for v in config.instruments.instrument_definitions}
+        kw = dict(definitions.get(spec['name'], {}))
+        kw.update(spec)
+        return cls(**kw)
+
+    def to_spec(self):
+        """
+        Returns the configuration of the instrument as a dict of plain values, which is sent to
+        worker processes instead of the object (see core.ipc). The other attributes, e.g. the
+        currency or the spot price function, are recreated by Instrument.from_spec().
+        """
+        spec = {k: v for k, v in vars(self).items() if _plain(v)}
+        spec['weights'] = self.weights.to_dict()
+        return spec
+
     def __repr__(self):
         return self.name
 
@@ -66,6 +94,8 @@ class Instrument(object):
         self.bootstrapped_weights = None            # Only used to store results of bootstrapping. Not used for trading.
         self.first_contract = None
         self.contract_data = ['ib', 'quandl']
+        self.incremental = False                    # Extend the persisted results in calculate(), see core.incremental
+        self.prices_from = None                     # Only load prices from this date, see Instrument.trailing()
 
         # assign properties from instrument definition
         for key, value in kwargs.items():
@@ -73,7 +103,7 @@ class Instrument(object):
             setattr(self, key, value)
 
         self.weights = pd.DataFrame.from_dict(self.weights, orient='index').transpose().loc[0]
-        self.currency = Currency(self.denomination + config.settings.base_currency)
+        self.currency = Currency.get(self.denomination + config.settings.base_currency)
 
     def calculate(self):
         """
@@ -82,27 +112,77 @@ class Instrument(object):
         Called from Portfolio using multiprocessing to speed things up.
         
         Returns a dict with the important things we need in to trade with.
+
+        If self.incremental, the panama prices and the position are extended from the persisted
+        state of the last call instead of being recalculated from the whole history.
         """
-        if self.currency.rate() is 1:
-            rate = pd.Series(1, index=self.panama_prices().index)
-        else:
-            rate = self.currency.rate()
+        state = None
+        if self.incremental:
+            try:
+                state = self.incremental_state()
+            except ValueError as e:
+                logger.warning("Incremental update of %s failed: %s" % (self.name, str(e)))
+        panama_prices = self.panama_prices() if state is None else state.panama
+        rate = self.currency.rate()
+        if not isinstance(rate, pd.Series):
+            rate = pd.Series(rate, index=panama_prices.index)
         return {
-            'panama_prices': self.panama_prices(),
+            'panama_prices': panama_prices,
+            # the roll calendar doesn't depend on the prices, see generate_roll_progression()
             'roll_progression': self.roll_progression(),
-            'market_price': self.market_price(),
-            'position': self.position(),
+            'market_price': self.market_price() if state is None else state.market,
+            'position': self.position() if state is None else state.position(self),
             'rate': rate,
             }
 
-    def latest_price_date(self):
-        """Gets the date of the latest price we've got, to help us calculate how old our data is."""
-        current_contract = self.roll_progression().loc[datetime.date.today()]
-        latest_price = self.contracts().loc[current_contract].tail(1)
-        return latest_price.index[0] # latest price date
+    def incremental_state(self, rebuild=False):
+        """
+        Extends the persisted results of this instrument with the new prices
+        :param rebuild: recalculate the results from the whole history
+        :return: core.incremental.InstrumentState
+        """
+        return core.incremental.update(self, rebuild=rebuild)
 
-    def validate(self):
-        """Validates that the instrument has up-to-date data and sane results."""
+    def check_incremental(self, tolerance=1e-8):
+        """
+        Compares the persisted results with a full recalculation
+        :return: Series of the max. absolute differences by result name
+        """
+        state = core.incremental.load(self)
+        if state is None:
+            raise ValueError('No incremental state for %s' % self.name)
+        return core.incremental.check(self, state, tolerance=tolerance)
+
+    def latest_price_date(self):
+        """Gets the date of the latest price we've got, to help us calculate how old our data is.
+        Read from the storage catalog, the price data isn't loaded. The dates without trading
+        activity are skipped, like in the contract prices (see core.utility.active_quotes())."""
+        current_contract = self.roll_progression().loc[pd.to_datetime(datetime.date.today())]
+        catalog = data_feed.get_catalog(self)
+        if catalog is None:
+            raise KeyError(current_contract)
+        date = catalog.xs(current_contract, level='contract')['last_active'].max()
+        if pd.isnull(date):
+            raise KeyError(current_contract)
+        return date
+
+    def trailing(self, days=None, start=None):
+        """
+        Returns a copy of the instrument which only loads the prices of the last days, for quick
+        checks of the latest results. The forecasts are normalised over the window only.
+        :param days: number of calendar days, config.strategy.validation_days if None
+        :param start: first date to load instead of the number of days
+        """
+        inst = copy.copy(self)
+        inst.prices_from = pd.Timestamp(start) if start is not None else \
+            pd.to_datetime(datetime.date.today()) - \
+            pd.Timedelta(days=validation_days if days is None else days)
+        return inst
+
+    def validate(self, fast=False):
+        """Validates that the instrument has up-to-date data and sane results.
+        If fast, the results are calculated from the last config.strategy.validation_days only."""
+        inst = self.trailing() if fast else self
         d = {
             'is_valid': True,
             'today': pd.to_datetime(datetime.date.today()),
@@ -125,18 +205,18 @@ class Instrument(object):
 
             # Check carry is not zero
             try:
-                d['carry_forecast'] = self.forecasts()['carry'].tail(1)[0]
+                d['carry_forecast'] = inst.forecasts()['carry'].iloc[-1]
             except KeyError:
                 pass
 
-            d['weighted_forecast'] = self.weighted_forecast().tail(1)[0]
+            d['weighted_forecast'] = inst.weighted_forecast().iloc[-1]
 
             # Check panama_price data is not cached
-            d['panama_date'] = self.panama_prices().tail(1).index[0]
+            d['panama_date'] = inst.panama_prices().tail(1).index[0]
 
             # Check volatility is not zero
             try:
-                d['vol'] = self.return_volatility().loc[lpd]
+                d['vol'] = inst.return_volatility().loc[lpd]
             except KeyError:
                 logger.warning("Validation for instrument %s failed: no volatility data" % self.name)
                 d['is_valid'] = False
@@ -165,18 +245,16 @@ class Instrument(object):
         """
         return self.roll_progression(**kw)
 
-    @lru_cache(maxsize=1)
+    @memoize
     def panama_prices(self):
         """
         Returns a Series representing a 'continuous future' time series.
         Our system uses the simplest method - 'panama stitching'. 
         Absolute prices won't make any sense, but daily returns and trends are preserved. Perfectly suitable for our purposes.
         """
-        return self.contracts()['close'].diff().to_frame().swaplevel().fillna(0).join(
-            self.rp().to_frame().set_index('contract',append=True), how='inner').\
-            reset_index('contract',drop=True)['close'].cumsum().rename(self.name)
+        return panama_stitch(self.contracts()['close'], self.rp()).rename(self.name)
 
-    @lru_cache(maxsize=2)
+    @memoize
     def return_volatility(self, **kw):
         """
         Returns a Series with the EWA volatility of returns for this instrument.
@@ -184,12 +262,18 @@ class Instrument(object):
         return (self.panama_prices() * self.point_value).\
                diff().ewm(span=36, min_periods=36).std() * self.currency.rate(**kw)
 
-    def market_price(self):
+    def market_price(self, active_only=True):
         """
         Returns a series of real market prices for this contract.
         """
-        return self.roll_progression().to_frame().set_index('contract', append=True).\
-               swaplevel().join(self.contracts())['close'].swaplevel().dropna()
+        m = self.price_matrix()
+        rp = self.roll_progression()
+        rows, cols = m.row_index(rp.index), m.column_index(rp.values)
+        found = m.exists(rows, cols, active_only=active_only)
+        index = pd.MultiIndex.from_arrays([rp.index[found], rp.values[found]],
+                                          names=['date', 'contract'])
+        return pd.Series(m.take('close', rows[found], cols[found], active_only=active_only),
+                         index=index, name='close').dropna()
 
 ### Forecast & Position
 
@@ -203,22 +287,36 @@ class Instrument(object):
             .divide(self.return_volatility(nofx=nofx)[forecasts.index], axis=0)
         return np.around(position)
 
-    @lru_cache(maxsize=8)
+    @memoize
     def forecasts(self, rules=None):
         """
-        Position forecasts for individual trading rules
+        Position forecasts for individual trading rules, evaluated with shared intermediate results
+        (see trading.rules.evaluate())
         """
         if rules is None:
             rules = self.rules
-        return pd.concat(list(map(lambda x: getattr(trading.rules, str(x))(self), rules)), axis=1).dropna()
+        return pd.concat(trading.rules.evaluate(self, rules), axis=1).dropna()
 
     def weighted_forecast(self, rules=None):
         """
         Returns a Series representing the weighted forecast for this instrument.
         """
-        return weight_forecast(self.forecasts(rules=rules), self.weights)
+        return weight_forecast(self.forecasts(rules=rules), self.weights, self.name)
+
+    def forecast_scalars(self, estimator=None):
+        """
+        Estimates the normalisation scalars of all forecast columns, the weighted forecast and the
+        price volatility from the whole history, for the frozen scalars file (see scalars.py).
+        :param estimator: normalisation estimator, see core.normalization.record()
+        :return: dict {forecast column: scalar}
+        """
+        # a fresh copy, the memoized forecasts may use the frozen scalars
+        inst = Instrument.from_spec(self.to_spec())
+        with normalization.record(estimator) as scalars:
+            inst.weighted_forecast()
+        return scalars.get(self.name, {})
 
-    @lru_cache(maxsize=8)
+    @memoize
     def forecast_returns(self, **kw):
         """
         Estimated returns for individual trading rules
@@ -229,7 +327,7 @@ class Instrument(object):
                                  panama_prices = self.panama_prices()))
         return curves.apply(lambda x: x.returns()[self.name]).transpose()
 
-    @lru_cache(maxsize=8)
+    @memoize
     def contract_format(self, contract):
         """
         Convert the contract label to the broker's format
@@ -237,23 +335,37 @@ class Instrument(object):
         year, month = contract_to_tuple(contract)
         return self.quandl_symbol + cbot_month_code(month) + str(year)
 
-    @lru_cache(maxsize=8)
     def next_contract(self, contract, months=None, reverse=False):
         """
         Given a contract, return the next contract in the sequence.
         """
-        if months == None:
+        return int(self.next_contracts([contract], months=months, reverse=reverse)[0])
+
+    def next_contracts(self, contracts, months=None, reverse=False):
+        """
+        Array version of next_contract(): maps every contract label of an array to the next
+        (or the previous if reverse) contract in the sequence of months with a lookup table.
+        :param contracts: array-like of contract labels (YYYYMM)
+        :param months: sequence of traded months, self.months_traded if None
+        :return: np.ndarray of contract labels
+        """
+        if months is None:
             months = self.months_traded
-        rot = 1 if reverse else -1
-        m_idx = 0 if reverse else -1
-        d = pd.to_datetime(str(contract), format='%Y%m')
-        months_traded = deque(months)
-        months_traded.rotate(rot)
-        output_month = months_traded[months.index(d.month)]
-        output_year = d.year + (d.month == months[m_idx]) * (-rot)
-        return int(str(output_year) + str("%02d" % (output_month,)))
-
-    @lru_cache(maxsize=8)
+        months = np.asarray(months)
+        contracts = np.asarray(contracts, dtype='int64')
+        # position of each month in the sequence by the last two digits of the label, -1 for the
+        # months not traded
+        position = np.full(100, -1)
+        position[months] = np.arange(len(months))
+        year, month = np.divmod(contracts, 100)
+        i = position[month]
+        if (i < 0).any():
+            raise ValueError('Contract months %s are not in %s' %
+                             (np.unique(month[i < 0]).tolist(), months.tolist()))
+        i = i + (-1 if reverse else 1)
+        return (year + i // len(months)) * 100 + months[i % len(months)]
+
+    @memoize
     def contracts(self, **kw_in):
         """
         Returns the filtered contract data.
@@ -262,39 +374,85 @@ class Instrument(object):
         active_only = True  # Only returns days with actual trading volume
         trade_only = True   # Only return contracts we have defined as 'trade_only' in instruments.py
         recent_only = False # Only return contracts from the last 3 years until today.
+        start = None        # Only return prices from this date (the load starts at self.prices_from if set)
+        end = None          # Only return prices until this date
+        columns = ('close', 'open', 'volume')   # Price columns to load, None for all of them
         
         """
-        kw = dict(active_only=True, trade_only=True, recent_only=False)
+        kw = dict(active_only=True, trade_only=True, recent_only=False, start=None, end=None,
+                  columns=('close', 'open', 'volume'))
         kw.update(kw_in)
 
-        data = data_feed.get_instrument(self)
-
-        if data is not None:
-            year = data.index.to_frame()['contract'] // 100
-            if self.backtest_from_contract:
-                data = data.loc[self.backtest_from_contract:]
-            if self.backtest_from_year:
-                data = data[year >= self.backtest_from_year]
-            if kw['recent_only']:
-                data = data[year > datetime.datetime.now().year-3]
-            if kw['trade_only']:
-                month = data.index.to_frame()['contract'] % 100
-                data = data[month.isin(self.trade_only)]
-            if kw['active_only']:
-                data = data[(data['open'] > 0) & (data['volume'] > 1)]
-        return data
+        # All the variants are masks over a single load, see Instrument.quotes()
+        quotes = self.quotes(None if kw['columns'] is None else
+                             tuple(dict.fromkeys(tuple(kw['columns']) + ('open', 'volume'))))
+        if quotes is None:
+            return None
+        data, a = quotes
+        mask = np.ones(len(data), dtype=bool)
+        if kw['recent_only']:
+            mask &= a['year'] >= datetime.datetime.now().year - 2
+        if kw['trade_only']:
+            traded = np.zeros(100, dtype=bool)
+            traded[list(self.trade_only)] = True
+            mask &= traded[a['month']]
+        if kw['active_only']:
+            mask &= a['active']
+        if kw['start'] is not None:
+            mask &= a['date'] >= pd.Timestamp(kw['start']).as_unit('ns').value
+        if kw['end'] is not None:
+            mask &= a['date'] <= pd.Timestamp(kw['end']).as_unit('ns').value
+        if kw['columns'] is not None:
+            data = data[list(kw['columns'])]
+        return data if mask.all() else data[mask]
+
+    @memoize
+    def quotes(self, columns=None):
+        """
+        Loads the quotes of the instrument once for all the variants of Instrument.contracts(),
+        with the arrays used to filter them.
+        The contract filters of the instrument definition and self.prices_from are pushed down to
+        the storage.
+        :param columns: tuple of price columns to load, None for all of them
+        :return: (pd.DataFrame, dict of np.ndarray 'year', 'month', 'date' (int64 ns), 'active'),
+                 or None if there is no data
+        """
+        first_contract = [0]
+        if self.backtest_from_contract:
+            first_contract.append(int(self.backtest_from_contract))
+        if self.backtest_from_year:
+            first_contract.append(self.backtest_from_year * 100)
+        data = data_feed.get_instrument(self, start=self.prices_from,
+                                        contracts=slice(max(first_contract) or None, None),
+                                        columns=None if columns is None else list(columns))
+        if data is None:
+            return None
+        contract = data.index.get_level_values('contract').values.astype('int64')
+        year, month = np.divmod(contract, 100)
+        date = data.index.get_level_values('date').as_unit('ns').asi8
+        active = active_quotes(data)
+        return data, {'year': year, 'month': month, 'date': date, 'active': active}
 
 ### Rolling
 
     def term_structure(self, date=None):
         if date is None:
             date = self.pp().tail(1).index[0]
-        return self.contracts(active_only=False).xs(date, level=1)
+        return self.price_matrix(columns=None).snapshot(date)
 
     def contract_volumes(self):
         return self.contracts(active_only=False).groupby(level=0)['volume'].mean().plot.bar()
 
-    @lru_cache(maxsize=1)
+    @memoize
+    def price_matrix(self, columns=('close', 'open', 'volume')):
+        """
+        Returns the quotes of the traded contracts as a core.pricematrix.PriceMatrix, the dense
+        date x contract arrays used to look up the prices of given contracts on given dates.
+        :param columns: tuple of price columns to load, None for all of them
+        """
+        return PriceMatrix(self.contracts(active_only=False, columns=columns))
+
+    @memoize
     def roll_progression(self):
         """
         Lists the contracts the system wants to be in depending on the date
@@ -326,9 +484,7 @@ class Instrument(object):
     def plot_contracts(self, start, finish, panama=True):
         """ Function to help visualise individual contract data and stitching. Not used for trading. """
         if panama is False:
-            self.roll_progression().to_frame().set_index('contract', append=True).swaplevel().\
-                join(self.contracts(active_only=False)).reset_index().\
-                pivot(index='date', columns='contract', values='close')[start:finish].\
+            self.market_price(active_only=False).unstack()[start:finish].\
                 dropna(how='all',axis=1).plot()
         else:
             df = self.panama_prices().to_frame()
@@ -353,11 +509,33 @@ class Instrument(object):
               self.forecasts(), result.mean())), panama_prices=self.panama_prices()))
         return result.mean()
 
+    def data_version(self):
+        """
+        Token identifying the state of the stored data this instrument depends on (including the
+        frozen normalisation scalars). The memoized methods drop their results when it changes,
+        see core.memo.
+        """
+        return data_feed.instrument_version(self), normalization.version()
+
+    def cache_info(self):
+        """
+        Hit and miss counts of the memoized methods
+        :return: dict {method name: core.memo.CacheInfo}
+        """
+        return core.memo.info(self)
+
     def cache_clear(self):
-        self.forecasts.cache_clear()
-        self.roll_progression.cache_clear()
-        self.panama_prices.cache_clear()
-        self.return_volatility.cache_clear()
-        self.forecast_returns.cache_clear()
-        self.contract_format.cache_clear()
-        self.next_contract.cache_clear()
+        """
+        Drop the memoized results. Not needed after new data is downloaded, the results are
+        dropped automatically when the data version changes.
+        """
+        core.memo.clear(self)
+
+
+def _plain(value):
+    """Check if the value is made of plain Python values only, see Instrument.to_spec()"""
+    if isinstance(value, (list, tuple)):
+        return all(_plain(v) for v in value)
+    elif isinstance(value, dict):
+        return all(_plain(k) and _plain(v) for k, v in value.items())
+    return value is None or isinstance(value, (str, int, float, datetime.date))
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+from multiprocessing_on_dill import Pool
+from contextlib import closing
+
+"""
+Transfer of instrument calculations to worker processes.
+
+Sending Instrument objects through the process pool dill-pickles everything attached to them: the
+lambdas of the instrument definitions, the Currency object and so on. Instead the workers get
+Instrument.to_spec(), a dict of the plain configuration values, and rehydrate the instrument
+from it (Instrument.from_spec()) with the price data read from the shared local storage.
+
+The results are sent back packed: pandas objects are converted to NumPy arrays with a compact
+description of their index, which pickle with much less overhead than the frames themselves.
+
+* map_instruments() and imap_instruments() call an Instrument method for a list of instruments
+* Instrument methods which take arguments have to get them as keywords
+"""
+
+
+class Packed(object):
+    """
+    Series or DataFrame as NumPy arrays, see pack()
+    """
+    __slots__ = ('kind', 'values', 'index', 'columns', 'name')
+
+    def __init__(self, kind, values, index, columns=None, name=None):
+        self.kind = kind
+        self.values = values
+        self.index = index
+        self.columns = columns
+        self.name = name
+
+    def __getstate__(self):
+        return (self.kind, self.values, self.index, self.columns, self.name)
+
+    def __setstate__(self, state):
+        self.kind, self.values, self.index, self.columns, self.name = state
+
+
+def pack(obj):
+    """
+    Convert the pandas objects in a result (also inside dicts, lists and tuples) to Packed
+    objects. Frames with mixed or extension dtypes are left as they are.
+    """
+    if isinstance(obj, pd.Series) and isinstance(obj.dtype, np.dtype):
+        return Packed('series', obj.to_numpy(), _pack_index(obj.index), name=obj.name)
+    elif isinstance(obj, pd.DataFrame) and obj.dtypes.nunique() <= 1 and \
+            all(isinstance(d, np.dtype) for d in obj.dtypes):
+        return Packed('frame', obj.to_numpy(), _pack_index(obj.index),
+                      columns=_pack_index(obj.columns))
+    elif isinstance(obj, dict):
+        return {k: pack(v) for k, v in obj.items()}
+    elif type(obj) in (list, tuple):
+        return type(obj)(pack(v) for v in obj)
+    return obj
+
+
+def unpack(obj):
+    """
+    Inverse of pack()
+    """
+    if isinstance(obj, Packed):
+        index = _unpack_index(obj.index)
+        if obj.kind == 'series':
+            return pd.Series(obj.values, index=index, name=obj.name)
+        return pd.DataFrame(obj.values, index=index, columns=_unpack_index(obj.columns))
+    elif isinstance(obj, dict):
+        return {k: unpack(v) for k, v in obj.items()}
+    elif type(obj) in (list, tuple):
+        return type(obj)(unpack(v) for v in obj)
+    return obj
+
+
+def map_instruments(instruments, method, multiproc=True, **kw):
+    """
+    Call a method of every instrument in worker processes
+    :param instruments: list of core.instrument.Instrument objects
+    :param method: name of the Instrument method
+    :param multiproc: use the process pool, otherwise the method is called on the objects
+    :param kw: keyword arguments of the method
+    :return: dict {instrument name: result}
+    """
+    return dict(imap_instruments(instruments, method, multiproc=multiproc, **kw))
+
+
+def imap_instruments(instruments, method, multiproc=True, **kw):
+    """
+    Same as map_instruments(), yields (instrument name, result) in the order of completion
+    """
+    instruments = list(instruments)
+    if not multiproc or len(instruments) < 2:
+        for i in instruments:
+            yield i.name, getattr(i, method)(**kw)
+        return
+    with closing(Pool()) as pool:
+        tasks = [(i.to_spec(), method, kw) for i in instruments]
+        for name, result in pool.imap_unordered(_call, tasks):
+            yield name, unpack(result)
+
+
+def _call(task):
+    """Worker: rehydrate the instrument from its spec and call the method"""
+    # imported here, core.instrument depends on the modules using this one
+    from core.instrument import Instrument
+    spec, method, kw = task
+    return spec['name'], pack(getattr(Instrument.from_spec(spec), method)(**kw))
+
+
+def _pack_index(index):
+    if isinstance(index, pd.MultiIndex):
+        return ('multi', [_pack_index(l) for l in index.levels],
+                [np.asarray(c) for c in index.codes], list(index.names))
+    elif isinstance(index, pd.RangeIndex):
+        return ('range', index.start, index.stop, index.step, index.name)
+    elif isinstance(index, pd.DatetimeIndex) and index.tz is None:
+        return ('datetime', index.asi8, str(index.dtype), index.name)
+    return ('array', np.asarray(index), index.name)
+
+
+def _unpack_index(packed):
+    kind = packed[0]
+    if kind == 'multi':
+        return pd.MultiIndex(levels=[_unpack_index(l) for l in packed[1]], codes=packed[2],
+                             names=packed[3], verify_integrity=False)
+    elif kind == 'range':
+        return pd.RangeIndex(packed[1], packed[2], packed[3], name=packed[4])
+    elif kind == 'datetime':
+        return pd.DatetimeIndex(packed[1].view(packed[2]), name=packed[3])
+    return pd.Index(packed[1], name=packed[2])
+
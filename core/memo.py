@@ -0,0 +1,85 @@
+import functools
+import threading
+import weakref
+from collections import namedtuple
+
+"""
+Per-instance memoization of methods which depend on the stored price data.
+
+* Results are cached separately for every object, keyed by the method and its arguments
+  (which have to be hashable, as with functools.lru_cache)
+* The object provides data_version(): a token which changes whenever the data its methods
+  depend on is written. All results of the object are dropped on the first call after it changes,
+  so there is no need to clear the caches manually after downloading.
+* The caches are held in a weak dictionary outside of the objects: they don't keep the objects
+  alive and are not pickled with them when the objects are sent to worker processes
+"""
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'currsize'])
+
+_caches = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+class _Cache(object):
+    def __init__(self, version):
+        self.version = version
+        self.results = {}
+        self.hits = {}
+        self.misses = {}
+
+
+def memoize(method):
+    """
+    Decorator caching the results of a method per instance, see the module description
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = _cache(self)
+        key = (name, args, tuple(sorted(kwargs.items())))
+        try:
+            result = cache.results[key]
+        except KeyError:
+            cache.misses[name] = cache.misses.get(name, 0) + 1
+            result = cache.results[key] = method(self, *args, **kwargs)
+        else:
+            cache.hits[name] = cache.hits.get(name, 0) + 1
+        return result
+    return wrapper
+
+
+def info(obj):
+    """
+    Cache statistics of an object since its cache was created or cleared
+    :return: dict {method name: CacheInfo(hits, misses, currsize)}
+    """
+    with _lock:
+        cache = _caches.get(obj)
+    if cache is None:
+        return {}
+    sizes = {}
+    for key in list(cache.results):
+        sizes[key[0]] = sizes.get(key[0], 0) + 1
+    names = set(cache.hits) | set(cache.misses)
+    return {n: CacheInfo(cache.hits.get(n, 0), cache.misses.get(n, 0), sizes.get(n, 0))
+            for n in sorted(names)}
+
+
+def clear(obj):
+    """Drop all cached results of an object"""
+    with _lock:
+        _caches.pop(obj, None)
+
+
+def _cache(obj):
+    """The cache of an object, emptied if its data version has changed"""
+    version = obj.data_version()
+    with _lock:
+        cache = _caches.get(obj)
+        if cache is None:
+            cache = _caches[obj] = _Cache(version)
+        elif cache.version != version:
+            cache.version = version
+            cache.results = {}
+    return cache
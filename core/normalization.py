@@ -0,0 +1,266 @@
+import datetime
+import json
+import os
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import config.settings
+from core.fileutil import atomic_write
+
+"""
+Estimators of the scalars used to normalise the forecasts (core.utility.norm_forecast()) and the
+price volatility (core.utility.norm_vol()).
+
+The scalar is a statistic of the whole series: the absolute mean for the forecasts, the standard
+deviation for the prices. For a DataFrame it is the mean of the column statistics over the rows
+without missing values. Estimators:
+
+* 'bootstrap' - mean of the statistic over 100 resamples of arch's StationaryBootstrap with the
+                expected block size of 50. Random, a different scalar on every call.
+* 'resample'  - the same stationary bootstrap with a fixed seed. All the resamples are drawn as a
+                single index matrix and the statistics are computed as matrix products of the
+                resample counts, so the scalar is reproducible and fast.
+* 'analytic'  - the statistic of the series itself, the expected value of the resampled
+                statistic for the circular stationary bootstrap
+* 'frozen'    - precomputed scalars by instrument and forecast column, loaded from
+                settings.scalars_path. The scalars missing in the file are estimated with the
+                fallback estimator.
+
+The estimator is chosen by settings.normalization ('frozen' by default, which is 'resample' until
+the scalars file is created).
+
+The scalars file is written by scalars.py. record() collects the scalars estimated while the
+forecasts are calculated, save() writes them with a version number incremented on every save:
+{"version": 3, "created": "2020-01-31T06:00:00", "estimator": "resample",
+ "scalars": {"corn": {"ewmac8": 1.9, "carry": 0.02, "vol": 210.5, "weighted": 7.8, ...}, ...}}
+The columns of a DataFrame (e.g. ewmac8..ewmac64) share one scalar, it is stored for every column.
+"""
+estimator = getattr(config.settings, 'normalization', 'frozen')
+scalars_path = getattr(config.settings, 'scalars_path',
+                       os.path.join(os.path.dirname(config.settings.hdf_path),
+                                    'forecast_scalars.json'))
+# Estimator for the scalars missing in the frozen scalars file
+fallback = 'resample'
+# Parameters of the stationary bootstrap
+block_size = 50
+repetitions = 100
+seed = 0
+
+_frozen = {'mtime': None, 'version': None, 'scalars': {}}
+# {instrument name: {forecast column: scalar}} collected inside record()
+_recorded = None
+# The resamples only depend on the length of the series with the fixed seed, the resample counts
+# are kept for the last lengths in the smallest integer dtype (uint8 in practice, 100 bytes per
+# row of the series)
+_counts = {}
+_counts_size = 16
+
+
+def scalar(data, statistic, instrument=None, name=None, method=None):
+    """
+    Estimate the normalisation scalar of the data
+    :param data: pd.Series or pd.DataFrame
+    :param statistic: 'abs_mean' or 'std'
+    :param instrument: instrument name, the key of the frozen scalars
+    :param name: name of the series in the frozen scalars, data.name by default (the columns of
+                 a DataFrame are looked up by their names)
+    :param method: estimator, settings.normalization if None
+    :return: float, or pd.Series by column for the frozen scalars of a DataFrame
+    """
+    method = method or estimator
+    if method == 'frozen':
+        result = frozen(data, instrument, name)
+        if result is not None:
+            return result
+        method = fallback
+    if len(data) == 0:
+        result = np.nan
+    elif method == 'bootstrap':
+        result = _bootstrap(data, statistic)
+    elif method == 'resample':
+        result = _resample(data, statistic)
+    elif method == 'analytic':
+        result = _analytic(data, statistic)
+    else:
+        raise ValueError('Unknown normalization estimator: %s' % method)
+    if _recorded is not None and instrument is not None:
+        names = data.columns if isinstance(data, pd.DataFrame) else \
+            [data.name if name is None else name]
+        _recorded.setdefault(str(instrument), {}).update(
+            {str(n): float(result) for n in names if n is not None})
+    return result
+
+
+@contextmanager
+def record(method=None):
+    """
+    Collect the scalars estimated in the block, e.g. by Instrument.weighted_forecast()
+    :param method: estimator used in the block, settings.normalization by default (the fallback
+                   estimator instead of 'frozen')
+    :return: dict {instrument name: {forecast column: scalar}}
+    """
+    global estimator, _recorded
+    saved = estimator, _recorded
+    estimator = method or (fallback if estimator == 'frozen' else estimator)
+    _recorded = {}
+    try:
+        yield _recorded
+    finally:
+        estimator, _recorded = saved
+
+
+def save(scalars, method=None, path=None):
+    """
+    Write the frozen scalars file as the next version
+    :param scalars: dict {instrument name: {forecast column: scalar}}
+    :param method: estimator of the scalars, stored for the reference
+    :param path: settings.scalars_path by default
+    :return: version number of the file
+    """
+    path = path or scalars_path
+    try:
+        with open(path) as f:
+            previous = json.load(f).get('version', 0)
+    except (IOError, ValueError):
+        previous = 0
+    content = {'version': previous + 1,
+               'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               'estimator': method or (fallback if estimator == 'frozen' else estimator),
+               'scalars': scalars}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with atomic_write(path) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump(content, f, indent=1, sort_keys=True)
+    return content['version']
+
+
+def version():
+    """
+    Version of the frozen scalars in use, None if there is no scalars file or they are not used
+    """
+    if estimator != 'frozen':
+        return None
+    load()
+    return _frozen['version']
+
+
+def frozen(data, instrument, name=None):
+    """
+    Look up the frozen scalars of the data
+    :return: float, pd.Series by column for a DataFrame, or None if any scalar is missing
+    """
+    if instrument is None:
+        return None
+    table = load().get(str(instrument), {})
+    if isinstance(data, pd.DataFrame):
+        names = [str(c) for c in data.columns]
+        if not all(n in table for n in names):
+            return None
+        return pd.Series([table[n] for n in names], index=data.columns)
+    name = str(data.name if name is None else name)
+    return table.get(name)
+
+
+def load():
+    """
+    Load the frozen scalars file, reloaded when it changes
+    :return: dict {instrument name: {forecast column: scalar}}
+    """
+    try:
+        mtime = os.stat(scalars_path).st_mtime_ns
+    except OSError:
+        _frozen.update(mtime=None, version=None, scalars={})
+        return {}
+    if _frozen['mtime'] != mtime:
+        with open(scalars_path) as f:
+            content = json.load(f)
+        _frozen.update(mtime=mtime, version=content.get('version'), scalars=content['scalars'])
+    return _frozen['scalars']
+
+
+def resample_indices(n, size=None, reps=None, random_state=None):
+    """
+    Indices of the stationary bootstrap resamples of a series of length n, as a single matrix.
+    Every position starts a new block with the probability 1 / size at a random position,
+    otherwise it continues the block from the next value (circularly).
+    :return: np.ndarray of shape (reps, n)
+    """
+    size = size or block_size
+    reps = reps or repetitions
+    rs = np.random.RandomState(seed) if random_state is None else random_state
+    starts = rs.randint(0, n, size=(reps, n))
+    new_block = rs.random_sample((reps, n)) < 1.0 / size
+    new_block[:, 0] = True
+    t = np.arange(n)
+    # position in the series where the current block started
+    block_t = np.maximum.accumulate(np.where(new_block, t, 0), axis=1)
+    block_start = np.take_along_axis(starts, block_t, axis=1)
+    return (block_start + t - block_t) % n
+
+
+def resample_counts(n):
+    """
+    Number of times every position of a series of length n is drawn in each resample
+    :return: np.ndarray of shape (repetitions, n) with an unsigned integer dtype, cast it to
+             float64 for the matrix products
+    """
+    if n not in _counts:
+        idx = resample_indices(n)
+        reps = len(idx)
+        counts = np.bincount((idx + np.arange(reps)[:, None] * n).ravel(), minlength=reps * n)
+        if len(_counts) >= _counts_size:
+            _counts.pop(next(iter(_counts)))
+        dtype = np.min_scalar_type(counts.max() if len(counts) else 0)
+        _counts[n] = counts.reshape(reps, n).astype(dtype)
+    return _counts[n]
+
+
+def _values(data):
+    """Values as a 2-D array, the rows with missing values masked as in data.dropna()"""
+    values = np.asarray(data, dtype='float64')
+    if values.ndim == 1:
+        values = values[:, None]
+    valid = ~np.isnan(values).any(axis=1)
+    return np.where(valid[:, None], values, 0), valid
+
+
+def _resample(data, statistic):
+    values, valid = _values(data)
+    counts = resample_counts(len(values)).astype('float64')
+    # the statistics of all the resamples as weighted sums of the rows
+    total = counts.dot(valid.astype('float64'))[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if statistic == 'abs_mean':
+            stat = counts.dot(np.abs(values)) / total
+        elif statistic == 'std':
+            mean = counts.dot(values) / total
+            stat = np.sqrt((counts.dot(values ** 2) - total * mean ** 2) / (total - 1))
+        else:
+            raise ValueError('Unknown statistic: %s' % statistic)
+    return float(np.nanmean(stat)) if np.isfinite(stat).any() else np.nan
+
+
+def _analytic(data, statistic):
+    values, valid = _values(data)
+    values = values[valid]
+    if len(values) < 2:
+        return np.nan
+    if statistic == 'abs_mean':
+        stat = np.abs(values).mean(axis=0)
+    elif statistic == 'std':
+        stat = values.std(axis=0, ddof=1)
+    else:
+        raise ValueError('Unknown statistic: %s' % statistic)
+    return float(np.mean(stat))
+
+
+def _bootstrap(data, statistic):
+    from arch.bootstrap import StationaryBootstrap
+    if statistic == 'abs_mean':
+        fn = lambda x: x.dropna().abs().mean()
+    elif statistic == 'std':
+        fn = lambda x: x.dropna().std()
+    else:
+        raise ValueError('Unknown statistic: %s' % statistic)
+    bs = StationaryBootstrap(block_size, data)
+    return bs.apply(fn, repetitions).mean()
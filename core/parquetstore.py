@@ -0,0 +1,211 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import config.settings
+import os
+import core.schema as schema
+from core.fileutil import file_lock, atomic_write
+
+"""
+Implementation of the local storage with Parquet files as the backend.
+
+* Directories structure for Parquet storage:
+    futures: "[settings.parquet_path]/[provider]/futures/[symbol]/[contract].parquet"
+    others:  "[settings.parquet_path]/[provider]/[q_type]/[symbol].parquet"
+* Futures are partitioned by contract, so an update only rewrites the contracts it touches
+* Files are columnar, the readers can load only the requested columns
+* Values are stored in the compact schema of core.schema, the dtypes are chosen per file.
+  The readers cast all files of a symbol to the common wide schema.
+* For q_type == 'futures' returnes DataFrame with the multi-index ['contract', 'date'],
+  for other quotes types index is ['date']
+* Writes are serialized per symbol with an advisory lock, which works across threads and processes
+* Every file is written to a temporary file first and then renamed over the original one, so
+  readers don't need the lock and a crash during a write can't corrupt the file
+"""
+parquet_path = getattr(config.settings, 'parquet_path',
+                       os.path.join(os.path.dirname(config.settings.hdf_path), 'parquet'))
+
+
+def fname(symbol, q_type, provider, contract=None):
+    """
+    Resolve the Parquet file name for the given store symbol. For futures the name of the
+    directory with contract files is returned if contract is not given.
+    """
+    if q_type == 'futures':
+        fname = os.path.join(parquet_path, provider, q_type, symbol)
+        dirname = fname
+        if contract is not None:
+            fname = os.path.join(fname, '%d.parquet' % int(contract))
+    else:
+        fname = os.path.join(parquet_path, provider, q_type, symbol + '.parquet')
+        dirname = os.path.dirname(fname)
+    # create directories
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    return fname
+
+
+def read_contract(symbol, contract, provider, start=None, end=None):
+    """
+    Read a single contract for a future instrument, optionally only the dates between start and
+    end (inclusive)
+    """
+    d = fname(symbol, 'futures', provider)
+    if os.listdir(d):
+        f = fname(symbol, 'futures', provider, contract)
+        if os.path.exists(f):
+            data = _read(f, filters=_filters(start, end))
+        else:
+            # a contract without quotes has the columns of the other contracts, as in hdfstore
+            data = _wide_schema(d).empty_table().to_pandas()
+        return data.drop('contract', axis=1).set_index('date')
+    else:
+        c = ['contract', 'date']
+        return pd.DataFrame(columns=c).set_index(c)
+
+
+def read_symbol(symbol, q_type, provider, start=None, end=None, contracts=None, columns=None):
+    """
+    Read data from the corresponding Parquet file(s). The selection is pushed down to the
+    Parquet reader, which skips the files and row groups outside of it.
+    :param start: first date to read, inclusive
+    :param end: last date to read, inclusive
+    :param contracts: list of contract labels, or a slice of labels (futures only)
+    :param columns: list of data columns to read, all columns if None
+    """
+    idx = _index(q_type)
+    f = fname(symbol, q_type, provider)
+    if os.path.exists(f) and (q_type != 'futures' or os.listdir(f)):
+        data = _read(f, columns=None if columns is None else idx + list(columns),
+                     filters=_filters(start, end, contracts))
+        return data.set_index(idx).sort_index()
+    else:  # if symbol doesn't exist, an empty df is returned with only index columns
+        return pd.DataFrame(columns=idx).set_index(idx)
+
+
+def write_data(data, symbol, q_type, provider, stored=None):
+    """
+    Writes a dataframe to Parquet file(s). If the symbol exists, the existing data will be
+    updated on dataframe keys, favoring new data.
+    :param stored: storage dtypes of the data in its previous storage (e.g. when migrated from
+                   the HDF files), see core.schema.dtypes()
+    :return: tuple (rows, None): the whole contents of the rewritten contracts as they are read
+             back, see core.hdfstore.write_data()
+    """
+    idx = _index(q_type)
+    with file_lock(fname(symbol, q_type, provider)):
+        if q_type == 'futures':
+            rows = pd.concat([_merge_write(fname(symbol, q_type, provider, contract),
+                                           c_data.set_index(idx), idx, symbol, stored)
+                              for contract, c_data in data.groupby('contract')])
+        else:
+            rows = _merge_write(fname(symbol, q_type, provider), data.set_index(idx), idx, symbol,
+                                stored)
+    return rows, None
+
+
+def drop_symbol(symbol, q_type, provider):
+    """
+    Remove the corresponding Parquet file(s)
+    """
+    f = fname(symbol, q_type, provider)
+    with file_lock(f):
+        if q_type == 'futures':
+            for c in os.listdir(f):
+                os.remove(os.path.join(f, c))
+            os.rmdir(f)
+        else:
+            os.remove(f)
+
+
+def version(symbol, q_type, provider):
+    """
+    Token identifying the current state of the stored symbol, it changes on every write
+    :return: version string, or None if the symbol doesn't exist
+    """
+    f = fname(symbol, q_type, provider)
+    if q_type == 'futures':
+        stats = [e.stat() for e in os.scandir(f) if e.name.endswith('.parquet')]
+    else:
+        stats = [os.stat(f)] if os.path.exists(f) else []
+    if not stats:
+        return None
+    return '%d-%d-%d' % (max(s.st_mtime_ns for s in stats), sum(s.st_size for s in stats),
+                         len(stats))
+
+
+def _index(q_type):
+    return ['contract', 'date'] if q_type == 'futures' else ['date']
+
+
+def _filters(start=None, end=None, contracts=None):
+    """Parquet row filters for a date range and contracts"""
+    filters = []
+    if isinstance(contracts, slice):
+        if contracts.start is not None:
+            filters.append(('contract', '>=', int(contracts.start)))
+        if contracts.stop is not None:
+            filters.append(('contract', '<=', int(contracts.stop)))
+    elif contracts is not None:
+        filters.append(('contract', 'in', [int(c) for c in contracts]))
+    if start is not None:
+        filters.append(('date', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('date', '<=', pd.Timestamp(end)))
+    return filters
+
+
+def _read(f, columns=None, filters=None):
+    """
+    Read a Parquet file or a directory of files, upcasting the stored values
+    """
+    return pq.read_table(f, schema=_wide_schema(f), columns=columns,
+                         filters=filters or None).to_pandas()
+
+
+def _wide_schema(f):
+    """
+    The common wide schema of a Parquet file or a directory of files, see core.schema
+    """
+    if os.path.isdir(f):
+        first = next(e.path for e in os.scandir(f) if e.name.endswith('.parquet'))
+    else:
+        first = f
+    return pa.schema([(n, pa.int64() if n == 'contract' else
+                       pa.timestamp('ns') if n == 'date' else pa.float64())
+                      for n in pq.read_schema(first).names])
+
+
+def _stored_dtypes(f, idx, stored=None):
+    """
+    Storage dtypes of the data columns of a file, the wider one where stored has the column too
+    :return: dict {column: dtype name}, stored if the file doesn't exist
+    """
+    if not os.path.exists(f):
+        return stored
+    result = dict(stored or {})
+    for field in pq.read_schema(f):
+        dtype = np.dtype(field.type.to_pandas_dtype())
+        if field.name not in idx and \
+                dtype.itemsize >= np.dtype(result.get(field.name, dtype)).itemsize:
+            result[field.name] = dtype.name
+    return result
+
+
+def _merge_write(f, data, idx, symbol, stored=None):
+    """
+    Merge the data with the existing file (favoring new data) and rewrite it
+    :param stored: storage dtypes of the data, see write_data()
+    :return: the merged data as it is read from the file
+    """
+    stored = _stored_dtypes(f, idx, stored)
+    if os.path.exists(f):
+        data = data.combine_first(_read(f).set_index(idx))
+    data = schema.encode(data.sort_index(), schema.dtypes(data, symbol, stored), days=False)
+    table = pa.Table.from_pandas(data.reset_index(), preserve_index=False)
+    table = table.set_column(table.schema.get_field_index('date'), 'date',
+                             table['date'].cast(pa.date32()))
+    with atomic_write(f) as tmp:
+        pq.write_table(table.replace_schema_metadata(None), tmp)
+    return schema.decode(data)
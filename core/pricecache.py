@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import config.settings
+
+"""
+Read-only cache of merged price data as memory-mapped NumPy arrays.
+
+* Directories structure: "[settings.cache_path]/prices/[name]/"
+* Every data column is stored in a separate [column].npy file, the index levels are stored as
+  [level].levels.npy and [level].codes.npy, so a DataFrame is rebuilt without parsing or copying
+  the data. All processes loading the same cache share the pages of the mapped files.
+* index.json holds the column and index names and the version of the source data. An entry is
+  only used while its version matches the current version of the source storage.
+* Entries are replaced by swapping their directories. Readers don't take a lock, they check that
+  index.json hasn't changed while the arrays were mapped and load again otherwise.
+"""
+# Older settings files don't have the option, the cache is kept next to the quotes storage
+cache_path = getattr(config.settings, 'cache_path',
+                     os.path.join(os.path.dirname(config.settings.hdf_path), 'cache'))
+# Older settings files don't have the option, the cache is enabled by default
+price_cache = getattr(config.settings, 'price_cache', True)
+# Attempts to load an entry which is being replaced by another process
+load_retries = 3
+
+
+def dirname(name):
+    """
+    Resolve the cache directory for the given name
+    """
+    return os.path.join(cache_path, 'prices', name)
+
+
+def load(name, version, columns=None):
+    """
+    Load the cached DataFrame if it's up to date
+    :param name: cache entry name
+    :param version: version of the source data the cache must match
+    :param columns: list of data columns to map, all columns if None
+    :return: pd.DataFrame backed by memory-mapped arrays, or None if there is no valid entry
+    """
+    d = dirname(name)
+    for attempt in range(load_retries):
+        try:
+            index = _read_index(d)
+            if index['version'] != version:
+                return None
+            data = _map(d, index, index['columns'] if columns is None else list(columns))
+            # the entry may have been replaced while the arrays were mapped, they are only
+            # consistent if it's still the same
+            if data is None or _read_index(d) == index:
+                return data
+        except (IOError, ValueError, KeyError):
+            # e.g. the directory was swapped between the reads of two files
+            continue
+    return None
+
+
+def _read_index(d):
+    with open(os.path.join(d, 'index.json')) as f:
+        return json.load(f)
+
+
+def _map(d, index, columns):
+    """
+    Rebuild the DataFrame of an entry from the memory-mapped arrays
+    :return: pd.DataFrame, or None if the entry doesn't have the columns
+    """
+    if not set(columns).issubset(index['columns']):
+        return None
+    levels = [pd.Index(np.load(os.path.join(d, l + '.levels.npy'), mmap_mode='r'), name=l)
+              for l in index['index']]
+    codes = [np.load(os.path.join(d, l + '.codes.npy'), mmap_mode='r') for l in index['index']]
+    if len(levels) > 1:
+        idx = pd.MultiIndex(levels=levels, codes=codes, names=index['index'],
+                            verify_integrity=False)
+    else:
+        idx = levels[0].take(codes[0])
+    return pd.DataFrame({c: np.load(os.path.join(d, c + '.npy'), mmap_mode='r')
+                         for c in columns}, index=idx, columns=columns, copy=False)
+
+
+def save(name, version, data):
+    """
+    Write the DataFrame to the cache, replacing the existing entry
+    """
+    d = dirname(name)
+    tmp = d + '.tmp-%d' % os.getpid()
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    names = list(data.index.names)
+    if isinstance(data.index, pd.MultiIndex):
+        levels, codes = data.index.levels, data.index.codes
+    else:
+        codes, uniques = pd.factorize(data.index)
+        levels, codes = [uniques], [codes]
+    for n, l, c in zip(names, levels, codes):
+        np.save(os.path.join(tmp, n + '.levels.npy'), np.asarray(l))
+        np.save(os.path.join(tmp, n + '.codes.npy'), np.asarray(c))
+    for c in data.columns:
+        np.save(os.path.join(tmp, c + '.npy'), data[c].to_numpy(dtype='float64'))
+    with open(os.path.join(tmp, 'index.json'), 'w') as f:
+        json.dump({'version': version, 'columns': list(data.columns), 'index': names,
+                   'rows': len(data)}, f)
+    # swap the directories, so that the readers never see a partially written entry
+    old = d + '.old-%d' % os.getpid()
+    try:
+        if os.path.exists(d):
+            os.rename(d, old)
+        os.rename(tmp, d)
+    except OSError:
+        # another process has replaced the entry at the same time, keep its version
+        pass
+    shutil.rmtree(old, ignore_errors=True)
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+def clear(name=None):
+    """
+    Remove a cache entry, or the whole cache if name is None
+    """
+    shutil.rmtree(dirname(name) if name is not None else os.path.join(cache_path, 'prices'),
+                  ignore_errors=True)
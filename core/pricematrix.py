@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+"""
+Dense date x contract representation of the quotes of a future instrument.
+
+The quotes are held as 2-D arrays with a row per date and a column per contract, so reading the
+prices of given contracts on given dates (the held contract, the next contract, a term structure
+snapshot) is a lookup of the row and column positions and a fancy index instead of a join
+against the MultiIndex frame.
+
+* Cells without a quote are NaN in the value arrays and False in PriceMatrix.present
+* PriceMatrix.active marks the quotes kept by Instrument.contracts(active_only=True)
+"""
+
+
+class PriceMatrix(object):
+    """
+    Quotes of a future instrument as date x contract arrays
+    """
+    def __init__(self, data):
+        """
+        :param data: quotes DataFrame with the multi-index ['contract', 'date'], see
+                     Instrument.contracts()
+        """
+        index = data.index.remove_unused_levels()
+        contract_levels, date_levels = index.levels
+        # the levels are sorted and unique, the codes are the column and row positions
+        self.contracts = np.asarray(contract_levels, dtype='int64')
+        self.dates = pd.DatetimeIndex(date_levels, name='date')
+        shape = (len(self.dates), len(self.contracts))
+        rows, cols = index.codes[1], index.codes[0]
+        self.present = np.zeros(shape, dtype=bool)
+        self.present[rows, cols] = True
+        self.values = {}
+        for c in data.columns:
+            self.values[c] = np.full(shape, np.nan)
+            self.values[c][rows, cols] = data[c].values
+        self.active = self.present.copy()
+        if 'open' in self.values and 'volume' in self.values:
+            with np.errstate(invalid='ignore'):
+                self.active &= (self.values['open'] > 0) & (self.values['volume'] > 1)
+
+    def __len__(self):
+        return int(self.present.sum())
+
+    def row_index(self, dates):
+        """
+        Row positions of the dates, -1 for the dates without quotes
+        """
+        dates = pd.DatetimeIndex(dates).as_unit(self.dates.unit)
+        return self.dates.get_indexer(dates)
+
+    def column_index(self, contracts):
+        """
+        Column positions of the contract labels, -1 for the contracts without quotes
+        """
+        contracts = np.asarray(contracts, dtype='int64')
+        if not len(self.contracts):
+            return np.full(len(contracts), -1)
+        i = np.searchsorted(self.contracts, contracts).clip(0, len(self.contracts) - 1)
+        return np.where(self.contracts[i] == contracts, i, -1)
+
+    def exists(self, rows, cols, active_only=True):
+        """
+        Check which (row, column) pairs have a quote
+        :param rows: row positions, see row_index()
+        :param cols: column positions, see column_index()
+        :param active_only: only count the quotes of Instrument.contracts(active_only=True)
+        :return: boolean np.ndarray
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        found = (rows >= 0) & (cols >= 0)
+        mask = self.active if active_only else self.present
+        result = np.zeros(len(rows), dtype=bool)
+        result[found] = mask[rows[found], cols[found]]
+        return result
+
+    def take(self, column, rows, cols, active_only=True):
+        """
+        Values of a column at the (row, column) pairs, NaN where there is no quote
+        :return: np.ndarray
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        found = self.exists(rows, cols, active_only=active_only)
+        result = np.full(len(rows), np.nan)
+        result[found] = self.values[column][rows[found], cols[found]]
+        return result
+
+    def snapshot(self, date, active_only=False):
+        """
+        Quotes of all contracts on the date (the term structure)
+        :return: pd.DataFrame indexed by contract
+        :raise KeyError: if there are no quotes on the date
+        """
+        row = self.row_index([date])[0]
+        if row < 0:
+            raise KeyError(date)
+        cols = np.flatnonzero((self.active if active_only else self.present)[row])
+        return pd.DataFrame({c: v[row, cols] for c, v in self.values.items()},
+                            index=pd.Index(self.contracts[cols], name='contract'))
+
+    def frame(self, column, active_only=False):
+        """
+        A column as a date x contract DataFrame, NaN where there is no quote
+        """
+        values = np.where(self.active if active_only else self.present,
+                          self.values[column], np.nan)
+        return pd.DataFrame(values, index=self.dates,
+                            columns=pd.Index(self.contracts, name='contract'))
@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+import config.settings
+
+"""
+Compact dtype schema of the local storage.
+
+Quotes are stored with the narrowest dtypes which keep the values within the precision that
+matters, and are upcast back when read. Readers get frames of the same dtypes, but a price stored
+as float32 comes back as the nearest float32 value (404.4 is read as 404.399994), within the
+tolerance below:
+
+* price columns are stored as float32 when the round trip through float32 is within tolerance,
+  otherwise as float64
+* volume is stored as int32 when all values are integers in range, otherwise as a float column
+* contract labels (YYYYMM) are stored as int32
+* dates are stored as days since 1970-01-01 (int32 in HDF files, date32 in Parquet files)
+* readers get float64 data columns, int64 contract labels and datetime64[ns] dates
+
+The tolerance is relative (settings.storage_rtol) unless the instrument defines the absolute one
+in the price units of the storage ('storage_precision' in config/instruments.py).
+
+Values which are already stored in 64 bits (files written before the compact schema, or columns
+which needed the precision) are only narrowed when the conversion is exact, so rewriting a file
+doesn't change its values. Set settings.convert_storage to convert them within the tolerance too.
+"""
+# Older settings files don't have the options, the compact schema is enabled by default
+compact_storage = getattr(config.settings, 'compact_storage', True)
+storage_rtol = getattr(config.settings, 'storage_rtol', 1e-6)
+convert_storage = getattr(config.settings, 'convert_storage', False)
+# Version of the schema, stored with every file written in it
+version = 1
+# Columns which may be stored as integers
+integer_columns = ['volume']
+
+_precision = None
+
+
+def precision(symbol):
+    """
+    Absolute tolerance of the stored values for the given store symbol
+    :return: tolerance, or None if the instrument doesn't define it
+    """
+    global _precision
+    if _precision is None:
+        # imported here, config.instruments depends on the modules using the storage
+        import config.instruments
+        _precision = {}
+        for i in config.instruments.instrument_definitions:
+            if 'storage_precision' not in i:
+                continue
+            if 'quandl_database' in i and 'quandl_symbol' in i:
+                _precision[i['quandl_database'] + '_' + i['quandl_symbol']] = i['storage_precision']
+            if 'exchange' in i and 'ib_code' in i:
+                _precision[i['exchange'] + '_' + i['ib_code']] = i['storage_precision']
+    return _precision.get(symbol)
+
+
+def dtypes(data, symbol=None, stored=None):
+    """
+    Choose the storage dtypes for the data columns of a quotes DataFrame
+    :param symbol: store symbol, used to look up the instrument's precision
+    :param stored: dict {column: dtype name} of the file the data is rewritten to, the columns
+                   stored in 64 bits are only narrowed without a loss (unless convert_storage)
+    :return: dict {column: dtype name}
+    """
+    result = {}
+    for c in data.columns:
+        exact = not convert_storage and stored is not None and \
+            np.dtype(stored.get(c, 'float32')).itemsize == 8
+        candidates = (['int32'] if c in integer_columns else []) + ['float32']
+        result[c] = next((d for d in candidates if compact_storage and
+                          _lossless(data[c], d, symbol, exact)), 'float64')
+    return result
+
+
+def fits(data, dtypes, symbol=None):
+    """
+    Check if the data columns can be stored with the given dtypes without losing precision
+    """
+    return set(data.columns) == set(dtypes) and \
+        all(_lossless(data[c], d, symbol) for c, d in dtypes.items())
+
+
+def encode(data, dtypes, days=True):
+    """
+    Convert a quotes DataFrame to the storage schema
+    :param dtypes: dict {column: dtype name}, see dtypes()
+    :param days: store the dates as int32 days, otherwise they are left as datetimes
+    """
+    data = data.astype(dtypes)
+    if isinstance(data.index, pd.MultiIndex):
+        contracts, dates = data.index.levels
+        levels = [contracts.astype('int32'), to_days(dates) if days else dates]
+        data.index = data.index.set_levels(levels, verify_integrity=False)
+    elif days:
+        data.index = pd.Index(to_days(data.index), name=data.index.name)
+    return data
+
+
+def decode(data):
+    """
+    Upcast a quotes DataFrame read from the storage. Only the unique values of the index levels
+    are converted, not the whole index.
+    """
+    data = data.astype('float64')
+    if isinstance(data.index, pd.MultiIndex):
+        contracts, dates = data.index.levels
+        levels = [contracts.astype('int64'), from_days(dates)]
+        data.index = data.index.set_levels(levels, verify_integrity=False)
+    else:
+        data.index = pd.DatetimeIndex(from_days(data.index), name=data.index.name)
+    return data
+
+
+def to_days(dates):
+    """Convert dates to int32 days since 1970-01-01"""
+    dates = pd.DatetimeIndex(dates).as_unit('ns')
+    return pd.Index((dates.asi8 // (86400 * 10 ** 9)).astype('int32'), name=dates.name)
+
+
+def from_days(days):
+    """Convert int days since 1970-01-01 to datetime64[ns], other dates are converted as is"""
+    days = pd.Index(days)
+    if pd.api.types.is_integer_dtype(days.dtype):
+        return pd.to_datetime(days.astype('int64'), unit='D').as_unit('ns').rename(days.name)
+    return pd.DatetimeIndex(days).as_unit('ns')
+
+
+def _lossless(values, dtype, symbol=None, exact=False):
+    """
+    Check if the values survive the round trip through dtype within the tolerance
+    :param exact: no tolerance, the values must survive the round trip unchanged
+    """
+    if dtype == 'float64':
+        return True
+    values = np.asarray(values, dtype='float64')
+    finite = np.isfinite(values)
+    if dtype == 'int32':
+        return bool(finite.all() and (values == np.round(values)).all() and
+                    (np.abs(values) <= np.iinfo('int32').max).all())
+    with np.errstate(over='ignore', invalid='ignore'):
+        error = np.abs(values.astype(dtype).astype('float64') - values)[finite]
+    if exact:
+        return bool((error == 0).all())
+    atol = precision(symbol) if symbol is not None else None
+    tolerance = atol if atol is not None else storage_rtol * np.abs(values[finite])
+    return bool((error <= tolerance).all())
@@ -1,13 +1,21 @@
 import numpy as np
 import logging
 import pandas as pd
+from bisect import bisect_left
 from collections import namedtuple
 import datetime
+import os
 import subprocess
+from scipy.signal import lfilter
+import config.settings
+from core.fileutil import atomic_write
+import core.normalization as normalization
 
 """
 Miscellaneous utility functions
 """
+cache_path = getattr(config.settings, 'cache_path',
+                     os.path.join(os.path.dirname(config.settings.hdf_path), 'cache'))
 
 
 class ConnectionException(Exception):
@@ -27,6 +35,42 @@ def contract_to_tuple(contract):
     return (int(contract[0:4]),int(contract[4:6]))
 
 
+def filter_quotes(data, contracts=None, start=None, end=None):
+    """
+    Select rows of a quotes DataFrame as stored in the local storage (see core.contract_store)
+    :param contracts: list of contract labels, or a slice of labels (inclusive), futures only
+    :param start: first date, inclusive
+    :param end: last date, inclusive
+    """
+    futures = isinstance(data.index, pd.MultiIndex)
+    dates = data.index.get_level_values('date') if futures else data.index
+    mask = np.ones(len(data), dtype=bool)
+    if isinstance(contracts, slice):
+        c = data.index.get_level_values('contract')
+        if contracts.start is not None:
+            mask &= c >= int(contracts.start)
+        if contracts.stop is not None:
+            mask &= c <= int(contracts.stop)
+    elif contracts is not None:
+        mask &= data.index.get_level_values('contract').isin([int(c) for c in contracts])
+    if start is not None:
+        mask &= dates >= pd.Timestamp(start)
+    if end is not None:
+        mask &= dates <= pd.Timestamp(end)
+    return data if mask.all() else data[mask]
+
+
+def active_quotes(data):
+    """
+    Mask of the quotes with trading activity: a positive open price and a volume above 1.
+    Quotes without these columns (e.g. exchange rates) are all active.
+    :return: np.ndarray of bool
+    """
+    if 'open' not in data.columns or 'volume' not in data.columns:
+        return np.ones(len(data), dtype=bool)
+    return ((data['open'] > 0) & (data['volume'] > 1)).to_numpy()
+
+
 def filter_outliers(s, sigma=4):
     """Filter out samples with more than sigma std deviations away from the mean"""
     return s[~(s-s.mean()).abs() > sigma*s.std()]
@@ -66,11 +110,12 @@ def drawdown(x):
     return x - maxx
 
 
-def norm_vol(df):
+def norm_vol(df, instrument=None):
     """Arbitrarily normalize the volatility of a series. Useful for where different instruments
      have different price volatilities but we still want to feed them into the same regressor
-    WARNING: Lookahead bias here"""
-    return (df*10/bootstrap(df, lambda x: x.dropna().std()))
+    WARNING: Lookahead bias here
+    :param instrument: instrument name, the key of the frozen scalar 'vol' (see core.normalization)"""
+    return (df*10/normalization.scalar(df, 'std', instrument, name='vol'))
     # return (df*10/df.expanding(50).std())
 
 
@@ -89,26 +134,258 @@ def contract_from_date(expire_day, months, date):
     return date_to_contract(expiry)
 
 
+# roll calendars generated or loaded by this process, keyed by (roll_day, months, roll_shift)
+_roll_calendars = {}
+
+
 def generate_roll_progression(roll_day, months, roll_shift):
-    """Fast version of contract_from_date, used to generate roll sequence quickly."""
-    rolls = []
-    for year in range(1960,datetime.datetime.now().year+5):
-        rolls.extend([datetime.datetime(year, k, abs(roll_day)) for k in months])
+    """
+    Fast version of contract_from_date, used to generate roll sequence quickly.
+    Returns the contract to hold on every day from the first roll after 1960 until today.
+
+    Calendars are shared by all instruments with the same parameters: they are cached in the
+    process and persisted to "[settings.cache_path]/rolls/", so other processes load them
+    instead of generating.
+    """
+    key = (int(roll_day), tuple(sorted(int(m) for m in months)), int(roll_shift))
+    now = datetime.datetime.now()
+    calendar = _roll_calendars.get(key)
+    if calendar is None or calendar.index[-1] < pd.Timestamp(now.date()):
+        calendar = _load_roll_calendar(key, now)
+        if calendar is None:
+            # calendars are generated until the end of the next year
+            calendar = _roll_calendar(*key, end=datetime.date(now.year + 1, 12, 31))
+            _save_roll_calendar(key, calendar)
+        _roll_calendars[key] = calendar
+    return calendar[:now]
+
+
+def _roll_calendar(roll_day, months, roll_shift, end):
+    """
+    Contract to hold on every day until end. It's the contract of the first roll after
+    date + 30 days (if roll_day < 1) - roll_shift days. The contract codes are computed from the
+    roll dates arithmetically.
+    """
+    offset = (30 if roll_day < 1 else 0) - roll_shift
+    years = np.arange(1960, (end + datetime.timedelta(days=offset)).year + 2)
+    months = np.array(months)
+    # roll dates and contract codes of all years, in the chronological order
+    rolls = ((years[:, None] - 1970) * 12 + months - 1).ravel().astype('datetime64[M]').\
+        astype('datetime64[D]') + (abs(roll_day) - 1)
+    codes = (years[:, None] * 100 + months).ravel()
+    dates = np.arange(rolls[0] + max(roll_shift, 0), np.datetime64(end, 'D') + 1)
+    contracts = codes[np.searchsorted(rolls, dates + offset, side='right')]
+    return _calendar_series(dates[0], contracts)
+
+
+def _calendar_series(start, contracts):
+    """Daily series of contract codes starting at start (numpy datetime64[D])"""
+    index = pd.date_range(start=str(start), periods=len(contracts), name='date')
+    return pd.Series(contracts.astype('int64'), index=index, name='contract')
+
+
+def _roll_calendar_fname(key):
+    roll_day, months, roll_shift = key
+    return os.path.join(cache_path, 'rolls', '%d_%s_%d.npz' % (
+        roll_day, '-'.join(str(m) for m in months), roll_shift))
+
+
+def _load_roll_calendar(key, now):
+    """Load a persisted calendar, None if it's missing or doesn't reach today"""
+    try:
+        with np.load(_roll_calendar_fname(key)) as f:
+            start, contracts = f['start'], f['contracts']
+    except (IOError, ValueError, KeyError):
+        return None
+    if not len(contracts) or start + len(contracts) - 1 < np.datetime64(now.date()):
+        return None
+    return _calendar_series(start, contracts)
 
-    rolls = pd.Series(rolls, index=rolls, name='rolls').shift(-1)
 
-    dates = pd.date_range(start='1960-01-01', end=datetime.datetime.now()+pd.DateOffset(years=10))
-    a = pd.Series(0, index=dates).to_frame().join(rolls).ffill().dropna()['rolls'].to_frame()
-    a['contract'] = a['rolls'].apply(date_to_contract)
-    a.index = a.index.rename('date')
-    b = a['contract']
+def _save_roll_calendar(key, calendar):
+    f = _roll_calendar_fname(key)
+    try:
+        os.makedirs(os.path.dirname(f), exist_ok=True)
+        with atomic_write(f) as tmp:
+            with open(tmp, 'wb') as out:
+                np.savez(out, start=calendar.index[0].to_datetime64().astype('datetime64[D]'),
+                         contracts=calendar.values.astype('int32'))
+    except OSError:
+        # the cache is optional, e.g. the directory may be read-only
+        pass
 
-    if roll_day<1:
-        b = b.shift(-30).dropna().apply(int)
 
-    if roll_shift!=0:
-        b = b.shift(roll_shift).dropna().apply(int)
-    return b[:datetime.datetime.now()]
+def panama_stitch(close, roll_progression):
+    """
+    Build a 'continuous future' series by panama stitching: the daily price changes of the
+    contract held on each date according to the roll progression are summed up.
+    Works on the sorted date and contract arrays, the contract held on each row's date is looked
+    up with a binary search in the roll progression.
+    :param close: pd.Series of close prices with the multi-index ['contract', 'date'], sorted
+    :param roll_progression: pd.Series of contract labels indexed by date, sorted
+    :return: pd.Series indexed by date
+    """
+    contracts = close.index.get_level_values('contract').values
+    dates = close.index.get_level_values('date').values
+    # price changes in the frame order, like Series.diff() on the whole frame
+    values = np.asarray(close.values, dtype='float64')
+    diff = np.zeros(len(values))
+    diff[1:] = values[1:] - values[:-1]
+    diff[np.isnan(diff)] = 0
+    rp_dates = roll_progression.index.values.astype(dates.dtype)
+    rp_contracts = roll_progression.values
+    pos = np.searchsorted(rp_dates, dates).clip(max=max(len(rp_dates) - 1, 0))
+    held = np.zeros(len(dates), dtype=bool)
+    if len(rp_dates):
+        held = (rp_dates[pos] == dates) & (rp_contracts[pos] == contracts)
+    return pd.Series(diff[held].cumsum(), index=pd.DatetimeIndex(dates[held], name='date'),
+                     name=close.name)
+
+
+def ewm_mean(values, span):
+    """
+    Same as pd.DataFrame(values).ewm(span=span).mean() for a 2-D array, calculated for all the
+    columns at once as two recursive filters: the weighted sum of the values and the sum of the
+    weights. The weights decay over the missing values as in pandas (ignore_na=False).
+    :param values: np.ndarray of shape (dates, series)
+    :return: np.ndarray of the same shape, NaN before the first value of each column
+    """
+    values = np.asarray(values, dtype='float64')
+    decay = [1., 2. / (span + 1.) - 1.]
+    valid = ~np.isnan(values)
+    if valid.all():
+        # the sum of the weights is the same for all the columns
+        weights = lfilter([1.], decay, np.ones(len(values)))
+        weights = weights.reshape((-1,) + (1,) * (values.ndim - 1))
+    else:
+        weights = lfilter([1.], decay, valid.astype('float64'), axis=0)
+        values = np.where(valid, values, 0.)
+    weighted = lfilter([1.], decay, values, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return weighted / weights
+
+
+def rolling_extrema(values, lookbacks, min_periods=None):
+    """
+    Rolling minima and maxima of a 1-D array for many lookbacks at once, the same as
+    pd.Series(values).rolling(lookback, min_periods).min() and .max() (missing values skipped).
+
+    Vectorized with a sparse table: level k holds the extrema of the 2^k values ending at each
+    position, built once by doubling up to the longest lookback. The extremum of any window is
+    then the extremum of the two overlapping power of 2 blocks which cover it, so every extra
+    lookback costs two lookups instead of another rolling pass. See RollingExtrema for the
+    streaming version.
+    :param lookbacks: list of window lengths
+    :param min_periods: list of the minimum numbers of values in the window, the lookbacks if None
+    :return: (minima, maxima) np.ndarrays of shape (len(values), len(lookbacks))
+    """
+    values = np.asarray(values, dtype='float64')
+    n = len(values)
+    lookbacks = [int(x) for x in lookbacks]
+    min_periods = lookbacks if min_periods is None else [int(m) for m in min_periods]
+    # (lookbacks, values), every lookback is written to a contiguous row
+    minima, maxima = np.full((len(lookbacks), n), np.nan), np.full((len(lookbacks), n), np.nan)
+    if n == 0:
+        return minima.T, maxima.T
+    levels = max(int(np.log2(min(max(lookbacks), n))), 0) + 1
+    lows, highs = np.empty((levels, n)), np.empty((levels, n))
+    lows[0] = highs[0] = values
+    with np.errstate(invalid='ignore'):
+        for k in range(1, levels):
+            h = 2 ** (k - 1)
+            # the blocks starting before the array are the shorter blocks at the same position
+            lows[k, :h], highs[k, :h] = lows[k - 1, :h], highs[k - 1, :h]
+            np.fmin(lows[k - 1, h:], lows[k - 1, :-h], out=lows[k, h:])
+            np.fmax(highs[k - 1, h:], highs[k - 1, :-h], out=highs[k, h:])
+    missing = np.isnan(values)
+    # number of values up to each position, for the min_periods
+    counts = np.concatenate([[0], np.cumsum(~missing)]) if missing.any() else None
+    for j, (x, m) in enumerate(zip(lookbacks, min_periods)):
+        # the first x - 1 windows are shorter, the block length varies with the position
+        t = np.arange(min(x - 1, n))
+        k = np.log2(t + 1).astype(int)
+        np.fmin(lows[k, t], lows[k, 2 ** k - 1], out=minima[j, :len(t)])
+        np.fmax(highs[k, t], highs[k, 2 ** k - 1], out=maxima[j, :len(t)])
+        if n >= x:
+            # the window [t - x + 1, t] is covered by the blocks ending at t and t - x + 2^k
+            k = int(np.log2(x))
+            np.fmin(lows[k, x - 1:], lows[k, 2 ** k - 1:n - x + 2 ** k], out=minima[j, x - 1:])
+            np.fmax(highs[k, x - 1:], highs[k, 2 ** k - 1:n - x + 2 ** k], out=maxima[j, x - 1:])
+        if counts is None:
+            minima[j, :max(m, 1) - 1] = maxima[j, :max(m, 1) - 1] = np.nan
+        else:
+            t = np.arange(n)
+            short = counts[t + 1] - counts[np.maximum(t + 1 - x, 0)] < max(m, 1)
+            minima[j, short] = maxima[j, short] = np.nan
+    return minima.T, maxima.T
+
+
+class RollingExtrema(object):
+    """
+    Streaming version of rolling_extrema(): the rolling minima and maxima of a series for many
+    lookbacks, extended with the new values in a single pass.
+
+    Monotonic queues over the longest lookback hold the positions of the values which can still
+    be a minimum (increasing values) or a maximum (decreasing values) of a window. Every value is
+    added and removed once, and the extremum of a lookback is the first queued position inside
+    its window, found by binary search.
+    """
+    def __init__(self, lookbacks, min_periods=None):
+        self.lookbacks = [int(x) for x in lookbacks]
+        self.min_periods = self.lookbacks if min_periods is None else [int(m) for m in min_periods]
+        self.size = max(self.lookbacks)
+        self.count = 0
+        # positions of the values in the longest window, the candidate minima and maxima
+        self.present, self.lows, self.highs = [], [], []
+        self.values = {}
+
+    def update(self, values):
+        """
+        Append new values
+        :return: (minima, maxima) np.ndarrays of shape (len(values), len(lookbacks))
+        """
+        values = np.asarray(values, dtype='float64')
+        minima, maxima = np.full((len(values), len(self.lookbacks)), np.nan), \
+            np.full((len(values), len(self.lookbacks)), np.nan)
+        for i, v in enumerate(values.tolist()):
+            t = self.count
+            self.count += 1
+            if v == v:
+                for queue, higher in ((self.lows, False), (self.highs, True)):
+                    while queue and (self.values[queue[-1]] <= v if higher else
+                                     self.values[queue[-1]] >= v):
+                        queue.pop()
+                    queue.append(t)
+                self.present.append(t)
+                self.values[t] = v
+            self._drop(t - self.size)
+            for j, (x, m) in enumerate(zip(self.lookbacks, self.min_periods)):
+                first = t - x + 1
+                if len(self.present) - bisect_left(self.present, first) < max(m, 1):
+                    continue
+                minima[i, j] = self.values[self.lows[bisect_left(self.lows, first)]]
+                maxima[i, j] = self.values[self.highs[bisect_left(self.highs, first)]]
+        return minima, maxima
+
+    def start(self, values):
+        """
+        Initialise the state from the whole history, the extrema are calculated with
+        rolling_extrema() and only the last longest window goes through the queues
+        :return: (minima, maxima) as update()
+        """
+        values = np.asarray(values, dtype='float64')
+        self.count = max(len(values) - self.size, 0)
+        self.update(values[self.count:])
+        return rolling_extrema(values, self.lookbacks, self.min_periods)
+
+    def _drop(self, last):
+        """Forget the positions up to last, out of the longest window"""
+        for queue in (self.present, self.lows, self.highs):
+            n = bisect_left(queue, last + 1)
+            if n:
+                del queue[:n]
+        if len(self.values) > 2 * self.size:
+            self.values = {t: v for t, v in self.values.items() if t > last}
 
 
 def date_to_contract(date):
@@ -134,16 +411,18 @@ def draw_sample(df, length=1):
     return df.iloc[s:s+length]
 
 
-def weight_forecast(forecasts, weights):
+def weight_forecast(forecasts, weights, instrument=None):
     f = (forecasts*weights).mean(axis=1)
-    f = norm_forecast(f)
+    f = f*10/normalization.scalar(f, 'abs_mean', instrument, name='weighted')
     return f.clip(-20,20)
 
 
-def norm_forecast(a):
+def norm_forecast(a, instrument=None):
     """Normalize a forecast, such that it has an absolute mean of 10.
-    WARNING: Insample lookahead bias"""
-    return (a*10/bootstrap(a, lambda x: x.dropna().abs().mean())).clip(-20,20)
+    WARNING: Insample lookahead bias
+    :param instrument: instrument name, the key of the frozen scalars of the forecast columns
+                       (see core.normalization)"""
+    return (a*10/normalization.scalar(a, 'abs_mean', instrument)).clip(-20,20)
 
 
 def ibcode_to_inst(ib_code):
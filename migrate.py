@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+import os
+import sys
+import traceback
+import pyprind
+import core.hdfstore as hdfstore
+import core.parquetstore as parquetstore
+import core.logger
+logger = core.logger.get_logger('migrate')
+
+
+"""
+Script usage: python migrate.py
+Copies all the quotes from the HDF5 storage (settings.hdf_path) to the Parquet storage
+(settings.parquet_path). Existing Parquet data is updated on index collision, favoring the HDF data.
+Set quotes_storage = 'parquet' in config/settings.py after the migration to use the new storage.
+"""
+
+
+def hdf_symbols():
+    """
+    List all (symbol, q_type, provider) stored in the HDF tree
+    """
+    symbols = []
+    if not os.path.exists(hdfstore.hdf_path):
+        return symbols
+    for provider in sorted(os.listdir(hdfstore.hdf_path)):
+        for q_type in sorted(os.listdir(os.path.join(hdfstore.hdf_path, provider))):
+            for f in sorted(os.listdir(os.path.join(hdfstore.hdf_path, provider, q_type))):
+                if f.endswith('.h5'):
+                    symbols.append((f[:-len('.h5')], q_type, provider))
+    return symbols
+
+
+def migrate():
+    symbols = hdf_symbols()
+    bar = pyprind.ProgBar(len(symbols), title='Migrating quotes from HDF5 to Parquet')
+    for symbol, q_type, provider in symbols:
+        data = hdfstore.read_symbol(symbol, q_type, provider)
+        if not data.empty:
+            # the values stored in 64 bits are kept exactly, see core.schema
+            parquetstore.write_data(data.reset_index(), symbol, q_type, provider,
+                                    stored=hdfstore.stored_dtypes(symbol, q_type, provider))
+            logger.debug('Migrated %s/%s/%s, %d rows' % (provider, q_type, symbol, len(data)))
+        bar.update(item_id=symbol)
+
+
+if __name__ == "__main__":
+    try:
+        migrate()
+    except KeyboardInterrupt:
+        print("Shutdown requested...exiting")
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        sys.exit(0)
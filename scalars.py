@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+import sys
+import traceback
+import pyprind
+import config.portfolios
+import core.normalization as normalization
+from core.instrument import Instrument
+from core.ipc import imap_instruments
+import core.logger
+logger = core.logger.get_logger('scalars')
+
+
+"""
+Script usage: python scalars.py [--all] [--method=<estimator>]
+Estimates the normalisation scalars of every forecast column (ewmac8..ewmac64, carry,
+brk40..brk320, ...), the weighted forecast and the price volatility of the instruments in
+config.portfolios.p_trade (all instruments with --all) from the whole history, and writes them to
+a new version of the frozen scalars file (settings.scalars_path).
+
+With settings.normalization = 'frozen' the forecasts read the scalars from the file instead of
+estimating them on every run. Run it again after a change of the rules or a long period of new
+data; the persisted incremental states are recalculated with the new scalars.
+The scalars of the instruments which are not calculated are kept from the previous version.
+"""
+
+
+def compute(instruments, method=None):
+    """
+    :param instruments: list of instrument names
+    :param method: normalisation estimator, settings.normalization by default
+    :return: dict {instrument name: {forecast column: scalar}}
+    """
+    instruments = list(Instrument.load(instruments).values())
+    bar = pyprind.ProgBar(len(instruments), title='Estimating forecast scalars')
+    scalars = {}
+    for name, result in imap_instruments(instruments, 'forecast_scalars', estimator=method):
+        scalars[name] = result
+        logger.debug('%s: %d scalars' % (name, len(result)))
+        bar.update(item_id=name)
+    return scalars
+
+
+if __name__ == "__main__":
+    try:
+        method = next((a.split('=', 1)[1] for a in sys.argv if a.startswith('--method=')), None)
+        scalars = dict(normalization.load())
+        scalars.update(compute(None if '--all' in sys.argv else config.portfolios.p_trade,
+                               method=method))
+        version = normalization.save(scalars, method=method)
+        print('Saved version %d of %s' % (version, normalization.scalars_path))
+    except KeyboardInterrupt:
+        print("Shutdown requested...exiting")
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        sys.exit(0)
@@ -12,7 +12,7 @@ import traceback
 from core.logger import get_logger
 from functools import partial
 logger = get_logger('scheduler')
-p = trading.portfolio.Portfolio(instruments=config.portfolios.p_trade)
+p = trading.portfolio.Portfolio(instruments=config.portfolios.p_trade, incremental=True)
 i = p.instruments
 
 
@@ -0,0 +1,24 @@
+import pytest
+import core.catalog as catalog
+import core.hdfstore as hdfstore
+import core.incremental as incremental
+import core.pricecache as pricecache
+import core.utility as utility
+
+
+"""
+Fixtures shared by the tests
+"""
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """
+    Point the quotes storage and all the data derived from it (catalog, price cache, incremental
+    states, roll calendars) to a temporary directory
+    :return: the temporary directory
+    """
+    monkeypatch.setattr(hdfstore, 'hdf_path', str(tmp_path / 'quotes'))
+    for module in (catalog, pricecache, incremental, utility):
+        monkeypatch.setattr(module, 'cache_path', str(tmp_path / 'cache'))
+    return tmp_path
@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+
+
+"""
+Synthetic quotes shared by the tests and benchmark.py. The prices are drawn from the global
+NumPy random state, seed it for reproducible data.
+"""
+
+
+def random_contract(contract, length=500):
+    """Synthetic daily quotes for a single contract in the provider download format"""
+    year, month = divmod(contract, 100)
+    dates = pd.bdate_range(end=pd.Timestamp(year, month, 1), periods=length)
+    close = 100 + np.random.randn(length).cumsum()
+    return pd.DataFrame({'date': dates, 'contract': contract, 'close': close, 'high': close + 1,
+                         'low': close - 1, 'open': close, 'volume': np.random.randint(0, 1000, length)})
+
+
+def synthetic_contracts(instrument, first_year=1980):
+    """Synthetic close prices for the traded contracts of an instrument, a year of data each"""
+    now = pd.Timestamp.now()
+    frames = [random_contract(y * 100 + m, length=260)
+              for y in range(first_year, now.year + 2) for m in instrument.trade_only]
+    return pd.concat(frames).set_index(['contract', 'date']).sort_index()
@@ -0,0 +1,59 @@
+import pickle
+import numpy as np
+import pandas as pd
+import config.settings
+from core.contract_store import Store, QuotesType
+from core.currency import Currency, cross_rate
+from core.instrument import Instrument
+
+
+"""
+Tests of the currency rates (core.currency): the cross rates through the base currency and the
+shared Currency objects of the registry
+"""
+
+
+def write_rate(code, start, periods, seed):
+    """Write synthetic rates of a pair to its Quandl store"""
+    rs = np.random.RandomState(seed)
+    data = pd.DataFrame({'date': pd.bdate_range(start, periods=periods),
+                         'rate': 1 + rs.rand(periods)})
+    Store('quandl', QuotesType.currency, 'CURRFX_' + code).update(data)
+    return data.set_index('date')['rate']
+
+
+def test_cross_rate():
+    numerator = pd.Series([2., 4., 8.], index=pd.to_datetime(['2015-01-01', '2015-01-02',
+                                                              '2015-01-05']))
+    denominator = pd.Series([1., 2.], index=pd.to_datetime(['2014-12-31', '2015-01-05']))
+    # the last rate is carried forward, the dates before the first rate of both are dropped
+    pd.testing.assert_series_equal(cross_rate(numerator, denominator), pd.Series(
+        [2., 4., 4.], index=pd.to_datetime(['2015-01-01', '2015-01-02', '2015-01-05'])),
+        check_freq=False)
+    pd.testing.assert_series_equal(cross_rate(numerator, 1), numerator)
+    pd.testing.assert_series_equal(cross_rate(1, denominator), 1 / denominator)
+
+
+def test_currency_cross_rate(storage):
+    base = config.settings.base_currency
+    usd = write_rate('USD' + base, '2015-01-01', 100, 0)
+    chf = write_rate('CHF' + base, '2015-01-05', 100, 1)
+    currency = Currency.get('USDCHF')
+    assert currency.cross == ('USD' + base, 'CHF' + base)
+    expected = cross_rate(usd, chf)
+    pd.testing.assert_series_equal(currency.rate(), expected.rename('rate'), check_freq=False,
+                                   check_index_type=False)
+    # a write of one of the pairs changes the cross rate
+    usd = write_rate('USD' + base, '2015-01-01', 120, 2)
+    assert len(currency.rate()) == len(cross_rate(usd, chf))
+    assert Currency.get(base * 2).rate() == 1
+
+
+def test_currency_pickle():
+    base = config.settings.base_currency
+    currency = Currency.get('USD' + base)
+    assert Currency.get('USD' + base) is currency
+    # restored from the registry, the definitions with lambdas aren't pickled
+    assert pickle.loads(pickle.dumps(currency)) is currency
+    inst = Instrument.load(['corn'])['corn']
+    assert pickle.loads(pickle.dumps(inst)).currency is inst.currency
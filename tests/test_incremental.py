@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import config.settings
+import core.incremental as incremental
+import trading.rules
+from core.contract_store import Store, QuotesType
+from core.instrument import Instrument
+from tests.synthetic import synthetic_contracts
+
+
+"""
+Tests of the incremental updates (core.incremental) against the full calculation, on synthetic
+contracts written to a temporary storage.
+"""
+
+
+def corn(**kw):
+    """
+    The corn instrument with a few rules in the base currency (no exchange rate is needed), the
+    definition overridden with kw
+    """
+    spec = {'name': 'corn', 'denomination': config.settings.base_currency,
+            'rules': ('ewmac', 'breakout', 'carry_next'),
+            'weights': {r: 1.0 for r in ('ewmac8', 'ewmac16', 'ewmac32', 'ewmac64', 'carry_next')}}
+    spec.update(kw)
+    return Instrument.from_spec(spec)
+
+
+def setup_instrument(**kw):
+    """
+    Write synthetic contracts of corn until 60 business days ago
+    :param kw: overrides of the definition, see corn()
+    :return: (instrument, store, quotes DataFrame, dates of the quotes)
+    """
+    np.random.seed(0)
+    inst = corn(**kw)
+    data = synthetic_contracts(inst, first_year=2005).reset_index()
+    data['open'] = data['close']
+    data = data[data['date'] <= pd.Timestamp.now().normalize()]
+    store = Store('quandl', QuotesType.futures, inst.quandl_database + '_' + inst.quandl_symbol)
+    dates = np.sort(data['date'].unique())
+    store.update(data[data['date'] <= dates[-60]])
+    return inst, store, data, dates
+
+
+def assert_matches_full(inst, state):
+    diff = inst.check_incremental()
+    assert (diff < 1e-9).all(), diff
+    pd.testing.assert_series_equal(state.panama, inst.panama_prices())
+    pd.testing.assert_series_equal(state.market, inst.market_price())
+
+
+def test_update_matches_full(storage):
+    inst, store, data, dates = setup_instrument()
+    length = len(inst.incremental_state().panama)
+    for first, last in [(-59, -59), (-58, -50), (-49, -1)]:
+        store.update(data[(data['date'] >= dates[first]) & (data['date'] <= dates[last])])
+        state = inst.incremental_state()
+        assert len(state.panama) == length + last + 60
+    assert_matches_full(inst, state)
+
+
+def test_revision_rebuilds(storage):
+    inst, store, data, dates = setup_instrument()
+    inst.incremental_state()
+    revised = data[(data['date'] >= '2015-01-01') & (data['date'] <= '2019-12-31')]
+    store.update(revised.assign(close=revised['close'] + 20))
+    store.update(data[data['date'] > dates[-60]])
+    assert_matches_full(inst, inst.incremental_state())
+
+
+def test_config_change_rebuilds(storage):
+    inst, store, data, dates = setup_instrument()
+    inst.incremental_state()
+    assert incremental.load(inst) is not None
+    inst = corn(roll_day=inst.roll_day + 1)
+    assert incremental.load(inst) is None
+    store.update(data[data['date'] > dates[-60]])
+    assert_matches_full(inst, inst.incremental_state())
+
+
+def test_calculate_from_state(storage):
+    inst, store, data, dates = setup_instrument()
+    inst.incremental = True
+    inst.calculate()
+    store.update(data[data['date'] > dates[-60]])
+    inst.cache_clear()
+    result = inst.calculate()
+    # the prices of the whole history aren't loaded
+    assert not {'contracts', 'quotes', 'price_matrix', 'panama_prices'} & set(inst.cache_info())
+    inst.incremental = False
+    expected = inst.calculate()
+    for k in ('panama_prices', 'market_price', 'roll_progression'):
+        pd.testing.assert_series_equal(result[k], expected[k])
+    pd.testing.assert_series_equal(result['position'], expected['position'])
+
+
+def test_carry_matches_rules(storage):
+    # quarterly contracts, the next contract is quoted together with the held one
+    inst, store, data, dates = setup_instrument(
+        trade_only=(3, 6, 9, 12), rules=('carry_next', 'carry_prev'),
+        weights={'carry_next': 1.0, 'carry': 1.0})
+    state = inst.incremental_state()
+    for r in ('carry_next', 'carry_prev'):
+        assert state.outputs[r].notnull().any()
+        pd.testing.assert_series_equal(state.outputs[r], getattr(trading.rules, r)(inst))
+    store.update(data[data['date'] > dates[-60]])
+    assert_matches_full(inst, inst.incremental_state())
@@ -0,0 +1,114 @@
+from collections import deque
+import numpy as np
+import pandas as pd
+import pytest
+import config.settings
+from core.contract_store import Store, QuotesType
+from core.instrument import Instrument
+from tests.synthetic import random_contract, synthetic_contracts
+
+
+"""
+Tests of the Instrument methods on synthetic contracts written to a temporary storage
+"""
+
+
+def write_contracts(inst, seed=0, first_year=2005):
+    """
+    Write synthetic contracts of the instrument until today
+    :return: (store, quotes DataFrame)
+    """
+    np.random.seed(seed)
+    data = synthetic_contracts(inst, first_year=first_year).reset_index()
+    data = data[data['date'] <= pd.Timestamp.now().normalize()]
+    store = Store('quandl', QuotesType.futures, inst.quandl_database + '_' + inst.quandl_symbol)
+    store.update(data)
+    return store, data
+
+
+def test_latest_price_date(storage):
+    # no exchange rate is needed in the base currency
+    inst = Instrument.from_spec({'name': 'corn', 'denomination': config.settings.base_currency,
+                                 'rules': ('ewmac',)})
+    store, data = write_contracts(inst)
+    current = inst.roll_progression().iloc[-1]
+    last = data[data['contract'] == current]['date'].max()
+    # the last quote of the held contract has no trading activity
+    store.update(pd.DataFrame({'contract': [current], 'date': [last], 'close': [100.],
+                               'open': [0.], 'volume': [1]}))
+    assert inst.latest_price_date() == inst.panama_prices().index[-1] < last
+    v = inst.validate()
+    assert v['latest_price_date'] == v['panama_date']
+    assert v['vol'] > 0
+
+
+def test_term_structure(storage):
+    inst = Instrument.load(['corn'])['corn']
+    write_contracts(inst)
+    date = inst.panama_prices().index[-300]
+    expected = inst.contracts(active_only=False, columns=None).xs(date, level='date')
+    pd.testing.assert_frame_equal(inst.term_structure(date), expected)
+    assert {'close', 'open', 'high', 'low', 'volume'} <= set(inst.term_structure().columns)
+
+
+def baseline_next_contract(contract, months, reverse=False):
+    """The single contract version replaced by Instrument.next_contracts()"""
+    rot = 1 if reverse else -1
+    m_idx = 0 if reverse else -1
+    d = pd.to_datetime(str(contract), format='%Y%m')
+    months_traded = deque(months)
+    months_traded.rotate(rot)
+    output_month = months_traded[months.index(d.month)]
+    output_year = d.year + (d.month == months[m_idx]) * (-rot)
+    return int(str(output_year) + str("%02d" % (output_month,)))
+
+
+@pytest.mark.parametrize('months', [[12], [3, 12], [3, 6, 9, 12], [1, 3, 5, 7, 8, 9, 11],
+                                    list(range(1, 13))])
+def test_next_contracts(months):
+    inst = Instrument.load(['corn'])['corn']
+    contracts = np.array([y * 100 + m for y in range(1998, 2003) for m in months])
+    for reverse in (False, True):
+        expected = [baseline_next_contract(c, months, reverse=reverse) for c in contracts]
+        result = inst.next_contracts(contracts, months=months, reverse=reverse)
+        assert result.tolist() == expected
+        assert inst.next_contract(contracts[0], months=months, reverse=reverse) == expected[0]
+    with pytest.raises(ValueError):
+        inst.next_contracts([199802], months=[3, 12])
+
+
+def test_contracts_masks(storage):
+    inst = Instrument.load(['corn'])['corn']
+    inst.backtest_from_year = 2012
+    np.random.seed(0)
+    now = pd.Timestamp.now()
+    data = pd.concat([random_contract(y * 100 + m, length=260)
+                      for y in range(2010, now.year + 1) for m in inst.months_traded])
+    # quotes without trading activity
+    data.loc[data.sample(frac=0.1, random_state=0).index, 'open'] = 0
+    data.loc[data.sample(frac=0.1, random_state=1).index, 'volume'] = 1
+    Store('quandl', QuotesType.futures, 'CME_C').update(data)
+    full = data.set_index(['contract', 'date']).sort_index().astype('float64')
+    full = full[full.index.get_level_values('contract') >= 201200]
+    contract = full.index.get_level_values('contract')
+    date = full.index.get_level_values('date')
+    masks = {'active_only': (full['open'] > 0) & (full['volume'] > 1),
+             'trade_only': (contract % 100).isin(inst.trade_only),
+             'recent_only': contract // 100 > now.year - 3,
+             'start': date >= '2015-01-01', 'end': date <= '2018-06-30'}
+    variants = [{}, {'active_only': False}, {'trade_only': False},
+                {'active_only': False, 'trade_only': False, 'recent_only': True},
+                {'start': '2015-01-01', 'end': '2018-06-30'},
+                {'active_only': False, 'start': '2015-01-01', 'columns': None}]
+    for kw in variants:
+        options = dict(dict(active_only=True, trade_only=True, start=None, end=None), **kw)
+        mask = np.ones(len(full), dtype=bool)
+        for name, m in masks.items():
+            if options.get(name) not in (None, False):
+                mask &= np.asarray(m)
+        # the default columns, or all of them with columns=None
+        columns = list(full.columns) if 'columns' in kw else ['close', 'open', 'volume']
+        result = inst.contracts(**kw)
+        pd.testing.assert_frame_equal(result[columns], full[mask][columns],
+                                      check_index_type=False)
+        assert list(result.columns) == columns
@@ -0,0 +1,55 @@
+import pickle
+import numpy as np
+import pandas as pd
+import core.ipc as ipc
+from core.instrument import Instrument
+
+
+"""
+Tests of the transfer of instruments and results to the worker processes (core.ipc): the
+instrument specs and the packed pandas objects must survive the round trip through pickle.
+"""
+
+
+def round_trip(obj):
+    return pickle.loads(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def test_spec_round_trip():
+    for name, inst in sorted(Instrument.load(None).items()):
+        spec = round_trip(inst.to_spec())
+        assert spec == inst.to_spec()
+        copy = Instrument.from_spec(spec)
+        assert copy.to_spec() == spec
+        assert copy.weights.equals(inst.weights)
+        assert copy.currency.code == inst.currency.code
+        assert hasattr(copy, 'spot') == hasattr(inst, 'spot')
+
+
+def test_spec_overrides():
+    inst = Instrument.load(['corn'])['corn']
+    inst.roll_day, inst.trade_only, inst.rules = 3, (3, 12), ('ewmac', 'carry_next')
+    name, spec = ipc._call((inst.to_spec(), 'to_spec', {}))
+    assert name == 'corn' and spec == inst.to_spec()
+    copy = Instrument.from_spec(spec)
+    assert (copy.roll_day, copy.trade_only, copy.rules) == (3, (3, 12), ('ewmac', 'carry_next'))
+
+
+def test_pack_round_trip():
+    # the dates read from the storage have no frequency
+    dates = pd.DatetimeIndex(pd.bdate_range('2000-01-03', periods=50).values, name='date')
+    rs = np.random.RandomState(0)
+    series = pd.Series(rs.randn(50), index=dates, name='panama')
+    frame = pd.DataFrame(rs.randn(50, 3), index=dates, columns=['ewmac8', 'ewmac16', 'carry'])
+    quotes = pd.DataFrame({'close': rs.randn(100)}, index=pd.MultiIndex.from_product(
+        [[201503, 201506], dates], names=['contract', 'date']))
+    result = {'panama_prices': series, 'forecasts': frame,
+              'other': (quotes, pd.Series([1., 2.]), 'text', 1.5)}
+    packed = round_trip(ipc.pack(result))
+    assert isinstance(packed['forecasts'], ipc.Packed)
+    unpacked = ipc.unpack(packed)
+    pd.testing.assert_series_equal(unpacked['panama_prices'], series)
+    pd.testing.assert_frame_equal(unpacked['forecasts'], frame)
+    pd.testing.assert_frame_equal(unpacked['other'][0], quotes)
+    pd.testing.assert_series_equal(unpacked['other'][1], pd.Series([1., 2.]))
+    assert unpacked['other'][2:] == ('text', 1.5)
@@ -0,0 +1,54 @@
+import pickle
+import pandas as pd
+import core.memo as memo
+from core.memo import memoize
+from core.instrument import Instrument
+from tests.test_instrument import write_contracts
+
+
+"""
+Tests of the per-instance memoization (core.memo) and of its invalidation by the data version
+"""
+
+
+class Source(object):
+    def __init__(self):
+        self.version = 0
+        self.calls = 0
+
+    def data_version(self):
+        return self.version
+
+    @memoize
+    def value(self, x=1):
+        self.calls += 1
+        return self.version * x
+
+
+def test_memoize():
+    a, b = Source(), Source()
+    b.version = 1
+    assert (a.value(), a.value(), a.value(x=2), b.value()) == (0, 0, 0, 1)
+    assert (a.calls, b.calls) == (2, 1)
+    assert memo.info(a)['value'] == memo.CacheInfo(1, 2, 2)
+    # a write changes the version, all the results of the object are dropped
+    a.version = 2
+    assert a.value() == 2 and a.calls == 3
+    assert memo.info(a)['value'].currsize == 1
+    # the cache isn't pickled with the object
+    assert memo.info(pickle.loads(pickle.dumps(a))) == {}
+    memo.clear(a)
+    assert memo.info(a) == {}
+
+
+def test_instrument_invalidated_by_write(storage):
+    inst = Instrument.load(['corn'])['corn']
+    store, data = write_contracts(inst, first_year=2010)
+    before = inst.panama_prices()
+    assert inst.panama_prices() is before
+    # the last prices are revised
+    last = data[data['date'] > data['date'].max() - pd.Timedelta(days=30)]
+    store.update(last.assign(close=last['close'] + 1))
+    after = inst.panama_prices()
+    assert not after.equals(before)
+    pd.testing.assert_series_equal(after, Instrument.load(['corn'])['corn'].panama_prices())
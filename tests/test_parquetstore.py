@@ -0,0 +1,73 @@
+import pandas as pd
+import pytest
+import core.parquetstore as parquetstore
+from tests.test_store import random_quotes, updates
+
+
+"""
+Tests of the Parquet storage (a file per contract), on synthetic quotes written to a temporary
+directory
+"""
+
+
+@pytest.fixture
+def parquet(tmp_path, monkeypatch):
+    monkeypatch.setattr(parquetstore, 'parquet_path', str(tmp_path / 'parquet'))
+
+
+def expected_quotes(frames):
+    # the last write of every row wins
+    data = pd.concat(frames).drop_duplicates(['contract', 'date'], keep='last')
+    # the dates are read back in nanoseconds
+    data['date'] = data['date'].astype('datetime64[ns]')
+    return data.set_index(['contract', 'date']).sort_index().astype('float64')
+
+
+def test_write_read_round_trip(parquet):
+    frames = updates()
+    for data in frames:
+        parquetstore.write_data(data, 'TEST_X', 'futures', 'quandl')
+    data = parquetstore.read_symbol('TEST_X', 'futures', 'quandl')
+    pd.testing.assert_frame_equal(data, expected_quotes(frames), check_like=True)
+    # the rows returned by the write are the stored contracts
+    rows, replaced = parquetstore.write_data(frames[-1], 'TEST_X', 'futures', 'quandl')
+    assert replaced is None
+    pd.testing.assert_frame_equal(rows.sort_index(), data.loc[[201509]], check_like=True)
+
+
+def test_column_projection(parquet):
+    parquetstore.write_data(random_quotes([201503, 201506], '2014-06-02', 100, 0), 'TEST_X',
+                            'futures', 'quandl')
+    data = parquetstore.read_symbol('TEST_X', 'futures', 'quandl')
+    close = parquetstore.read_symbol('TEST_X', 'futures', 'quandl', columns=['close'])
+    assert list(close.columns) == ['close']
+    pd.testing.assert_frame_equal(close, data[['close']])
+
+
+def test_filters(parquet):
+    parquetstore.write_data(random_quotes([201503, 201506, 201509], '2014-06-02', 100, 0),
+                            'TEST_X', 'futures', 'quandl')
+    data = parquetstore.read_symbol('TEST_X', 'futures', 'quandl')
+    dates = data.index.get_level_values('date')
+    selected = parquetstore.read_symbol('TEST_X', 'futures', 'quandl', start='2014-07-01',
+                                        end='2014-07-31', contracts=[201503, 201509])
+    pd.testing.assert_frame_equal(selected, data[
+        data.index.get_level_values('contract').isin([201503, 201509]) &
+        (dates >= '2014-07-01') & (dates <= '2014-07-31')])
+    pd.testing.assert_frame_equal(
+        parquetstore.read_symbol('TEST_X', 'futures', 'quandl', contracts=slice(201506, None)),
+        data.loc[201506:])
+    contract = parquetstore.read_contract('TEST_X', 201506, 'quandl', start='2014-07-01',
+                                          end='2014-07-31')
+    pd.testing.assert_frame_equal(contract, data.loc[201506].loc['2014-07-01':'2014-07-31'])
+
+
+def test_missing_contract(parquet):
+    parquetstore.write_data(random_quotes([201503], '2014-06-02', 100, 0), 'TEST_X', 'futures',
+                            'quandl')
+    stored = parquetstore.read_contract('TEST_X', 201503, 'quandl')
+    missing = parquetstore.read_contract('TEST_X', 201506, 'quandl')
+    assert missing.empty
+    pd.testing.assert_frame_equal(missing, stored.iloc[:0])
+    # no quotes of the symbol at all
+    assert parquetstore.read_contract('TEST_Y', 201503, 'quandl').empty
@@ -1,12 +1,16 @@
+import pandas as pd
 import trading.portfolio as portfolio
 import trading.accountcurve as accountcurve
 import config.portfolios
 import config.settings
+from tests.test_currency import write_rate
+from tests.test_instrument import write_contracts
 
 
 """
 Set of basic tests for portfolio.
-Should pass only if historical data are downloaded and up to date.
+Should pass only if historical data are downloaded and up to date, except the tests on synthetic
+data in a temporary storage.
 """
 
 
@@ -27,3 +31,21 @@ def test_frontier():
     p = portfolio.Portfolio(instruments=config.portfolios.p_trade)
     f = p.frontier()
     assert not f.empty
+
+
+def test_validate_fast(storage):
+    p = portfolio.Portfolio(instruments=['corn'])
+    inst = p.instruments['corn']
+    # all the months, the carry rules need the quotes of the next contract
+    inst.trade_only = inst.months_traded
+    write_contracts(inst)
+    write_rate(inst.currency.code, '2005-01-03',
+               len(pd.bdate_range('2005-01-03', pd.Timestamp.now())), 0)
+    fast = p.validate(fast=True)
+    # a single instrument is validated in this process, only the trailing window was loaded
+    assert 'contracts' not in inst.cache_info()
+    full = p.validate()
+    assert fast['is_valid'].all() and full['is_valid'].all() and not p.inst_blacklist
+    columns = ['latest_price_date', 'panama_date', 'price_age', 'panama_age', 'currency_age']
+    pd.testing.assert_frame_equal(fast[columns], full[columns])
+    assert fast.loc['corn', 'vol'] > 0
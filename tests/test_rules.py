@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+from core.utility import ewm_mean, rolling_extrema, RollingExtrema
+import core.normalization as normalization
+import trading.rules
+from trading.rules import ewmac_batch, pickleable_ewmac, breakout_batch, breakout_fn
+
+
+"""
+Tests of the vectorized rule kernels against the pandas implementations and of the rule registry,
+on synthetic prices.
+"""
+
+
+def random_prices(start, periods, seed):
+    rs = np.random.RandomState(seed)
+    return pd.Series(100 + rs.randn(periods).cumsum(),
+                     index=pd.bdate_range(start, periods=periods, name='date'))
+
+
+def assert_equal_forecasts(a, b):
+    assert a.index.equals(b.index)
+    assert (a.isnull() == b.isnull()).all()
+    np.testing.assert_allclose(a.dropna().values, b.dropna().values, rtol=1e-9, atol=1e-9)
+
+
+def test_ewm_mean():
+    values = random_prices('2000-01-03', 1000, 0).values.reshape(-1, 2).copy()
+    values[:10, 0] = np.nan
+    values[100:120, 1] = np.nan
+    for span in (2, 8, 256):
+        expected = pd.DataFrame(values).ewm(span=span).mean().values
+        np.testing.assert_allclose(ewm_mean(values, span), expected, rtol=1e-9, atol=1e-9)
+
+
+def test_ewmac_batch_single():
+    d = random_prices('1990-01-01', 3000, 1)
+    periods = [8, 16, 32, 64]
+    f = ewmac_batch(d.to_frame('price'), periods)['price']
+    assert list(f.columns) == ['ewmac8', 'ewmac16', 'ewmac32', 'ewmac64']
+    for x in periods:
+        assert_equal_forecasts(f['ewmac%d' % x], pickleable_ewmac(d, x).rename('ewmac%d' % x))
+
+
+def test_ewmac_batch_instruments():
+    # instruments with different date ranges and missing dates
+    prices = {'a': random_prices('1990-01-01', 3000, 2),
+              'b': random_prices('1995-06-01', 1500, 3).drop(pd.bdate_range('1996-01-01', '1996-03-01')),
+              'c': random_prices('1992-01-01', 100, 4)}
+    periods = [2, 4, 8, 16, 32, 64]
+    f = ewmac_batch(pd.DataFrame(prices), periods, prefix='mr')
+    assert sorted(f.keys()) == ['a', 'b', 'c']
+    for k, d in prices.items():
+        for x in periods:
+            assert_equal_forecasts(f[k]['mr%d' % x], pickleable_ewmac(d, x).rename('mr%d' % x))
+
+
+def test_rolling_extrema():
+    prices = random_prices('1990-01-01', 3000, 6)
+    prices.iloc[[3, 40, 41, 42, 500]] = np.nan
+    lookbacks, min_periods = [1, 2, 3, 40, 80, 160, 320, 5000], [1, 1, 2, 20, 40, 80, 160, 10]
+    expected = [np.column_stack([getattr(prices.rolling(x, min_periods=m), fn)()
+                                 for x, m in zip(lookbacks, min_periods)]) for fn in ('min', 'max')]
+    for result in rolling_extrema(prices.values, lookbacks, min_periods), \
+            rolling_extrema(prices.values[:30], lookbacks, min_periods):
+        for r, e in zip(result, expected):
+            np.testing.assert_array_equal(r, e[:len(r)])
+    # streaming, from the history and then in steps
+    extrema = RollingExtrema(lookbacks, min_periods)
+    steps = [extrema.start(prices.values[:1000])] + \
+        [extrema.update(prices.values[i:i + 7]) for i in range(1000, 3000, 7)]
+    for j in range(2):
+        np.testing.assert_array_equal(np.vstack([s[j] for s in steps]), expected[j])
+
+
+def test_breakout_batch():
+    prices = random_prices('1990-01-01', 3000, 7)
+    lookbacks = list(range(10, 330, 10))
+    f = breakout_batch(prices, lookbacks)
+    assert list(f.columns) == ['brk%d' % x for x in lookbacks]
+    for x in lookbacks:
+        assert_equal_forecasts(f['brk%d' % x], breakout_fn(prices, x).rename('brk%d' % x))
+
+
+class PricesInstrument(object):
+    """Instrument with the panama prices only, counting the calls"""
+    name = 'test'
+
+    def __init__(self, prices):
+        self.prices = prices
+        self.calls = 0
+
+    def panama_prices(self):
+        self.calls += 1
+        return self.prices
+
+
+def test_evaluate_shares_intermediates():
+    inst = PricesInstrument(random_prices('1990-01-01', 2000, 5))
+    rules = ['ewmac', 'mr', 'breakout', 'buy_and_hold']
+    assert trading.rules.dependencies(rules) == ['norm_prices', 'panama_prices']
+    forecasts = trading.rules.evaluate(inst, rules)
+    assert inst.calls == 1
+    for r, f in zip(rules, forecasts):
+        assert f.equals(getattr(trading.rules, r)(inst))
+
+
+def test_resample_scalar():
+    prices = random_prices('2000-01-03', 3000, 0)
+    counts = normalization.resample_counts(len(prices))
+    # the cached counts are small integers
+    assert counts.dtype == np.uint8
+    # the same statistic as the mean over the explicit resamples
+    idx = normalization.resample_indices(len(prices))
+    expected = np.mean([prices.values[i].std(ddof=1) for i in idx])
+    np.testing.assert_allclose(normalization.scalar(prices, 'std', method='resample'), expected,
+                               rtol=1e-9)
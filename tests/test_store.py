@@ -0,0 +1,157 @@
+import threading
+import numpy as np
+import pandas as pd
+import core.catalog as catalog
+import core.hdfstore as hdfstore
+import core.pricecache as pricecache
+import core.schema as schema
+from core.contract_store import Store, QuotesType
+from core.fileutil import file_lock
+
+
+"""
+Tests of the HDF storage (append-only table files and their compaction) and of the catalog of
+the stored data, on synthetic quotes written to a temporary directory.
+"""
+
+
+def random_quotes(contracts, start, periods, seed):
+    rs = np.random.RandomState(seed)
+    dates = pd.bdate_range(start, periods=periods)
+    return pd.concat([pd.DataFrame({'contract': c, 'date': dates,
+                                    'close': (100 + rs.randn(periods).cumsum()).round(2),
+                                    'open': (100 + rs.randn(periods).cumsum()).round(2),
+                                    'volume': rs.randint(0, 1000, periods)})
+                      for c in contracts], ignore_index=True)
+
+
+def updates():
+    """Sequence of writes with new contracts, new dates and revisions of the stored rows"""
+    frames = [random_quotes([201503, 201506], '2014-06-02', 100, 0),
+              random_quotes([201506, 201509], '2014-09-01', 100, 1),
+              random_quotes([201503], '2014-07-01', 20, 2)]
+    frames += [random_quotes([201509], pd.Timestamp('2015-01-01') + pd.Timedelta(days=i), 1, i)
+               for i in range(10)]
+    return frames
+
+
+def setup_store(monkeypatch, compact_after=4):
+    monkeypatch.setattr(hdfstore, 'hdf_compact_after', compact_after)
+    return Store('quandl', QuotesType.futures, 'TEST_X')
+
+
+def test_append_matches_single_write(storage, monkeypatch):
+    store = setup_store(monkeypatch)
+    frames = updates()
+    for data in frames:
+        store.update(data)
+    # the last write of every row wins
+    expected = pd.concat(frames).drop_duplicates(['contract', 'date'], keep='last')
+    hdfstore.write_data(expected, 'TEST_Y', 'futures', 'quandl')
+    appended = store.get()
+    pd.testing.assert_frame_equal(appended, hdfstore.read_symbol('TEST_Y', 'futures', 'quandl'))
+    assert len(appended) == len(expected)
+    # compacted after every 4 appends
+    with pd.HDFStore(hdfstore.fname('TEST_X', 'futures', 'quandl'), mode='r') as f:
+        assert f.get_storer('quotes').attrs.appends == (len(frames) - 1) % 4
+    hdfstore.compact('TEST_X', 'futures', 'quandl')
+    pd.testing.assert_frame_equal(store.get(), appended)
+
+
+def test_read_contract(storage, monkeypatch):
+    store = setup_store(monkeypatch)
+    store.update(random_quotes([201503, 201506], '2014-06-02', 100, 0))
+    data = store.get_contract(201503, start='2014-07-01', end='2014-07-31')
+    pd.testing.assert_frame_equal(
+        data, store.get().loc[201503].loc['2014-07-01':'2014-07-31'])
+    empty = store.get_contract(201503, start='2016-01-01')
+    assert empty.empty and list(empty.columns) == list(data.columns)
+
+
+def test_file_lock(tmp_path):
+    path, events = str(tmp_path / 'TEST_X.h5'), []
+
+    def locked(event, shared):
+        with file_lock(path, shared=shared):
+            events.append(event)
+
+    with file_lock(path, shared=True):
+        # the readers don't block each other
+        reader = threading.Thread(target=locked, args=('read', True))
+        reader.start()
+        reader.join(5)
+        assert events == ['read']
+        writer = threading.Thread(target=locked, args=('write', False))
+        writer.start()
+        writer.join(0.2)
+        assert events == ['read']
+    writer.join(5)
+    assert events == ['read', 'write']
+
+
+def test_catalog(storage, monkeypatch):
+    store = setup_store(monkeypatch)
+    for data in updates():
+        store.update(data)
+    # the last date of a contract is revised to a quote without trading activity
+    last = store.catalog().loc[201509, 'last_date']
+    store.update(pd.DataFrame({'contract': [201509], 'date': [last], 'close': [1.], 'open': [0.],
+                               'volume': [1]}))
+    # the catalog is updated from the written rows and not rebuilt from the storage
+    assert catalog._load(store)['version'] == store.version()
+    entries = store.catalog()
+    rebuilt = catalog._to_frame(catalog._stats(store.get()))
+    pd.testing.assert_frame_equal(entries, rebuilt)
+    assert entries.loc[201509, 'last_active'] < entries.loc[201509, 'last_date']
+    assert entries['rows'].sum() == len(store.get())
+
+
+def test_catalog_version(storage, monkeypatch):
+    store = setup_store(monkeypatch)
+    store.update(random_quotes([201503], '2014-06-02', 100, 0))
+    # written without updating the catalog, the next update doesn't build on the outdated entries
+    hdfstore.write_data(random_quotes([201506], '2014-06-02', 50, 1), 'TEST_X', 'futures',
+                        'quandl')
+    store.update(random_quotes([201509], '2014-06-02', 10, 2))
+    pd.testing.assert_frame_equal(store.catalog(),
+                                  catalog._to_frame(catalog._stats(store.get())))
+    # the query rebuilds the outdated entries
+    hdfstore.write_data(random_quotes([201512], '2014-06-02', 20, 3), 'TEST_X', 'futures',
+                        'quandl')
+    assert list(store.catalog().index) == [201503, 201506, 201509, 201512]
+    assert store.catalog().loc[201512, 'rows'] == 20
+
+
+def test_legacy_conversion(storage, monkeypatch):
+    store = setup_store(monkeypatch)
+    # a file written before the compact schema, the values are stored in float64
+    legacy = random_quotes([201503], '2014-06-02', 10, 0).assign(close=404.4)
+    legacy.set_index(['contract', 'date']).to_hdf(
+        hdfstore.fname('TEST_X', 'futures', 'quandl'), key='quotes', format='t',
+        data_columns=True)
+    store.update(random_quotes([201506], '2014-06-02', 10, 1))
+    assert (store.get().loc[201503, 'close'] == 404.4).all()
+    assert hdfstore.stored_dtypes('TEST_X', 'futures', 'quandl')['close'] == 'float64'
+    # the values within the tolerance are only converted on request
+    monkeypatch.setattr(schema, 'convert_storage', True)
+    hdfstore.compact('TEST_X', 'futures', 'quandl')
+    assert hdfstore.stored_dtypes('TEST_X', 'futures', 'quandl')['close'] == 'float32'
+    np.testing.assert_allclose(store.get().loc[201503, 'close'], 404.4, rtol=1e-6)
+
+
+def test_price_cache_replaced_while_loading(storage, monkeypatch):
+    old = random_quotes([201503], '2014-06-02', 100, 0).set_index(['contract', 'date'])
+    new = random_quotes([201503, 201506], '2014-06-02', 100, 1).set_index(['contract', 'date'])
+    pricecache.save('TEST_X', 'v1', old)
+    mapped = pricecache._map
+
+    def replaced(d, index, columns):
+        # another process replaces the entry after the reader has read index.json
+        if index['version'] == 'v1':
+            pricecache.save('TEST_X', 'v2', new)
+        return mapped(d, index, columns)
+
+    monkeypatch.setattr(pricecache, '_map', replaced)
+    assert pricecache.load('TEST_X', 'v1') is None
+    pd.testing.assert_frame_equal(pricecache.load('TEST_X', 'v2'), new.astype('float64'),
+                                  check_index_type=False)
@@ -0,0 +1,110 @@
+import datetime
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import core.utility as utility
+from core.utility import generate_roll_progression, date_to_contract, panama_stitch
+from tests.synthetic import random_contract
+
+
+"""
+Tests of the vectorized helpers of core.utility against the loops they replaced
+"""
+
+
+def baseline_roll_progression(roll_day, months, roll_shift):
+    """The day by day roll calendar generator replaced by generate_roll_progression()"""
+    rolls = []
+    for year in range(1960, datetime.datetime.now().year + 5):
+        rolls.extend([datetime.datetime(year, k, abs(roll_day)) for k in months])
+    rolls = pd.Series(rolls, index=rolls, name='rolls').shift(-1)
+    dates = pd.date_range(start='1960-01-01',
+                          end=datetime.datetime.now() + pd.DateOffset(years=10))
+    a = pd.Series(0, index=dates).to_frame().join(rolls).ffill().dropna()['rolls'].to_frame()
+    a['contract'] = a['rolls'].apply(date_to_contract)
+    a.index = a.index.rename('date')
+    b = a['contract']
+    if roll_day < 1:
+        b = b.shift(-30).dropna().apply(int)
+    if roll_shift != 0:
+        b = b.shift(roll_shift).dropna().apply(int)
+    return b[:datetime.datetime.now()]
+
+
+@pytest.mark.parametrize('roll_day, months, roll_shift', [
+    (15, (3, 6, 9, 12), 0), (-5, (12,), 0), (10, (1, 3, 5, 7, 9, 11), 45), (1, (6, 12), -20),
+    (-1, (3, 5, 7, 9, 12), -400)])
+def test_roll_progression(storage, roll_day, months, roll_shift):
+    pd.testing.assert_series_equal(generate_roll_progression(roll_day, months, roll_shift),
+                                   baseline_roll_progression(roll_day, months, roll_shift),
+                                   check_freq=False)
+
+
+def test_roll_calendar_cache(storage, monkeypatch):
+    key = (15, (3, 6, 9, 12), 0)
+    monkeypatch.setattr(utility, '_roll_calendars', {})
+    expected = generate_roll_progression(*key)
+    assert os.path.exists(utility._roll_calendar_fname(key))
+    # another process loads the persisted calendar instead of generating it
+    monkeypatch.setattr(utility, '_roll_calendars', {})
+    generate = utility._roll_calendar
+    monkeypatch.setattr(utility, '_roll_calendar', None)
+    pd.testing.assert_series_equal(generate_roll_progression(*key), expected)
+    # the calendars which don't reach today are generated again, in the process and on disk
+    monkeypatch.setattr(utility, '_roll_calendar', generate)
+    utility._roll_calendars[key] = expected[:'2000-01-01']
+    pd.testing.assert_series_equal(generate_roll_progression(*key), expected)
+    utility._save_roll_calendar(key, expected[:'2000-01-01'])
+    monkeypatch.setattr(utility, '_roll_calendars', {})
+    pd.testing.assert_series_equal(generate_roll_progression(*key), expected)
+    with open(utility._roll_calendar_fname(key), 'wb') as f:
+        f.write(b'corrupted')
+    monkeypatch.setattr(utility, '_roll_calendars', {})
+    pd.testing.assert_series_equal(generate_roll_progression(*key), expected)
+    assert utility._load_roll_calendar(key, datetime.datetime.now()) is not None
+
+
+def baseline_panama_stitch(close, roll_progression):
+    """The join based stitching replaced by panama_stitch()"""
+    return close.diff().to_frame().swaplevel().fillna(0).join(
+        roll_progression.to_frame().set_index('contract', append=True), how='inner').\
+        reset_index('contract', drop=True)['close'].cumsum()
+
+
+def stitch_inputs(contracts, seed=0):
+    """Close prices of synthetic contracts and a quarterly roll progression"""
+    np.random.seed(seed)
+    close = pd.concat([random_contract(c, length=260) for c in contracts]).\
+        set_index(['contract', 'date']).sort_index()['close']
+    return close, generate_roll_progression(15, (3, 6, 9, 12), 0)
+
+
+def assert_stitch_matches(close, rp):
+    expected = baseline_panama_stitch(close, rp)
+    result = panama_stitch(close, rp)
+    assert result.index.equals(pd.DatetimeIndex(expected.index, name='date'))
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-12, atol=1e-9)
+
+
+def test_panama_stitch():
+    close, rp = stitch_inputs([201503, 201506, 201509, 201512, 201603])
+    assert_stitch_matches(close, rp)
+
+
+def test_panama_stitch_gaps():
+    close, rp = stitch_inputs([201503, 201506, 201509, 201512, 201603])
+    # missing quotes and prices of the held contracts, a contract without quotes at all
+    dates = close.index.get_level_values('date')
+    close = close[~((dates >= '2015-04-01') & (dates <= '2015-04-15'))]
+    close[close.sample(frac=0.05, random_state=0).index] = np.nan
+    close = close.drop(201509, level='contract')
+    assert_stitch_matches(close, rp)
+
+
+def test_panama_stitch_single_contract():
+    close, rp = stitch_inputs([201506])
+    assert_stitch_matches(close, rp)
+    # no quotes on the dates the contract is held
+    close, rp = stitch_inputs([201503])
+    assert_stitch_matches(close[close.index.get_level_values('date') < '2014-12-01'], rp)
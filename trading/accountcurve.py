@@ -5,8 +5,7 @@ import pprint
 import config.settings
 import config.strategy
 from core.utility import chunk_trades, sharpe, drawdown
-from multiprocessing_on_dill import Pool #, Process, Manager
-from contextlib import closing
+from core.ipc import map_instruments
 
 
 class accountCurve():
@@ -55,11 +54,7 @@ class accountCurve():
         try:
             return self.memo_inst_calc
         except:
-            if len(self.portfolio)>1 and self.multiproc:
-                with closing(Pool()) as pool:
-                    self.memo_inst_calc = dict(pool.map(lambda x: (x.name, x.calculate()), self.portfolio))
-            else:
-                self.memo_inst_calc = dict(map(lambda x: (x.name, x.calculate()), self.portfolio))
+            self.memo_inst_calc = map_instruments(self.portfolio, 'calculate', multiproc=self.multiproc)
             return self.memo_inst_calc
 
     def instrument_positions(self):
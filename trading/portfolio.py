@@ -16,13 +16,15 @@ except ImportError:
     sys.exit()
     
 from core.instrument import Instrument
-from core.utility import draw_sample, sharpe
+from core.utility import draw_sample, sharpe, norm_vol, norm_forecast
+from trading.rules import ewmac_batch
 from trading.accountcurve import accountCurve
 import trading.bootstrap_portfolio as bp
 import seaborn
 import pyprind
 from multiprocessing_on_dill import Pool
 from contextlib import closing
+from core.ipc import map_instruments, imap_instruments
 from core.logger import get_logger
 logger = get_logger('portfolio')
 
@@ -32,8 +34,11 @@ class Portfolio(object):
     Portfolio is an object that is a group of instruments, with calculated positions based on the weighting and volatility target.
     """
 
-    def __init__(self, weights=1, instruments=None):
+    def __init__(self, weights=1, instruments=None, incremental=False):
         self.instruments = Instrument.load(instruments)
+        # extend the persisted results of the instruments on calculate(), see core.incremental
+        for i in self.instruments.values():
+            i.incremental = incremental
         self.weights = pd.Series(config.strategy.portfolio_weights)
         # remove weights for instruments that aren't in the portfolio
         self.weights = self.weights[self.weights.index.isin(instruments)]
@@ -60,19 +65,17 @@ class Portfolio(object):
 
 ### Utility Functions ###################################################################
 
-    def validate(self):
+    def validate(self, fast=False):
         """
         Runs Instrument.validate for every Instrument in the Portfolio and returns a DataFrame. Used for trading.
+        If fast, the instruments are validated on the last config.strategy.validation_days of prices.
         """
-        import concurrent.futures
         bar = pyprind.ProgBar(len(self.instruments.values()), title='Validating instruments')
-        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-            dl = {executor.submit(x.validate): x.name for x in self.instruments.values()}
-            d = {}
-            for fut in concurrent.futures.as_completed(dl):
-                bar.update(item_id=dl[fut])
-                d[dl[fut]] = fut.result()
-            d = pd.DataFrame(d).transpose()
+        d = {}
+        for name, result in imap_instruments(self.instruments.values(), 'validate', fast=fast):
+            bar.update(item_id=name)
+            d[name] = result
+        d = pd.DataFrame(d).transpose()
         # blacklist instruments that didn't pass validation
         self.inst_blacklist = d[d['is_valid'] == False].index.tolist()
         return d
@@ -91,9 +94,7 @@ class Portfolio(object):
         """
         Calculate the base positions for every instrument, before applying portfolio-wide weighting and volatility scaling.
         """
-        with closing(Pool()) as pool:
-            d = dict(pool.map(lambda x: (x.name, x.calculate()), self.valid_instruments().values()))
-        return d
+        return map_instruments(self.valid_instruments().values(), 'calculate')
 
     @lru_cache(maxsize=1)
     def panama_prices(self):
@@ -187,30 +188,32 @@ class Portfolio(object):
     def forecast_returns(self, **kw):
         """Get the returns for individual forecasts for each instrument, useful for bootstrapping
            forecast Sharpe ratios"""
-        with closing(Pool()) as pool:
-            d = dict(pool.map(lambda x: (x.name, x.forecast_returns(**kw).dropna()),
-                              self.valid_instruments().values()))
-        return d
+        d = map_instruments(self.valid_instruments().values(), 'forecast_returns', **kw)
+        return {k: v.dropna() for k, v in d.items()}
 
     @lru_cache(maxsize=1)
     def forecasts(self, **kw):
         """
         Returns a dict of forecasts for every Instrument in the Portfolio.
         """
-        with closing(Pool()) as pool:
-            d = dict(pool.map(lambda x: (x.name, x.forecasts(**kw)),
-                              self.valid_instruments().values()))
-        return d
+        return map_instruments(self.valid_instruments().values(), 'forecasts', **kw)
+
+    def ewmac_forecasts(self, periods=(8, 16, 32, 64)):
+        """
+        Returns a dict of the EWMAC forecasts for every Instrument in the Portfolio, the same as
+        trading.rules.ewmac() but calculated for all the instruments in one pass of
+        trading.rules.ewmac_batch() over the date x instrument price matrix.
+        """
+        prices = map_instruments(self.valid_instruments().values(), 'panama_prices')
+        d = pd.DataFrame({k: norm_vol(v, k) for k, v in prices.items()})
+        return {k: norm_forecast(v, k) for k, v in ewmac_batch(d, periods).items()}
 
     @lru_cache(maxsize=1)
     def weighted_forecasts(self, **kw):
         """
         Returns a dict of weighted forecasts for every Instrument in the Portfolio.
         """
-        with closing(Pool()) as pool:
-            d = dict(pool.map(lambda x: (x.name, x.weighted_forecast(**kw)),
-                              self.valid_instruments().values()))
-        return d
+        return map_instruments(self.valid_instruments().values(), 'weighted_forecast', **kw)
 
     @lru_cache(maxsize=1)
     def market_prices(self):
@@ -1,7 +1,95 @@
+import functools
 import numpy as np
 import pandas as pd
-from functools import partial
-from core.utility import norm_forecast, norm_vol
+from collections import namedtuple
+import config.strategy
+from core.utility import norm_forecast, norm_vol, ewm_mean, rolling_extrema
+
+"""
+Trading rules: functions returning the forecast of an instrument as pd.Series or pd.DataFrame.
+
+The rules are registered with the @rule decorator, which declares the intermediate results they
+consume (see intermediates). evaluate() calculates the forecasts of several rules of an instrument
+with a single RuleContext, so every intermediate result (e.g. the volatility normalised prices of
+ewmac and mr, the current and next contract prices of carry_next and carry_prev) is calculated
+once and fed to all the rules. The rules can still be called on their own, rule(inst), with a
+context of their own.
+"""
+Rule = namedtuple('Rule', ['name', 'fn', 'inputs'])
+# Lookbacks of the breakout rule in days, the forecast columns brk[lookback]
+breakout_lookbacks = tuple(getattr(config.strategy, 'breakout_lookbacks', (40, 80, 160, 320)))
+# Registered trading rules by name, see rule()
+registry = {}
+
+
+class RuleContext(object):
+    """
+    Intermediate results shared by the rules of an instrument, each calculated on the first
+    request. The results of the rules are kept too, so a rule used by another one (carry_next by
+    carry) is calculated once.
+    """
+    def __init__(self, inst):
+        self.inst = inst
+        self.results = {}
+
+    def __getitem__(self, name):
+        if name not in self.results:
+            self.results[name] = intermediates[name](self.inst, self)
+        return self.results[name]
+
+    def rule(self, name):
+        """Forecast of a registered rule"""
+        key = ('rule', name)
+        if key not in self.results:
+            self.results[key] = registry[name].fn(self.inst, self)
+        return self.results[key]
+
+
+def rule(*inputs):
+    """
+    Decorator registering a trading rule: fn(inst, context) where context is the RuleContext the
+    rule reads its inputs from
+    :param inputs: names of the intermediate results the rule consumes, see intermediates
+    """
+    def register(fn):
+        @functools.wraps(fn)
+        def wrapper(inst, context=None, **kw):
+            if kw:
+                # options of the rule (e.g. debug), the result isn't shared
+                return fn(inst, context or RuleContext(inst), **kw)
+            return (context or RuleContext(inst)).rule(fn.__name__)
+        registry[fn.__name__] = Rule(fn.__name__, fn, tuple(inputs))
+        return wrapper
+    return register
+
+
+def dependencies(rules):
+    """
+    Intermediate results consumed by the rules
+    :return: list of names, in the order of the first use
+    """
+    names = []
+    for r in rules:
+        for name in registry[str(r)].inputs if str(r) in registry else ():
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def evaluate(inst, rules, context=None):
+    """
+    Forecasts of the rules for an instrument, with the intermediate results calculated once
+    :param rules: rule names; functions of this module which are not registered are called as
+                  fn(inst)
+    :param context: RuleContext to share the intermediate results with, a new one if None
+    :return: list of the forecasts in the order of rules
+    """
+    context = context or RuleContext(inst)
+    for name in dependencies(rules):
+        context[name]
+    return [context.rule(str(r)) if str(r) in registry else globals()[str(r)](inst)
+            for r in rules]
+
 
 def pickleable_ewmac(d, x):
     """
@@ -9,83 +97,104 @@ def pickleable_ewmac(d, x):
     """
     return d.ewm(span = x, min_periods = x*4).mean() - d.ewm(span = x*4, min_periods=x*4).mean()
 
-def ewmac(inst, **kw):
+def ewmac_batch(prices, periods=(8, 16, 32, 64), prefix='ewmac'):
+    """
+    Exponentially weighted moving average crossovers of many series and periods in one pass.
+
+    Same as pickleable_ewmac() for every column of prices over its own dates (prices[c].dropna())
+    and every period. One recursive filter runs per distinct span for all the columns at once, and
+    the slow legs of the short periods are reused as the fast legs of the long ones (the spans 32
+    and 64 of the periods 8 and 16), so the default periods need 6 filters instead of 8.
+    :param prices: pd.DataFrame with a column per instrument, e.g. Portfolio.panama_prices()
+    :param periods: crossover periods, the slow leg span is 4 x the period
+    :param prefix: prefix of the column names
+    :return: dict {column: pd.DataFrame with the columns prefix + period, indexed by the column's dates}
+    """
+    values = prices.to_numpy(dtype='float64')
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=0)
+    if counts.min() < len(values):
+        # the values of every column are moved to the top rows, so the dates of the other columns
+        # don't decay its weights. The rows after them are filled with zeros and dropped.
+        order = np.argsort(~valid, axis=0, kind='stable')
+        values = np.take_along_axis(values, order, axis=0)
+        values[np.arange(len(values))[:, None] >= counts] = 0.
+    # the filters run along the dates of every column, faster on a column-major array
+    values = np.asfortranarray(values)
+    means = {s: ewm_mean(values, s) for s in sorted(set(periods) | {x * 4 for x in periods})}
+    # (columns, periods, dates), the forecasts of a column are a contiguous block
+    crossovers = np.empty((values.shape[1], len(periods), len(values)))
+    for k, x in enumerate(periods):
+        crossovers[:, k] = (means[x] - means[x * 4]).T
+        # min_periods of pickleable_ewmac()
+        crossovers[:, k, :x * 4 - 1] = np.nan
+    columns = [prefix + str(x) for x in periods]
+    result = {}
+    for j, c in enumerate(prices.columns):
+        n = counts[j]
+        index = prices.index if n == len(prices) else prices.index[order[:n, j]]
+        result[c] = pd.DataFrame(crossovers[j, :, :n].T, index=index, columns=columns, copy=False)
+    return result
+
+@rule('norm_prices')
+def ewmac(inst, context):
     """
     Exponentially weighted moving average crossover.
     
     Returns a DataFrame with four different periods.
     """
-    d = norm_vol(inst.panama_prices(**kw))
-    columns = [8, 16, 32, 64]
-    f = map(partial(pickleable_ewmac, d), columns)
-    f = pd.DataFrame(list(f)).transpose()
-    f.columns = pd.Series(columns).map(lambda x: "ewmac"+str(x))
-    return norm_forecast(f)
+    d = context['norm_prices']
+    f = ewmac_batch(d.to_frame('price'), [8, 16, 32, 64])['price']
+    return norm_forecast(f, inst.name)
 
-def mr(inst, **kw):
+@rule('norm_prices')
+def mr(inst, context):
     """
     Mean reversion.
     
     Never managed to make this profitable on futures, however it is presented here if you want to try it.
     """
-    d = norm_vol(inst.panama_prices(**kw))
-    columns = [2, 4, 8, 16, 32, 64]
-    f = map(partial(pickleable_ewmac, d), columns)
-    f = pd.DataFrame(list(f)).transpose() * -1
+    d = context['norm_prices']
+    f = ewmac_batch(d.to_frame('price'), [2, 4, 8, 16, 32, 64], prefix='mr')['price'] * -1
     f = f*10/f.abs().mean()
-    f.columns = pd.Series(columns).map(lambda x: "mr"+str(x))
     return f.clip(-20,20)
 
-def carry(inst, **kw):
+@rule()
+def carry(inst, context):
     """
     Generic carry function. 
     
     If the Instrument has a spot price series, use that for carry (carry_spot), otherwise use the next contract (carry_next)
     """
     if hasattr(inst, 'spot'):
-        return carry_spot(inst, **kw).rename('carry')
+        return context.rule('carry_spot').rename('carry')
     else:
-        return carry_next(inst, **kw).rename('carry')
+        return context.rule('carry_next').rename('carry')
 
-def carry_spot(inst, **kw):
+@rule('spot', 'market_price', 'time_to_expiry')
+def carry_spot(inst, context):
     """
     Calculates the carry between the current future price and the underlying spot price.
     """
-    f = inst.spot() - inst.market_price().reset_index('contract', drop=True)
-    f = f * 365 / inst.time_to_expiry()
-    return norm_forecast(f.ewm(90).mean()).rename('carry_spot')
+    f = context['spot'] - context['market_price']
+    f = f * 365 / context['time_to_expiry']
+    return norm_forecast(f.ewm(90).mean().rename('carry_spot'), inst.name)
 
-def carry_next(inst, debug=False, **kw):
+@rule('next_prices')
+def carry_next(inst, context, debug=False):
     """
     Calculates the carry between the current future price and the next contract we are going to roll to.
     """
     #    If not trading nearest contract,  Nearer contract price minus current contract price, divided by the time difference
     #    If trading nearest contract, Current contract price minus next contract price, divided by the time difference
-
-    current_contract = inst.roll_progression().to_frame().set_index('contract', append=True).swaplevel()
-    next_contract = inst.roll_progression().apply(inst.next_contract, months=inst.trade_only).to_frame().set_index('contract', append=True).swaplevel()
-
-    current_prices = inst.contracts(active_only=True).join(current_contract, how='inner')['close'].reset_index('contract')
-
-    next_prices = inst.contracts(active_only=True).join(next_contract, how='inner')['close'].reset_index('contract')
-
-    #Replace zeros with nan
-    next_prices[next_prices==0] = np.nan
+    current_prices, next_prices = context['next_prices']
 
     # Apply a ffill for low volume contracts
     # next_prices.ffill(inplace=True)
 
-    current_prices['contract'] = current_prices['contract'].apply(_get_month)
-    next_prices['contract'] = next_prices['contract'].apply(_get_month)
-    td = next_prices['contract'] - current_prices['contract']
-    td.loc[td<=0] = td.loc[td<=0] + 12
-    td = td/12
-    # Apply a 5 day mean to prices to stabilise signal
-    carry = (current_prices['close'] - next_prices['close'])
-
-    carry = carry.rolling(window=5).mean()/td
+    carry = _carry_raw(current_prices, next_prices)
 
-    f = norm_forecast(carry).ffill(limit=3)
+    f = norm_forecast(carry.rename('carry_next'), inst.name).ffill(limit=3)
 
     # if f.isnull().values.any():
     #     print(inst.name, "has some missing carry values")
@@ -93,53 +202,110 @@ def carry_next(inst, debug=False, **kw):
     if f.sum() == 0:
         print(inst.name  + ' carry is zero')
     if debug==True:
-        return f.rename('carry_next'), current_prices, next_prices, td
+        return f.rename('carry_next'), current_prices, next_prices, \
+            _contract_years(current_prices, next_prices)
     # return f.mean().rename('carry_next')
     return f.interpolate().rolling(window=90).mean().rename('carry_next')
 
-def carry_prev(inst, **kw):
+@rule('prev_prices')
+def carry_prev(inst, context):
     """
     Analogue of carry_next() but looks at the previous contract. Useful when not trading the nearest contract but one further one. Typically you'd do this for instruments where the near contract has deathly skew - e.g. Eurodollar or VIX.
     """
-    
-    current_contract = inst.roll_progression().to_frame().set_index('contract', append=True).swaplevel()
-    prev_contract = inst.roll_progression().apply(inst.next_contract, months=inst.trade_only,
-                            reverse=True).to_frame().set_index('contract', append=True).swaplevel()
-    current_prices = inst.contracts(active_only=True).join(current_contract, how='inner')['close'].reset_index('contract')
-    prev_prices = inst.contracts(active_only=True).join(prev_contract, how='inner')['close'].reset_index('contract')
+    current_prices, prev_prices = context['prev_prices']
+    carry = _carry_raw(current_prices, prev_prices, reverse=True)
+    f = norm_forecast(carry.rename('carry'), inst.name).ffill(limit=3)
+    if f.sum() == 0:
+        print(inst.name + ' carry is zero')
+    return f.interpolate().rolling(window=90).mean().rename('carry')
+
+
+def _held_quotes(inst):
+    """
+    Positions of the contract held on every date of the roll progression in
+    Instrument.price_matrix()
+    :return: dict with the roll progression 'rp', the matrix 'rows' and 'cols' and the boolean
+             array 'found' of the active quotes
+    """
+    m = inst.price_matrix()
+    rp = inst.roll_progression()
+    rows, cols = m.row_index(rp.index), m.column_index(rp.values)
+    return {'rp': rp, 'rows': rows, 'cols': cols, 'found': m.exists(rows, cols)}
+
+
+def _carry_prices(inst, reverse=False, held=None):
+    """
+    Close prices of the current contract and of the next (or the previous if reverse) contract
+    on every date with an active quote of any of them, looked up in Instrument.price_matrix()
+    :param held: _held_quotes() of the instrument, calculated if None
+    :return: two DataFrames indexed by date with the columns 'contract' (the contract month,
+             NaN without a quote) and 'close'
+    """
+    m = inst.price_matrix()
+    held = held or _held_quotes(inst)
+    rp, rows = held['rp'], held['rows']
+    other = inst.next_contracts(rp.values, months=inst.trade_only, reverse=reverse)
+    other_cols = m.column_index(other)
+    prices = [(held['found'], rp.values % 100, m.take('close', rows, held['cols'])),
+              (m.exists(rows, other_cols), other % 100, m.take('close', rows, other_cols))]
+    keep = prices[0][0] | prices[1][0]
+    current, other = [pd.DataFrame({'contract': np.where(found, month, np.nan)[keep],
+                                    'close': close[keep]}, index=rp.index[keep])
+                      for found, month, close in prices]
     # Replace zeros with nan
-    prev_prices[prev_prices == 0] = np.nan
+    other.loc[other['close'] == 0, 'close'] = np.nan
+    return current, other
 
-    current_prices['contract'] = current_prices['contract'].apply(_get_month)
-    prev_prices['contract'] = prev_prices['contract'].apply(_get_month)
-    td = current_prices['contract'] - prev_prices['contract']
+
+
+def _contract_years(current_prices, other_prices, reverse=False):
+    """
+    Time between the current contract and the next (or the previous if reverse) contract in
+    years, from their contract months
+    :param current_prices, other_prices: see _carry_prices()
+    """
+    td = other_prices['contract'] - current_prices['contract']
+    if reverse:
+        td = -td
     td.loc[td <= 0] = td.loc[td <= 0] + 12
-    td = td / 12
+    return td / 12
+
+
+def _carry_raw(current_prices, other_prices, reverse=False):
+    """
+    Carry per year between the current contract and the next (or the previous if reverse)
+    contract before the normalisation, used by carry_next(), carry_prev() and the incremental
+    state of the carry (core.incremental.CarryNextState)
+    :param current_prices, other_prices: see _carry_prices()
+    :return: pd.Series indexed by date
+    """
+    carry = other_prices['close'] - current_prices['close'] if reverse else \
+        current_prices['close'] - other_prices['close']
     # Apply a 5 day mean to prices to stabilise signal
-    carry = prev_prices['close'] - current_prices['close']
-    carry = carry.rolling(window=5).mean() / td
-    f = norm_forecast(carry).ffill(limit=3)
-    if f.sum() == 0:
-        print(inst.name + ' carry is zero')
-    return f.interpolate().rolling(window=90).mean().rename('carry')
+    return carry.rolling(window=5).mean() / _contract_years(current_prices, other_prices, reverse)
 
 
-def open_close(inst, **kw):
+@rule('held_quotes', 'return_volatility')
+def open_close(inst, context):
     """
     Read this one in a book, and it was easy to test. Consistently unprofitable in its current form.
     """
     #yesterdays open-close, divided by std deviation of returns
-    inst.panama_prices()
-    a = inst.rp().to_frame().set_index('contract', append=True).swaplevel().join(inst.contracts(), how='inner')
-    f = ((a['close']-a['open'])/inst.return_volatility).dropna().reset_index('contract', drop=True)
-    return norm_forecast(f).rename('open_close')
+    m = inst.price_matrix()
+    held = context['held_quotes']
+    rows, cols = held['rows'], held['cols']
+    a = pd.Series(m.take('close', rows, cols) - m.take('open', rows, cols),
+                  index=held['rp'].index)[held['found']]
+    f = (a/context['return_volatility']).dropna()
+    return norm_forecast(f.rename('open_close'), inst.name)
 
-def weather_rule(inst, **kw):
+@rule('panama_prices')
+def weather_rule(inst, context):
     """
     They say the most likely weather for tomorrow is today's weather. If today's return was +ve,
     returns +10 for tomorrow and vice versa.
     """
-    r = inst.panama_prices().diff()
+    r = context['panama_prices'].diff()
     #where today's return is 0, just use yesterday's forecast 
     r[r==0]=np.nan
     r = np.sign(r) * 10
@@ -147,17 +313,19 @@ def weather_rule(inst, **kw):
     return r.rename('weather_rule')
     
     
-def buy_and_hold(inst, **kw):
+@rule('panama_prices')
+def buy_and_hold(inst, context):
     """
     Returns a fixed forecast of 10.
     """
-    return pd.Series(10, index=inst.pp().index).rename('buy_and_hold')
+    return pd.Series(10, index=context['panama_prices'].index).rename('buy_and_hold')
 
-def sell_and_hold(inst, **kw):
+@rule('panama_prices')
+def sell_and_hold(inst, context):
     """
     Returns a fixed forecast of -10.
     """
-    return pd.Series(-10, index=inst.pp().index).rename('sell_and_hold')
+    return pd.Series(-10, index=context['panama_prices'].index).rename('sell_and_hold')
 
 def breakout_fn(data, lookback, smooth=None):
     """
@@ -176,18 +344,53 @@ def breakout_fn(data, lookback, smooth=None):
     bsmooth = b.ewm(span=smooth, min_periods=np.ceil(smooth / 2.0)).mean()
     return bsmooth
 
-def breakout(inst, **kw):
+def breakout_batch(prices, lookbacks=None):
+    """
+    Breakout forecasts of many lookbacks in one pass, the same as breakout_fn() for every
+    lookback. The rolling minima and maxima of all the lookbacks come from a single sparse table
+    of the prices (see core.utility.rolling_extrema()), so a dense family of lookbacks costs
+    little more than the four default ones.
+    :param prices: prices Series
+    :param lookbacks: lookback windows in days, breakout_lookbacks by default
+    :return: forecast DataFrame with the columns brk[lookback], range [-1, 1] (unnormed)
+    """
+    lookbacks = list(lookbacks or breakout_lookbacks)
+    values = prices.to_numpy(dtype='float64')
+    min_periods = [int(min(len(values), np.ceil(x / 2.0))) for x in lookbacks]
+    # (lookbacks, dates) views, a row per lookback
+    lows, highs = [a.T for a in rolling_extrema(values, lookbacks, min_periods)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        b = (values - (highs + lows) / 2.0) / (highs - lows)
+    nobs = np.cumsum(~np.isnan(b), axis=1)
+    columns = {}
+    for j, x in enumerate(lookbacks):
+        smooth = max(int(x / 4.0), 1)
+        f = np.full(len(values), np.nan)
+        # the smoothing starts at the first value, without the missing values of the warm-up
+        start = int(np.argmax(nobs[j] > 0)) if len(values) and nobs[j, -1] else len(values)
+        f[start:] = ewm_mean(b[j, start:], smooth)
+        f[nobs[j] < np.ceil(smooth / 2.0)] = np.nan
+        columns['brk%d' % x] = f
+    return pd.DataFrame(columns, index=prices.index)
+
+@rule('panama_prices')
+def breakout(inst, context):
     """
     Returns a DataFrame of breakout forecasts based on Rob Carver's work here:
     https://qoppac.blogspot.com.es/2016/05/a-simple-breakout-trading-rule.html
     """
-    prices = inst.panama_prices(**kw)
-    lookbacks = [40, 80, 160, 320]
-    res = map(partial(breakout_fn, prices), lookbacks)
-    res = pd.DataFrame(list(res)).transpose()
-    res.columns = pd.Series(lookbacks).map(lambda x: "brk%d" % x)
-    return norm_forecast(res)
+    return norm_forecast(breakout_batch(context['panama_prices']), inst.name)
 
-def _get_month(a):
-    return int(str(a)[4:6])
 
+# Intermediate results consumed by the rules: fn(inst, context)
+intermediates = {
+    'panama_prices': lambda inst, c: inst.panama_prices(),
+    'norm_prices': lambda inst, c: norm_vol(c['panama_prices'], inst.name),
+    'held_quotes': lambda inst, c: _held_quotes(inst),
+    'next_prices': lambda inst, c: _carry_prices(inst, held=c['held_quotes']),
+    'prev_prices': lambda inst, c: _carry_prices(inst, reverse=True, held=c['held_quotes']),
+    'market_price': lambda inst, c: inst.market_price().reset_index('contract', drop=True),
+    'spot': lambda inst, c: inst.spot(),
+    'time_to_expiry': lambda inst, c: inst.time_to_expiry(),
+    'return_volatility': lambda inst, c: inst.return_volatility(),
+}
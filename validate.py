@@ -10,7 +10,7 @@ logger = logging.getLogger('validate')
 if __name__ == "__main__":
     p = trading.portfolio.Portfolio(instruments=config.portfolios.p_trade)
     try:
-        validate = p.validate()[['carry_forecast', 'currency_age', 'panama_age', 'price_age', 'weighted_forecast']]
+        validate = p.validate(fast=True)[['carry_forecast', 'currency_age', 'panama_age', 'price_age', 'weighted_forecast']]
         print(validate)
     except KeyboardInterrupt:
         print("Shutdown requested...exiting")